@@ -0,0 +1,271 @@
+"""
+test_adjust_tfsd.py
+
+Checks that `proc_swt.adjust_tfsd` (with its bulk sample and subsample helpers,
+`_gap_sample_times` and `_subsample_times`) gives the same tables as the
+scene-by-scene algorithm it replaced, both with NumPy and with plain Python, on
+randomized tables and parameter sets.
+
+Run with `python -m pytest tests`.
+"""
+
+import random
+import logging
+
+import pytest
+
+from visaid_builder import proc_swt
+from visaid_builder.proc_swt import Scene, PROC_SWT_DEFAULTS
+
+
+LABELS = [ "bars", "slate", "chyron", "person & chyron", "credits", "other text", "text" ]
+NUM_TABLES = 200
+
+
+def reference_adjust_tfsd( tfsd_in:list,
+                           first_time:int,
+                           final_time:int,
+                           params_in:dict ):
+    """
+    The previous implementation of `adjust_tfsd`, which adds samples and
+    subsamples one scene at a time
+    """
+    tfsd = tfsd_in[:]
+    if first_time is None or final_time is None:
+        return tfsd
+
+    params = {}
+    if "default_to_none" in params_in:
+        params["default_to_none"] = params_in["default_to_none"]
+    else:
+        params["default_to_none"] = PROC_SWT_DEFAULTS["default_to_none"]
+    for key in PROC_SWT_DEFAULTS:
+        if key == "default_to_none":
+            continue
+        elif key in params_in:
+            params[key] = params_in[key]
+        elif not params["default_to_none"]:
+            params[key] = PROC_SWT_DEFAULTS[key]
+        else:
+            params[key] = None
+
+    if params["include_only"] is not None:
+        tfsd = [ tf for tf in tfsd if tf["tf_label"] in params["include_only"] ]
+    if params["exclude"] is not None and len(params["exclude"]) > 0:
+        tfsd = [ tf for tf in tfsd if tf["tf_label"] not in params["exclude"] ]
+    tfsd.sort(key=lambda f:f["start"])
+
+    tfsd.insert(0, Scene('f_0', 'first frame checked', first_time, first_time, first_time))
+    tfsd.append(Scene('f_n', 'last frame checked', final_time, final_time, final_time))
+
+    if params["max_unsampled_gap"]:
+        max_gap = params["max_unsampled_gap"]
+        sample_dur = max_gap // 2
+        samples = []
+        next_sample_num = 1
+        for rnum in range(1, len(tfsd)):
+            full_gap = tfsd[rnum]["start"] - tfsd[rnum-1]["end"]
+            if full_gap > max_gap:
+                num_samples = full_gap // max_gap
+                gap_size = full_gap // num_samples
+                for sample_count in range(num_samples):
+                    gap_start = tfsd[rnum-1]["end"] + ( sample_count * gap_size )
+                    sample_start = gap_start + (gap_size - sample_dur)//2
+                    samples.append( Scene( "s_" + str(next_sample_num), "unlabeled sample",
+                                           sample_start, sample_start + sample_dur,
+                                           sample_start + sample_dur//2 ) )
+                    next_sample_num += 1
+        tfsd += samples
+
+    if params["subsampling"] is not None or params["default_subsampling"] is not None:
+        subsampling = {}
+        if params["default_subsampling"] is None:
+            subsampling = dict(params["subsampling"])
+        else:
+            for label in set( tf["tf_label"] for tf in tfsd_in ):
+                subsampling[label] = params["default_subsampling"]
+            if params["subsampling"]:
+                for label in params["subsampling"]:
+                    subsampling[label] = params["subsampling"][label]
+        for scenetype in list(subsampling):
+            if not ( subsampling[scenetype] > 0 and subsampling[scenetype] < 9000000 ):
+                del subsampling[scenetype]
+
+        new_scenes = []
+        for tf in [ tf for tf in tfsd if tf["tf_label"] in subsampling ]:
+            scene_dur = tf["end"] - tf["start"]
+            if scene_dur > subsampling[tf["tf_label"]]:
+                num_subsamples = ( scene_dur // subsampling[tf["tf_label"]] ) + 1
+                subsample_dur = scene_dur // num_subsamples
+                next_start = tf["start"]
+                for k in range(num_subsamples):
+                    new_scenes.append( Scene( tf["tf_id"] + "_s_" + str(k), tf["tf_label"] + " - - -",
+                                              next_start, next_start + subsample_dur,
+                                              next_start + ( subsample_dur // 2 ) ) )
+                    next_start += subsample_dur
+        tfsd += new_scenes
+
+    to_remove = []
+    if not params["include_first_time"]:
+        to_remove.append('f_0')
+    if not params["include_final_time"]:
+        to_remove.append('f_n')
+    tfsd = [ tf for tf in tfsd if tf["tf_id"] not in to_remove ]
+
+    tfsd.sort(key=lambda f:f["start"])
+    return tfsd
+
+
+def random_table( rng, num_scenes:int, time_type=int ) -> tuple:
+    """
+    Returns a random tfsd table (unsorted, possibly with overlapping scenes and
+    long gaps), with its first and final times, with times of type `time_type`
+    """
+    tfsd = []
+    t = rng.randint(0, 5000)
+    for i in range(num_scenes):
+        t += rng.choice( [ 0, rng.randint(0, 3000), rng.randint(0, 200000) ] )
+        dur = rng.choice( [ 0, rng.randint(1, 5000), rng.randint(1, 150000) ] )
+        start, end = t, t + dur
+        tfsd.append( Scene( f"v_1:tf_{i}", rng.choice(LABELS), time_type(start), time_type(end),
+                            time_type(start + dur // 2), tp_label="X", tp_id=f"v_1:tp_{i}" ) )
+    rng.shuffle(tfsd)
+    return tfsd, time_type(0), time_type(t + rng.randint(0, 400000))
+
+
+def random_params( rng ) -> dict:
+    """
+    Returns a random set of adjustment parameters, covering the combinations of
+    gap sampling, subsampling, filtering, and first/final inclusion
+    """
+    params = {}
+    if rng.random() < 0.5:
+        params["default_to_none"] = rng.random() < 0.5
+    if rng.random() < 0.7:
+        params["max_unsampled_gap"] = rng.choice( [ None, 0, 999, 60000, rng.randint(500, 100000) ] )
+    if rng.random() < 0.7:
+        params["subsampling"] = rng.choice( [ None, {},
+                                              { rng.choice(LABELS): rng.randint(500, 50000) },
+                                              { label: rng.choice( [ -10, 0, rng.randint(500, 50000) ] ) for label in LABELS },
+                                              { "unlabeled sample": rng.randint(500, 20000) } ] )
+    if rng.random() < 0.7:
+        params["default_subsampling"] = rng.choice( [ None, 30100, rng.randint(500, 80000) ] )
+    if rng.random() < 0.3:
+        params["include_only"] = rng.sample(LABELS, rng.randint(0, len(LABELS)))
+    if rng.random() < 0.3:
+        params["exclude"] = rng.sample(LABELS, rng.randint(0, 3))
+    for key in ( "include_first_time", "include_final_time" ):
+        if rng.random() < 0.8:
+            params[key] = rng.random() < 0.5
+    return params
+
+
+def rows( tfsd:list ) -> list:
+    return [ tuple( tf[k] for k in Scene.__slots__ ) for tf in tfsd ]
+
+
+def outcome( fn, *args ):
+    """
+    Returns the rows of the table returned by `fn`, or the type of the exception
+    it raised
+    """
+    try:
+        return rows( fn(*args) )
+    except Exception as e:
+        return type(e)
+
+
+@pytest.fixture(params=["numpy", "python"])
+def numpy_mode( request, monkeypatch ):
+    """
+    Runs a test with NumPy (if installed) and without it
+    """
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+        monkeypatch.setattr(proc_swt, "_NUMPY", True)
+    else:
+        monkeypatch.setattr(proc_swt, "_NUMPY", False)
+    return request.param
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    logging.disable(logging.WARNING)
+    yield
+    logging.disable(logging.NOTSET)
+
+
+def test_matches_reference( numpy_mode ):
+    rng = random.Random(7)
+    for _ in range(NUM_TABLES):
+        tfsd, first_time, final_time = random_table( rng, rng.randint(0, 60) )
+        params = random_params( rng )
+        assert ( rows( proc_swt.adjust_tfsd(tfsd, first_time, final_time, params) ) ==
+                 rows( reference_adjust_tfsd(tfsd, first_time, final_time, params) ) ), params
+
+
+@pytest.mark.parametrize("include_first", [True, False])
+@pytest.mark.parametrize("include_final", [True, False])
+def test_first_and_final( numpy_mode, include_first, include_final ):
+    rng = random.Random(11)
+    for _ in range(NUM_TABLES // 4):
+        tfsd, first_time, final_time = random_table( rng, rng.randint(0, 20) )
+        params = random_params( rng )
+        params["include_first_time"] = include_first
+        params["include_final_time"] = include_final
+        adjusted = proc_swt.adjust_tfsd(tfsd, first_time, final_time, params)
+        assert rows(adjusted) == rows( reference_adjust_tfsd(tfsd, first_time, final_time, params) )
+        ids = [ tf["tf_id"] for tf in adjusted ]
+        assert ( "f_0" in ids ) == include_first
+        assert ( "f_n" in ids ) == include_final
+
+
+@pytest.mark.parametrize("max_gap", [None, 0, 30000, 60000])
+@pytest.mark.parametrize("subsampling", [None, {}, {"credits": 1900, "slate": 9900}])
+@pytest.mark.parametrize("default_subsampling", [None, 30100])
+@pytest.mark.parametrize("exclude", [[], ["credits"]])
+def test_parameter_combinations( numpy_mode, max_gap, subsampling, default_subsampling, exclude ):
+    rng = random.Random(13)
+    params = { "max_unsampled_gap": max_gap,
+               "subsampling": subsampling,
+               "default_subsampling": default_subsampling,
+               "exclude": exclude }
+    for _ in range(10):
+        tfsd, first_time, final_time = random_table( rng, rng.randint(0, 40) )
+        assert ( rows( proc_swt.adjust_tfsd(tfsd, first_time, final_time, params) ) ==
+                 rows( reference_adjust_tfsd(tfsd, first_time, final_time, params) ) )
+
+
+@pytest.mark.parametrize("time_type", [float, "numpy", "mixed"])
+def test_non_int_times( numpy_mode, time_type ):
+    # Tables with times that are not all plain ints take the plain Python path,
+    # and must behave as the previous implementation did (including raising the
+    # same exception, e.g., for float sample counts).
+    rng = random.Random(17)
+    if time_type == "numpy":
+        np = pytest.importorskip("numpy")
+        time_type = np.int64
+    elif time_type == "mixed":
+        time_type = lambda t: float(t) if rng.random() < 0.2 else int(t)
+    for _ in range(NUM_TABLES // 2):
+        tfsd, first_time, final_time = random_table( rng, rng.randint(0, 30), time_type )
+        params = random_params( rng )
+        assert ( outcome( proc_swt.adjust_tfsd, tfsd, first_time, final_time, params ) ==
+                 outcome( reference_adjust_tfsd, tfsd, first_time, final_time, params ) ), params
+
+
+def test_helpers_numpy_matches_python( monkeypatch ):
+    pytest.importorskip("numpy")
+    rng = random.Random(19)
+    for _ in range(NUM_TABLES):
+        n = rng.randint(0, 50)
+        starts = [ rng.randint(0, 10**6) for _ in range(n) ]
+        ends = [ s + rng.randint(0, 200000) for s in starts ]
+        thresholds = [ rng.randint(500, 50000) for _ in range(n) ]
+        max_gap = rng.randint(500, 100000)
+        results = {}
+        for mode in ( True, False ):
+            monkeypatch.setattr(proc_swt, "_NUMPY", mode)
+            results[mode] = ( proc_swt._gap_sample_times( ends[:-1], starts[1:], max_gap, max_gap // 2 ),
+                              proc_swt._subsample_times( starts, ends, thresholds ) )
+        assert results[True] == results[False]
@@ -0,0 +1,71 @@
+"""
+test_encoders.py
+
+Checks that the JPEG encoders for stills (see `lilhelp.ENCODERS`) give visually
+equivalent stills of the same size:  each encoder's stills must be within
+`format_bench.EQUIVALENT_PSNR` of Pillow's, in every quality profile.  Timings
+are printed (run with `-s` to see them).
+
+Run with `python -m pytest tests`.
+"""
+
+import io
+import random
+
+import av
+import pytest
+from PIL import Image, ImageDraw, ImageFilter
+
+from visaid_builder import lilhelp
+from visaid_builder import format_bench
+
+
+def make_frames( num_frames:int = 6 ) -> list:
+    """
+    Returns YUV frames (as decoded from video) with flat areas, edges, gradients,
+    and noise
+    """
+    rng = random.Random(29)
+    frames = []
+    for _ in range(num_frames):
+        image = Image.effect_noise( (640, 480), rng.randint(5, 20) ).convert("RGB")
+        draw = ImageDraw.Draw(image)
+        for _ in range(12):
+            x, y = rng.randint(0, 600), rng.randint(0, 440)
+            color = tuple( rng.randint(0, 255) for _ in range(3) )
+            draw.rectangle( (x, y, x + rng.randint(10, 200), y + rng.randint(10, 150)), fill=color )
+            draw.text( (rng.randint(0, 600), rng.randint(0, 460)), "SLATE 42", fill=(255, 255, 255) )
+        image = image.filter(ImageFilter.SMOOTH)
+        frames.append( av.VideoFrame.from_image(image).reformat(format="yuv420p") )
+    return frames
+
+
+@pytest.fixture(scope="module")
+def results():
+    results = format_bench.compare_encoders( make_frames(), 1.0, list(lilhelp.IMG_PROFILES), max_img_height=240 )
+    for r in results:
+        print( f"{r['encoder']:7} {r['profile']:8} {r['bytes']:>8.0f} bytes {r['ms']:>6.2f} ms "
+               f"PSNR {r['psnr']:.1f} vs pillow {r['psnr_vs_pillow'] or 0:.1f}" )
+    return results
+
+
+def test_encoders_equivalent( results ):
+    for r in results:
+        assert r["equivalent"], r
+        if r["encoder"] != "pillow":
+            assert r["min_psnr_vs_pillow"] >= format_bench.EQUIVALENT_PSNR, r
+
+
+def test_encoders_same_fidelity( results ):
+    # Each encoder is about as faithful to the frames as Pillow
+    pillow = { r["profile"]: r for r in results if r["encoder"] == "pillow" }
+    for r in results:
+        assert r["psnr"] >= pillow[r["profile"]]["psnr"] - 2.0, r
+
+
+@pytest.mark.parametrize("encoder", lilhelp.ENCODERS)
+def test_still_size_and_type( encoder ):
+    frame = make_frames(1)[0]
+    img_data = lilhelp.encode_image( frame, 320, 240, "JPEG", 75, encoder=encoder )
+    assert lilhelp.image_type(img_data)[0] == "image/jpeg"
+    assert Image.open(io.BytesIO(img_data)).size == (320, 240)
@@ -0,0 +1,142 @@
+"""
+test_target_frames.py
+
+Checks that every extraction strategy of `lilhelp.iter_target_frames` ("linear",
+"seek", and "auto", as planned by `lilhelp.plan_seeks`) finds the same frames:
+the same frame times and the same pixels, for sparse and dense target times, in
+several container formats.  MPEG program and transport streams, in which seeking
+is not exact, must fall back to decoding linearly.
+
+The test clips are generated with PyAV (in a temporary directory), so no media
+files are needed.
+
+Run with `python -m pytest tests`.
+"""
+
+import hashlib
+import random
+
+import av
+import pytest
+from PIL import Image, ImageDraw
+
+from visaid_builder import lilhelp
+
+
+CLIP_SECONDS = 12
+CLIP_FPS = 25
+CLIP_GOP = 12
+
+# (file name, container format, codec, encoder options, whether seeking is expected)
+CLIPS = [ ( "clip.mp4", "mp4", "libx264", {"bf": "2"}, True ),
+          ( "clip.mkv", "matroska", "mpeg4", {"bf": "2"}, True ),
+          ( "clip.avi", "avi", "mpeg4", {}, True ),
+          ( "clip.mpg", "mpeg", "mpeg2video", {"bf": "2"}, False ),
+          ( "clip.ts", "mpegts", "mpeg2video", {"bf": "2"}, False ) ]
+
+
+def make_clip( path:str,
+               container_format:str,
+               codec:str,
+               options:dict ):
+    """
+    Writes a short test clip in which every frame looks different
+    """
+    with av.open(path, "w", format=container_format) as container:
+        if codec not in av.codecs_available:
+            pytest.skip(f"No {codec} encoder")
+        stream = container.add_stream(codec, rate=CLIP_FPS)
+        stream.width = 160
+        stream.height = 120
+        stream.pix_fmt = "yuv420p"
+        stream.codec_context.gop_size = CLIP_GOP
+        stream.codec_context.options = dict(options)
+        for fnum in range(CLIP_SECONDS * CLIP_FPS):
+            image = Image.new("RGB", (160, 120), ( (fnum * 7) % 256, (fnum * 13) % 256, 90 ))
+            draw = ImageDraw.Draw(image)
+            draw.rectangle( ( fnum % 140, 20, fnum % 140 + 20, 60 ), fill=(255, 255, 255) )
+            draw.text( (10, 80), str(fnum), fill=(0, 0, 0) )
+            frame = av.VideoFrame.from_image(image)
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+
+@pytest.fixture(scope="module", params=CLIPS, ids=[ c[0] for c in CLIPS ])
+def clip( request, tmp_path_factory ):
+    fname, container_format, codec, options, seekable = request.param
+    path = str(tmp_path_factory.mktemp("clips") / fname)
+    make_clip( path, container_format, codec, options )
+    return path, seekable
+
+
+def target_sets() -> dict:
+    """
+    Returns sets of target times (in ms):  sparse (far apart, so "auto" seeks),
+    dense (so "auto" decodes forward), and mixed, each with targets at the start,
+    between frames, on frames, and past the end of the clip
+    """
+    rng = random.Random(23)
+    end_ms = CLIP_SECONDS * 1000
+    sparse = [ 0, 3000, 6021, 9980, end_ms + 500 ]
+    dense = sorted( rng.randint(4000, 5200) for _ in range(15) )
+    mixed = sorted( set( [ 0, 40, 41, 7960 ] +
+                         [ rng.randint(0, end_ms - 1) for _ in range(12) ] +
+                         [ end_ms - 1, end_ms * 2 ] ) )
+    return { "sparse": sparse, "dense": dense, "mixed": mixed }
+
+
+def found_frames( video_path:str,
+                  target_times:list,
+                  strategy:str,
+                  skip_frames:str = "none" ) -> tuple:
+    """
+    Returns the (target time, frame time, pixel hash) found for each target with
+    the given strategy, and the decoding stats
+    """
+    stats = {}
+    found = []
+    with av.open(video_path) as container:
+        video_stream = next(s for s in container.streams if s.type == 'video')
+        for target_time, ftime, frame in lilhelp.iter_target_frames( container,
+                                                                     video_stream,
+                                                                     target_times,
+                                                                     strategy=strategy,
+                                                                     gop_ms=lilhelp.probe_gop(video_path),
+                                                                     stats=stats,
+                                                                     skip_frames=skip_frames ):
+            found.append( (target_time, ftime, hashlib.sha1(frame.to_image().tobytes()).hexdigest()) )
+    return found, stats
+
+
+@pytest.mark.parametrize("targets", list(target_sets()))
+@pytest.mark.parametrize("skip_frames", ["none", "nonkey"])
+def test_strategies_find_same_frames( clip, targets, skip_frames ):
+    video_path, seekable = clip
+    target_times = target_sets()[targets]
+
+    linear, _ = found_frames( video_path, target_times, "linear" )
+    assert len(linear) > 0
+    for strategy in ( "seek", "auto" ):
+        found, stats = found_frames( video_path, target_times, strategy, skip_frames )
+        assert found == linear, strategy
+        if not seekable:
+            # (MPEG program and transport streams are always decoded linearly.)
+            assert stats["seeks"] == 0, strategy
+
+
+def test_seek_strategy_seeks( clip ):
+    video_path, seekable = clip
+    with av.open(video_path) as container:
+        assert lilhelp.is_seekable(container) == seekable
+    _, stats = found_frames( video_path, target_sets()["sparse"], "seek" )
+    if seekable:
+        assert stats["seeks"] > 0
+    else:
+        assert stats["seeks"] == 0
+
+
+def test_plan_seeks():
+    assert lilhelp.plan_seeks( [ 100, 200, 5000, 5100 ], gop_ms=500, min_gap_gops=2 ) == [ False, False, True, False ]
+    assert lilhelp.plan_seeks( [ 100, 5000 ], gop_ms=None ) == [ False, False ]
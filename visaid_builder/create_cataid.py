@@ -4,7 +4,8 @@ create_cataid.py
 Defines a function for creating a cataid from a list of scene TimeFrames.
 
 The main required parameters are the path to the video file and a table
-(list of dicts) in the style of the `tfsd` tables created by the proc_swt module.
+(list of `Scene` records or dicts) in the style of the `tfsd` tables created by 
+the proc_swt module.
 
 This function reads and depends on the display ingredients in these files:
    visaid_ingredients/visaid_embedded_styles.css
@@ -14,19 +15,18 @@ This function reads and depends on the display ingredients in these files:
 """
 
 import os
-import io
-import base64
 import json
+import base64
 import logging
 
 from datetime import datetime
 from importlib.metadata import version
 
-import av
 from titlecase import titlecase
 
 __version__ = version("visaid_builder")
 from . import lilhelp
+from . import create_visaid
 from . import catification_prompts as cp
 
 try:
@@ -52,6 +52,21 @@ CATAID_DEFAULTS = { "deselected_scene_types": ["filmed text"],
                     "display_image_ms": True,
                     "aapb_timecode_link": False,
                     "max_img_height": 360,
+                    "interpolation": "bilinear",
+                    "img_encoder": "pillow",
+                    "extract_strategy": "auto",
+                    "skip_frames": "nonkey",
+                    "skip_window": 1000,
+                    "decode_thread_type": "auto",
+                    "decode_threads": 0,
+                    "decode_workers": 1,
+                    "encode_threads": 4,
+                    "lowres_decode": False,
+                    "image_mode": "inline",
+                    "img_format": "JPEG",
+                    "img_profile": "standard",
+                    "img_budget_kb": None,
+                    "max_img_kb": None,
                     "use_ai_helper": False,
                     "custom_prompt_file": None }
 
@@ -121,12 +136,22 @@ def create_cataid( video_path:str,
                    proc_swt_params:dict = {},
                    cataid_params:dict = {},
                    mmif_metadata_str: str = "",
-                   prompts_dir:str = None
+                   prompts_dir:str = None,
+                   stills:tuple = None,
+                   thumb_cache_dir:str = None,
+                   index_dir:str = None,
+                   index_next_to_media:bool = False
                    ):       
     """
     Creates an HTML file (with embedded images) as a visaid with cataloging features,, 
     based on MMIF file processed into the tfsd structure.
 
+    If `stills` is passed, it should be as returned by `create_visaid.extract_images`
+    for the rep times in `tfsd` and the "max_img_height" in `cataid_params`.  Then
+    the video is not decoded again.  Otherwise, stills are extracted, using the 
+    thumbnail cache in `thumb_cache_dir` (if given), and saving the media index as
+    `index_dir` and `index_next_to_media` say (see `create_visaid.extract_images`).
+
     """
 
     problems = []
@@ -160,6 +185,16 @@ def create_cataid( video_path:str,
             suffix = ""
         hfilename = prefix + params["type_signified_in_cataid_filename"] + suffix + ".html"
 
+    # Set up the directory for sidecar image files, if needed
+    # (See `create_visaid.IMAGE_MODES`.  Cataids do not use sprite sheets, so
+    # "sprite" is taken as "sidecar".)
+    if params["image_mode"] not in create_visaid.IMAGE_MODES:
+        raise ValueError(f'Invalid image mode: {params["image_mode"]}')
+    image_dirname = None
+    if params["image_mode"] in ("sidecar", "sprite") and not stdout:
+        image_dirname = create_visaid.sidecar_dirname(hfilename)
+        os.makedirs(output_dirname + "/" + image_dirname, exist_ok=True)
+
     # Construct video name/identifier string to display in cataid
     video_fname = video_path[video_path.rfind("/")+1:]
     if item_name:
@@ -173,141 +208,51 @@ def create_cataid( video_path:str,
     cataid_identifier = video_identifier + "#" + datetime.now().strftime("%Y%m%d%H%M%S")
 
     # 
-    # Begin analyzing video in terms of tfsd table
+    # Get stills for the scenes in the tfsd table (unless they were passed in)
     #
-
-    # find the first video stream
-    container = av.open(video_path)
-    video_stream = next((s for s in container.streams if s.type == 'video'), None)
-    if video_stream is None:
-        raise Exception("No video stream found in {}".format(video_path) ) 
-
-    # get technical stats on the video stream; assumes FPS is constant
-    fps = video_stream.average_rate.numerator / video_stream.average_rate.denominator
-    extras["fps"] = float(f"{fps:.2f}")
-
-    # determine whether anamorphic stills will need to be stretched
-    if video_stream.sample_aspect_ratio is not None:
-        sar = float(video_stream.sample_aspect_ratio)
-        extras["sar"] = float(f"{sar:.3f}")
-    else:
-        # If SAR cannot be determined, assume it is 1 for present purposes
-        sar = 1.0
-        # But report it as None
-        extras["sar"] = None
-
-    if abs( 1 - sar ) > STRETCH_THRESHOLD:
-        stretch = True
-        if not stdout:
-            logging.info(f'Sample aspect ratio: {sar:.3f}. Will stretch anamorphic frames.')
-        infos.append(f'SAR-{sar:.3f}')
-    else:
-        stretch = False
-
-    # calculate duration in ms
-    media_length = int((video_stream.frames / fps) * 1000)
-    extras["media_length"] = media_length
-
-    # Table like tfsd, but with an extra columns. 
-    # Uses rows from the tfsd table, but adds additional columns for actual frame 
-    # time and base64 image data.
-
-    tfsdi = []
-    
-    # Build up tfsdi table by adding rows based on tfsd rows.
-    if len(tfsd) > 0:
-
-        # Create a new list sorted in order of rep frame times .
-        # Because we need to proceed in order of video frames to be extracted
-        # (not necessarily the order of the scene start times).
-        tfsd_s = sorted(tfsd, key=lambda f:f["tp_time"])
-
-        # initialize target scene and still 
-        next_scene = 0 
-        target_time = tfsd_s[next_scene]["tp_time"]
-        last_packet_error = 0
-      
-        # looping through packets instead of frames allows exception handling for each
-        # particular decode step.  This main loop originally iterated over frames in
-        # `container.decode(video_stream)`.
-        for packet in container.demux(video_stream):
-            #break # TESTING 
-            try:
-                for frame in packet.decode():
-                    ftime = int(frame.time * 1000)   
-
-                    # Look for the frame nearest to the target.
-                    # (Using `while` instead of `if` to loop through multiple rows
-                    #  in case multiple rows tareget the same frame (which is
-                    #  possible if scenes overlap).
-                    #while ftime+15 >= target_time :
-                    
-                    # Look for first frame after the target
-                    while ftime >= target_time :
-                        
-                        # Check for anamorphic and stretch if necessary
-                        if stretch:
-                            if sar > 1.0:
-                                # stretch the width
-                                new_width = int( sar * frame.width)
-                                new_height = frame.height
-                            else:
-                                # stretch the height
-                                new_width = frame.width
-                                new_height = int(frame.height / sar)
-                            stretched_frame = frame.reformat( width=new_width, height=new_height )
-                        else:
-                            stretched_frame = frame
-
-                        # Reduce the size of the image, if necessary
-                        if stretched_frame.height > params["max_img_height"]:
-                            res_factor = params["max_img_height"] / stretched_frame.height 
-                            new_width = int(stretched_frame.width * res_factor)
-                            res_frame = stretched_frame.reformat( width=new_width, height=params["max_img_height"] )
-                        else:
-                            res_frame = stretched_frame
-
-                        # Save frame to memory buffer
-                        buf = io.BytesIO()
-                        res_frame.to_image().save(buf, format="JPEG", quality=75)
-
-                        # convert binary image data to base64 serialized in a UTF-8 string
-                        img_str = base64.b64encode(buf.getvalue()).decode('utf-8')
-
-                        # add new row to tfsdi
-                        new_tf = dict(tfsd_s[next_scene])
-                        new_tf["video_frame_time"] = ftime
-                        new_tf["img_str"] = img_str
-                        tfsdi.append(new_tf)
-                        
-                        next_scene += 1
-                        if next_scene >= len(tfsd_s):            
-                            # no need to continue decoding video if we have all our scenes saved
-                            break
-                        else:
-                            target_time = tfsd_s[next_scene]["tp_time"]
-
-            except av.error.InvalidDataError as e:
-                # This exception may get raised many times if there are many packets with problems
-                # However, we'll log only one error per (starting) time stamp of corrupt region.
-                if last_packet_error != ftime:
-                    if not stdout:
-                        logging.warning(f"{video_fname} at {ftime} ms: {e}")
-                    last_packet_error = ftime
-                if "decode" not in problems:
-                    problems.append("decode")
-                continue  # Skip this packet and try the next one
-
-            if next_scene >= len(tfsd_s):
-                # no need to continue decoding video if we have all our scenes saved
-                break
-
-    # Done with the video media itself
-    container.close()
-
-    # Re-sort new array in terms of scene start time, then by TimeFrame id,
+    img_format, img_quality = create_visaid.img_settings( params["img_format"], params["img_profile"], stdout )
+    if stills is None:
+        stills = create_visaid.extract_images( video_path, 
+                                               [ f["tp_time"] for f in tfsd ],
+                                               [ params["max_img_height"] ],
+                                               stdout=stdout,
+                                               img_format=img_format,
+                                               img_quality=img_quality,
+                                               strategy=params["extract_strategy"],
+                                               skip_frames=params["skip_frames"],
+                                               skip_window=params["skip_window"],
+                                               thread_type=params["decode_thread_type"],
+                                               thread_count=params["decode_threads"],
+                                               workers=params["decode_workers"],
+                                               encode_threads=params["encode_threads"],
+                                               cache_dir=thumb_cache_dir,
+                                               index_dir=index_dir,
+                                               index_next_to_media=index_next_to_media,
+                                               interpolation=params["interpolation"],
+                                               encoder=params["img_encoder"],
+                                               lowres=params["lowres_decode"],
+                                               stretch_threshold=STRETCH_THRESHOLD )
+    images, stills_problems, stills_infos, stills_extras = stills
+    problems += [ p for p in stills_problems if p not in problems ]
+    infos += stills_infos
+    extras.update(stills_extras)
+    media_length = extras["media_length"]
+
+    # List of (scene, actual frame time, base64 image data) tuples. 
+    # Refers to the rows of the tfsd table, rather than copying them.
+    # (Scenes whose rep time is beyond the last frame of the video have no still.)
+    imgs = images[params["max_img_height"]]
+    tfsdi = [ (f, *imgs[f["tp_time"]]) 
+              for f in sorted(tfsd, key=lambda f:f["tp_time"]) 
+              if f["tp_time"] in imgs ]
+
+    # Sort in terms of scene start time, then by TimeFrame id,
     # (so that subsamples come after the scenes from which they've been sampled.)
-    tfsdi.sort(key=lambda f:(f["start"],f["tf_id"]))
+    tfsdi.sort(key=lambda f:(f[0]["start"],f[0]["tf_id"]))
+
+    # Re-encode the stills to fit the byte budget, if any
+    tfsdi = create_visaid.fit_budget( tfsdi, params, inline=(image_dirname is None), 
+                                      extras=extras, stdout=stdout )
     #tfsdi = tfsd # TESTING
 
     # Get ingredient code strings for inclusion in HTML files
@@ -403,156 +348,9 @@ def create_cataid( video_path:str,
     # serialize metadata about process and cataid options
     cataid_options_str = json.dumps( [proc_swt_params, cataid_params], indent=2 )
 
-    # Build HTML strig for main body of cataid -- the collection of cataid scenes, KIE, and annotation
-    # (This is the bulk of the cataid.)
-    cataid_body = ""
-    if len(tfsdi) == 0:
-        cataid_body += ("<div class=''>(No annotated scenes.)</div>")
-
-    # Create new item divs for each row in tfsdi
-    for ri, f in enumerate(tfsdi):
-
-        # `tf_label` is the displayed label, the value of `data-label`
-        tf_label = f["tf_label"]
-        tp_id = f["tp_id"]
-        tp_time = f["tp_time"]
-        video_frame_time = f["video_frame_time"] 
-        edit_row_id = str(ri)
-
-        # information to keep at the top itemrow-level div
-        itemrow_div_class = "itemrow" 
-        item_div_class = "item"
-
-        # Set some values used for logic.
-        # `scenetype` means the `tf_label` without the subsample suffix
-        if tf_label.find(" - - -") != -1:
-            item_div_class += " subsample"
-            scenetype = tf_label[:tf_label.find(" - - -")]
-        elif tf_label.find("unlabeled sample") != -1:
-            item_div_class += " unsample"
-            scenetype = tf_label
-        else:
-            item_div_class = item_div_class
-            scenetype = tf_label
-
-        #
-        # Build some strings as inline ingredients
-        #
-
-        # Human-readable time span for the item
-        time_start_str = lilhelp.tconv(f["start"], False)
-        time_end_str = lilhelp.tconv(f["end"], False) 
-
-        # human-readable time span for the item
-        time_start_str = lilhelp.tconv(f["start"], False)
-        time_end_str = lilhelp.tconv(f["end"], False) 
-
-        # Hyperlinked start time
-        if params["aapb_timecode_link"] and item_id:
-            # creating a link to the AAPB
-            time_start_sec = str(f["start"]/1000)
-            html_time_start = ( "<a href='https://americanarchive.org/catalog/" +
-                           item_id + "?proxy_start_time=" + time_start_sec + "'>" + 
-                           time_start_str + "</a>" )
-        else:
-            html_time_start = time_start_str
-
-        # top row of each of the item divs
-        html_vis_itemcap = ( '<span class="item-top">' + 
-                             f'<span>{html_time_start}-{time_end_str}: <span class="label">{tf_label}</span></span>' + 
-                             '</span>' )
-        html_aid_itemcap = ( '<span class="item-top">' + 
-                             '<span class="label">extracted text</span>' + 
-                             f'<span class="engage-toggle label clickable" data-rid="{edit_row_id}">&nbsp; &#9703; </span>' + 
-                             '</span>' )
-        html_edt_itemcap = ( '<span class="item-top">' + 
-                             '<span class="label">catalog data</span>' + 
-                             '<span class="label invisible">&nbsp; &#9703; </span>' + 
-                             '</span>' )
-
-        # the image and stuff about it
-        html_img_tag = f'<img data-rid="{edit_row_id}" src="data:image/jpeg;base64,{f["img_str"]}" >'
-        #html_img_tag = f'<img src="https://aapb-aux.s3.amazonaws.com/slates/cpb-aacip-225-10wpzhs0_slate.jpg" >' # TESTING 
-        
-        img_fname = f'{item_id}_{media_length:08}_{tp_time:08}_{video_frame_time:08}' + ".jpg"
-        html_img_fname = f"<span class='img-fname hidden' data-rid='{edit_row_id}'>" + img_fname + "<br></span>"
-        if params["display_image_ms"]:
-            html_img_ms = f"<span class='img-ms'>{tp_time:08} {video_frame_time:08}</span>"
-        else:
-            html_img_ms = f"<span class='img-ms hidden'><br>{tp_time:08} {video_frame_time:08}</span>"
-
-
-        # extracted text
-        if f["text"]:
-            aid_text = f["text"].replace("\\n", "\n")
-
-            # See about restructuring text
-            custom_prompts = None
-            if params["use_ai_helper"] and params["custom_prompt_file"]:
-                if not prompts_dir:
-                    raise ValueError("A `custom_prompt_file` was specified by there is no `prompts_dir`.")
-                else:
-                    prompt_file_path = prompts_dir + "/" + params["custom_prompt_file"]
-                    with open(prompt_file_path, "rb") as tomlfile:
-                        custom_prompts = tomllib.load(tomlfile)
-
-            editor_text = catify_text( aid_text, 
-                                       f["tf_label"], 
-                                       (params["use_ai_helper"] and _GBH_AI_HELPER),
-                                       custom_prompts=custom_prompts )
-        else:
-            aid_text = ""
-            editor_text = ""
-
-        #
-        # Build main block ingredients for itemrow
-        #
-
-        # start of the itemrow div
-        html_itemrow_div_open = f"<div class='{itemrow_div_class}' data-rid='{edit_row_id}' data-label='{tf_label}' data-scenetype='{scenetype}'>"
-
-        # visaid-style div
-        html_itemvis_div = ( f"<div class='{item_div_class}'>" + "\n" +
-                             html_vis_itemcap + "\n" +
-                             html_img_tag + "\n" +
-                             "<div class='img-caption'>" +
-                             html_img_fname + "\n" +
-                             html_img_ms + "\n" + 
-                             "</div>" + "\n" + 
-                             "</div>" + "\n" )
-
-        # extracted text div
-        html_itemaid_div = ( f"<div class='{item_div_class} item-aid' data-scenetype='{scenetype}' data-rid='{edit_row_id}'>" + "\n" +
-                             html_aid_itemcap + "\n" +
-                             f"<pre class='aid-text' data-rid='{edit_row_id}' data-tpid='{tp_id}'>" + "\n" +
-                             aid_text + "\n" +
-                             "</pre>" + "\n" + 
-                             "</div>" + "\n" )
-
-        html_itemedt_div = ( f"<div class='{item_div_class} item-editor' data-tptime='{tp_time}' data-scenetype='{scenetype}' data-rid='{edit_row_id}'>" + "\n" +
-                             html_edt_itemcap + "\n" +
-                             f"<pre class='editor-text' contenteditable='true' data-rid='{edit_row_id}' data-tpid='{tp_id}'>" + "\n" +
-                             editor_text + "\n" +
-                             "</pre>" + "\n" + 
-                             "</div>" + "\n" )
-
-        # full itemrow div
-        html_itemrow = ( html_itemrow_div_open + "\n" +
-                         html_itemvis_div + "\n" +
-                         "<div class='cataid-extra'>" + "\n\n" +
-                         html_itemaid_div + "\n" +
-                         html_itemedt_div + "\n" +
-                         "</div><!-- end of cataid portions-->" + "\n" +
-                         "</div>" + "\n" + 
-                         "<!-- end of itemrow-->" + "\n\n\n" )
-
-        # Add the new divs to the growing HTML
-        cataid_body += html_itemrow
-
-
     # Map values from Python variables into HTML placeholders.
     # (This dictionary provides values for the placeholder fields in the string read
-    # from the HTML structure file.)
+    # from the HTML structure file, except for the main body.)
     html_field_map = {
         "video_identifier": video_identifier,
         "cataid_identifier": cataid_identifier,
@@ -564,21 +362,173 @@ def create_cataid( video_path:str,
         "sample_type_checkboxes": sample_type_checkboxes,
         "cataid_options_str": cataid_options_str,
         "mmif_metadata_str": mmif_metadata_str,
-        "cataid_body": cataid_body,
         "MODULE_VERSION": __version__
     }
-    # Create final HTML string from the structure string and substitution map
-    html_str = structure_str.format_map(html_field_map)
+    # Fill in the parts of the structure before and after the main body
+    html_head, html_tail = create_visaid.split_structure( structure_str, "cataid_body" )
+    html_head = html_head.format_map(html_field_map)
+    html_tail = html_tail.format_map(html_field_map)
 
-    # Write output to stdout or to a file
     if stdout:
-        print(html_str)
         hfilename = None
         hfilepath = None
     else:
         hfilepath = output_dirname + "/" + hfilename
-        with open(hfilepath, "w") as html_file:
-            html_file.write(html_str)
+
+    # Write the HTML to stdout or to a file, streaming the main body of the cataid
+    # (the collection of cataid scenes, KIE, and annotation, which is the bulk of it)
+    # one item at a time
+    with create_visaid.html_writer(hfilepath) as html_file:
+        html_file.write(html_head)
+        if len(tfsdi) == 0:
+            html_file.write("<div class=''>(No annotated scenes.)</div>")
+
+        # Create new item divs for each row in tfsdi
+        for ri, (f, video_frame_time, img_str) in enumerate(tfsdi):
+
+            # `tf_label` is the displayed label, the value of `data-label`
+            tf_label = f["tf_label"]
+            tp_id = f["tp_id"]
+            tp_time = f["tp_time"]
+            edit_row_id = str(ri)
+
+            # information to keep at the top itemrow-level div
+            itemrow_div_class = "itemrow" 
+            item_div_class = "item"
+
+            # Set some values used for logic.
+            # `scenetype` means the `tf_label` without the subsample suffix
+            if tf_label.find(" - - -") != -1:
+                item_div_class += " subsample"
+                scenetype = tf_label[:tf_label.find(" - - -")]
+            elif tf_label.find("unlabeled sample") != -1:
+                item_div_class += " unsample"
+                scenetype = tf_label
+            else:
+                item_div_class = item_div_class
+                scenetype = tf_label
+
+            #
+            # Build some strings as inline ingredients
+            #
+
+            # Human-readable time span for the item
+            time_start_str = lilhelp.tconv(f["start"], False)
+            time_end_str = lilhelp.tconv(f["end"], False) 
+
+            # human-readable time span for the item
+            time_start_str = lilhelp.tconv(f["start"], False)
+            time_end_str = lilhelp.tconv(f["end"], False) 
+
+            # Hyperlinked start time
+            if params["aapb_timecode_link"] and item_id:
+                # creating a link to the AAPB
+                time_start_sec = str(f["start"]/1000)
+                html_time_start = ( "<a href='https://americanarchive.org/catalog/" +
+                               item_id + "?proxy_start_time=" + time_start_sec + "'>" + 
+                               time_start_str + "</a>" )
+            else:
+                html_time_start = time_start_str
+
+            # top row of each of the item divs
+            html_vis_itemcap = ( '<span class="item-top">' + 
+                                 f'<span>{html_time_start}-{time_end_str}: <span class="label">{tf_label}</span></span>' + 
+                                 '</span>' )
+            html_aid_itemcap = ( '<span class="item-top">' + 
+                                 '<span class="label">extracted text</span>' + 
+                                 f'<span class="engage-toggle label clickable" data-rid="{edit_row_id}">&nbsp; &#9703; </span>' + 
+                                 '</span>' )
+            html_edt_itemcap = ( '<span class="item-top">' + 
+                                 '<span class="label">catalog data</span>' + 
+                                 '<span class="label invisible">&nbsp; &#9703; </span>' + 
+                                 '</span>' )
+
+            # the image and stuff about it
+            img_mime, img_ext = lilhelp.image_type( base64.b64decode(img_str[:24]) )
+            img_fname = f'{item_id}_{media_length:08}_{tp_time:08}_{video_frame_time:08}' + "." + img_ext
+            if image_dirname:
+                img_src = create_visaid.write_sidecar_image( base64.b64decode(img_str), img_fname, 
+                                                             output_dirname, image_dirname )
+            else:
+                img_src = f"data:{img_mime};base64,{img_str}"
+            html_img_tag = f'<img data-rid="{edit_row_id}" src="{img_src}" >'
+            #html_img_tag = f'<img src="https://aapb-aux.s3.amazonaws.com/slates/cpb-aacip-225-10wpzhs0_slate.jpg" >' # TESTING 
+        
+            html_img_fname = f"<span class='img-fname hidden' data-rid='{edit_row_id}'>" + img_fname + "<br></span>"
+            if params["display_image_ms"]:
+                html_img_ms = f"<span class='img-ms'>{tp_time:08} {video_frame_time:08}</span>"
+            else:
+                html_img_ms = f"<span class='img-ms hidden'><br>{tp_time:08} {video_frame_time:08}</span>"
+
+
+            # extracted text
+            if f["text"]:
+                aid_text = f["text"].replace("\\n", "\n")
+
+                # See about restructuring text
+                custom_prompts = None
+                if params["use_ai_helper"] and params["custom_prompt_file"]:
+                    if not prompts_dir:
+                        raise ValueError("A `custom_prompt_file` was specified by there is no `prompts_dir`.")
+                    else:
+                        prompt_file_path = prompts_dir + "/" + params["custom_prompt_file"]
+                        with open(prompt_file_path, "rb") as tomlfile:
+                            custom_prompts = tomllib.load(tomlfile)
+
+                editor_text = catify_text( aid_text, 
+                                           f["tf_label"], 
+                                           (params["use_ai_helper"] and _GBH_AI_HELPER),
+                                           custom_prompts=custom_prompts )
+            else:
+                aid_text = ""
+                editor_text = ""
+
+            #
+            # Build main block ingredients for itemrow
+            #
+
+            # start of the itemrow div
+            html_itemrow_div_open = f"<div class='{itemrow_div_class}' data-rid='{edit_row_id}' data-label='{tf_label}' data-scenetype='{scenetype}'>"
+
+            # visaid-style div
+            html_itemvis_div = ( f"<div class='{item_div_class}'>" + "\n" +
+                                 html_vis_itemcap + "\n" +
+                                 html_img_tag + "\n" +
+                                 "<div class='img-caption'>" +
+                                 html_img_fname + "\n" +
+                                 html_img_ms + "\n" + 
+                                 "</div>" + "\n" + 
+                                 "</div>" + "\n" )
+
+            # extracted text div
+            html_itemaid_div = ( f"<div class='{item_div_class} item-aid' data-scenetype='{scenetype}' data-rid='{edit_row_id}'>" + "\n" +
+                                 html_aid_itemcap + "\n" +
+                                 f"<pre class='aid-text' data-rid='{edit_row_id}' data-tpid='{tp_id}'>" + "\n" +
+                                 aid_text + "\n" +
+                                 "</pre>" + "\n" + 
+                                 "</div>" + "\n" )
+
+            html_itemedt_div = ( f"<div class='{item_div_class} item-editor' data-tptime='{tp_time}' data-scenetype='{scenetype}' data-rid='{edit_row_id}'>" + "\n" +
+                                 html_edt_itemcap + "\n" +
+                                 f"<pre class='editor-text' contenteditable='true' data-rid='{edit_row_id}' data-tpid='{tp_id}'>" + "\n" +
+                                 editor_text + "\n" +
+                                 "</pre>" + "\n" + 
+                                 "</div>" + "\n" )
+
+            # full itemrow div
+            html_itemrow = ( html_itemrow_div_open + "\n" +
+                             html_itemvis_div + "\n" +
+                             "<div class='cataid-extra'>" + "\n\n" +
+                             html_itemaid_div + "\n" +
+                             html_itemedt_div + "\n" +
+                             "</div><!-- end of cataid portions-->" + "\n" +
+                             "</div>" + "\n" + 
+                             "<!-- end of itemrow-->" + "\n\n\n" )
+
+            # Write the new divs
+            html_file.write(html_itemrow)
+
+        html_file.write(html_tail)
     
     return hfilepath, problems, infos, extras
    
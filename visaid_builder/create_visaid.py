@@ -4,26 +4,45 @@ create_visaid.py
 Defines a function for creating a visaid from a list of scene TimeFrames.
 
 The main required parameters are the path to the video file and a table
-(list of lists) in the style of the `tfs` tables created by the proc_swt module.
+(list of `Scene` records) in the style of the `tfsd` tables created by the 
+proc_swt module.  (A table in the style of the legacy `tfs` tables may be 
+passed instead.)
 
-This function reads and depends on the display ingredients in these files:
+The stills for the visaid are extracted by `extract_images`, which can also be 
+called separately, so that several visaids can share one pass through the video.
+
+By default, the stills are embedded in the HTML file as base64 data URIs, so that
+the visaid is a single portable file.  With the "image_mode" option set to 
+"sidecar", they are instead saved as image files in a directory next to the HTML
+file (see `write_sidecar_image`), which makes the HTML file much smaller.  With
+"sprite", they are packed into a few large images (see `pack_sprites`), so that
+a visaid served over the web needs only a few requests for its images.
+
+The `create_visaid` function reads and depends on the display ingredients in these files:
    visaid_ingredients/visaid_embedded_logic.js
    visaid_ingredients/visaid_embedded_styles.css
    visaid_ingredients/visaid_structure.html
 """
 
-import os
 import io
-import base64
+import os
+import sys
 import json
+import contextlib
+import base64
+import hashlib
 import logging
+import urllib.parse
 
-import av
 
 from importlib.metadata import version
 
+from PIL import Image
+
 __version__ = version("visaid_builder")
 from . import lilhelp
+from . import proc_swt
+from . import frame_plan
 
 VISAID_DEFAULTS = { "deselected_scene_types": ["filmed text"],
                     "job_id_in_visaid_filename": False,
@@ -31,10 +50,41 @@ VISAID_DEFAULTS = { "deselected_scene_types": ["filmed text"],
                     "display_job_info": True,
                     "display_image_ms": True,
                     "aapb_timecode_link": False,
-                    "max_img_height": 360 }
+                    "max_img_height": 360,
+                    "interpolation": "bilinear",
+                    "img_encoder": "pillow",
+                    "extract_strategy": "auto",
+                    "skip_frames": "nonkey",
+                    "skip_window": 1000,
+                    "decode_thread_type": "auto",
+                    "decode_threads": 0,
+                    "decode_workers": 1,
+                    "encode_threads": 4,
+                    "lowres_decode": False,
+                    "preview": False,
+                    "preview_tolerance": 2000,
+                    "image_mode": "inline",
+                    "img_format": "JPEG",
+                    "img_profile": "standard",
+                    "img_budget_kb": None,
+                    "max_img_kb": None }
 
 STRETCH_THRESHOLD = 0.005
 
+# Ways of including stills in the HTML file
+#   "inline"  - embedded as base64 data URIs (a single, self-contained file)
+#   "sidecar" - saved as image files in a directory next to the HTML file (named
+#               for it; see `sidecar_dirname`), and referenced by relative URL
+#   "sprite"  - packed into sprite sheets, saved in the same directory, with each
+#               item showing its part of a sheet (see `pack_sprites`)
+# (When the HTML is written to stdout, stills are inline, and sprite sheets are
+# embedded as data URIs.)
+IMAGE_MODES = ["inline", "sidecar", "sprite"]
+
+# Layout of sprite sheets:  stills per row, and stills per sheet
+SPRITE_COLUMNS = 8
+SPRITE_MAX_ITEMS = 64
+
 # These are scene types (optionally) created by `proc_swt`, not defined by the 
 # SWT bins.  They are displayed in a different area of the page layout.
 SPECIAL_SCENE_TYPES = [ "first frame checked", 
@@ -43,7 +93,7 @@ SPECIAL_SCENE_TYPES = [ "first frame checked",
 
 
 def create_visaid( video_path:str, 
-                   tfs:list,
+                   tfs:list = None,
                    stdout:bool = False,
                    output_dirname:str = ".",
                    hfilename:str = "",
@@ -53,14 +103,29 @@ def create_visaid( video_path:str,
                    item_name:str = "",
                    proc_swt_params:dict = {},
                    visaid_params:dict = {},
-                   mmif_metadata_str: str = ""
+                   mmif_metadata_str: str = "",
+                   tfsd:list = None,
+                   stills:tuple = None,
+                   thumb_cache_dir:str = None,
+                   index_dir:str = None,
+                   index_next_to_media:bool = False
                    ):                  
     """
     Creates an HTML file (with embedded images) as a visual aid, based on MMIF file
-    processed into the tfs structure.
-
+    processed into the tfsd structure (or the legacy tfs structure).
+
+    If `stills` is passed, it should be the return value of `extract_images` for 
+    (at least) the rep times in `tfsd` and the "max_img_height" in `visaid_params`.
+    Then the video is not decoded again.  (This allows several visaids to be made
+    from one pass through the video.)  Otherwise, stills are extracted, using the
+    thumbnail cache in `thumb_cache_dir` (if given), and saving the media index
+    as `index_dir` and `index_next_to_media` say (see `extract_images`).
     """
 
+    # Accept legacy tfs tables
+    if tfsd is None:
+        tfsd = [ proc_swt.Scene.from_tfs_row(row) for row in tfs ]
+
     problems = []
     infos = []
     extras = {}
@@ -92,6 +157,17 @@ def create_visaid( video_path:str,
             suffix = ""
         hfilename = prefix + "visaid" + suffix + ".html"
 
+    # Set up the directory for sidecar image files, if needed
+    if params["image_mode"] not in IMAGE_MODES:
+        raise ValueError(f'Invalid image mode: {params["image_mode"]}')
+    image_dirname = None
+    if params["image_mode"] == "sprite" and params["max_img_kb"]:
+        # (Sprite sheets hold many stills, so there is no one file per still to cap.)
+        raise ValueError("The max_img_kb option does not apply in sprite image mode.  Use img_budget_kb.")
+    if params["image_mode"] in ("sidecar", "sprite") and not stdout:
+        image_dirname = sidecar_dirname(hfilename)
+        os.makedirs(output_dirname + "/" + image_dirname, exist_ok=True)
+
     # Construct video name/identifier string to display in visaid
     video_fname = video_path[video_path.rfind("/")+1:]
     if item_name:
@@ -102,137 +178,66 @@ def create_visaid( video_path:str,
         video_identifier = video_fname
 
     # 
-    # Begin analyzing video in terms of tfs table
+    # Get stills for the scenes in the tfsd table (unless they were passed in)
     #
+    img_format, img_quality = img_settings( params["img_format"], params["img_profile"], stdout )
+    if stills is None:
+        stills = extract_images( video_path, 
+                                 [ f["tp_time"] for f in tfsd ],
+                                 [ params["max_img_height"] ],
+                                 stdout=stdout,
+                                 img_format=img_format,
+                                 img_quality=img_quality,
+                                 strategy=params["extract_strategy"],
+                                 skip_frames=params["skip_frames"],
+                                 skip_window=params["skip_window"],
+                                 thread_type=params["decode_thread_type"],
+                                 thread_count=params["decode_threads"],
+                                 workers=params["decode_workers"],
+                                 encode_threads=params["encode_threads"],
+                                 cache_dir=thumb_cache_dir,
+                                 index_dir=index_dir,
+                                 index_next_to_media=index_next_to_media,
+                                 interpolation=params["interpolation"],
+                                 encoder=params["img_encoder"],
+                                 lowres=params["lowres_decode"],
+                                 preview_tolerance=(params["preview_tolerance"] if params["preview"] else None) )
+    images, stills_problems, stills_infos, stills_extras = stills
+    problems += [ p for p in stills_problems if p not in problems ]
+    infos += stills_infos
+    extras.update(stills_extras)
+    media_length = extras["media_length"]
+
+    # In preview mode, note which stills are keyframes near (but not necessarily
+    # at or after) their rep times, and report how many there were.
+    # (The stills may have been extracted for more rep times than are in `tfsd`.)
+    keyframe_times = set()
+    if params["preview"] and "preview" in extras:
+        tp_times = set( f["tp_time"] for f in tfsd )
+        keyframe_times = tp_times.intersection( extras["preview"]["keyframe_times"] )
+        preview = { "tolerance": extras["preview"]["tolerance"],
+                    "within_tolerance": len(keyframe_times),
+                    "fallback": len(tp_times) - len(keyframe_times) }
+        extras["preview"] = preview
+        if not stdout:
+            logging.info(f'Preview: {preview["within_tolerance"]} stills from keyframes within {preview["tolerance"]} ms; {preview["fallback"]} from exact frames.')
 
-    # find the first video stream
-    container = av.open(video_path)
-    video_stream = next((s for s in container.streams if s.type == 'video'), None)
-    if video_stream is None:
-        raise Exception("No video stream found in {}".format(video_path) ) 
-
-    # get technical stats on the video stream; assumes FPS is constant
-    fps = video_stream.average_rate.numerator / video_stream.average_rate.denominator
-    extras["fps"] = float(f"{fps:.2f}")
-
-    # determine whether anamorphic stills will need to be stretched
-    if video_stream.sample_aspect_ratio is not None:
-        sar = float(video_stream.sample_aspect_ratio)
-        extras["sar"] = float(f"{sar:.3f}")
-    else:
-        # If SAR cannot be determined, assume it is 1 for present purposes
-        sar = 1.0
-        # But report it as None
-        extras["sar"] = None
+    # List of (scene, actual frame time, base64 image data) tuples. 
+    # Refers to the rows of the tfsd table, rather than copying them.
+    # (Scenes whose rep time is beyond the last frame of the video have no still.)
+    imgs = images[params["max_img_height"]]
+    tfsi = [ (f, *imgs[f["tp_time"]]) 
+             for f in sorted(tfsd, key=lambda f:f["tp_time"]) 
+             if f["tp_time"] in imgs ]
 
-    if abs( 1 - sar ) > STRETCH_THRESHOLD:
-        stretch = True
-        if not stdout:
-            logging.info(f'Sample aspect ratio: {sar:.3f}. Will stretch anamorphic frames.')
-        infos.append(f'SAR-{sar:.3f}')
-    else:
-        stretch = False
-
-    # calculate duration in ms
-    media_length = int((video_stream.frames / fps) * 1000)
-    extras["media_length"] = media_length
-
-    # Table like tfs, but with an extra columns. 
-    # Uses rows from the tfs table, but adds additional columns for actual frame 
-    # time and base64 image data.
-
-    tfsi = []
-
-    # Build up tfsi table by adding rows based on tfs rows.
-    if len(tfs) > 0:
-
-        # Create a new list sorted in order of rep frame times .
-        # Because we need to proceed in order of video frames to be extracted
-        # (not necessarily the order of the scene start times).
-        tfs_s = sorted(tfs, key=lambda f:f[4])
-
-        # initialize target scene and still 
-        next_scene = 0 
-        target_time = tfs_s[next_scene][4]
-        last_packet_error = 0
-      
-        # looping through packets instead of frames allows exception handling for each
-        # particular decode step.  This main loop originally iterated over frames in
-        # `container.decode(video_stream)`.
-        for packet in container.demux(video_stream):
-            try:
-                for frame in packet.decode():
-                    ftime = int(frame.time * 1000)   
-
-                    # Look for the frame nearest to the target.
-                    # (Using `while` instead of `if` to loop through multiple rows
-                    #  in case multiple rows tareget the same frame (which is
-                    #  possible if scenes overlap).
-                    #while ftime+15 >= target_time :
-                    
-                    # Look for first frame after the target
-                    while ftime >= target_time :
-
-                        # Check for anamorphic and stretch if necessary
-                        if stretch:
-                            if sar > 1.0:
-                                # stretch the width
-                                new_width = int( sar * frame.width)
-                                new_height = frame.height
-                            else:
-                                # stretch the height
-                                new_width = frame.width
-                                new_height = int(frame.height / sar)
-                            stretched_frame = frame.reformat( width=new_width, height=new_height )
-                        else:
-                            stretched_frame = frame
-
-                        # Reduce the size of the image, if necessary
-                        if stretched_frame.height > params["max_img_height"]:
-                            res_factor = params["max_img_height"] / stretched_frame.height 
-                            new_width = int(stretched_frame.width * res_factor)
-                            res_frame = stretched_frame.reformat( width=new_width, height=params["max_img_height"] )
-                        else:
-                            res_frame = stretched_frame
-
-                        # Save frame to memory buffer
-                        buf = io.BytesIO()
-                        res_frame.to_image().save(buf, format="JPEG", quality=75)
-
-                        # convert binary image data to base64 serialized in a UTF-8 string
-                        img_str = base64.b64encode(buf.getvalue()).decode('utf-8')
-
-                        # add new row to tfsi
-                        tfsi.append(tfs_s[next_scene] + [ ftime ] + [ img_str ] )
-                        
-                        next_scene += 1
-                        if next_scene >= len(tfs_s):            
-                            # no need to continue decoding video if we have all our scenes saved
-                            break
-                        else:
-                            target_time = tfs_s[next_scene][4]
-
-            except av.error.InvalidDataError as e:
-                # This exception may get raised many times if there are many packets with problems
-                # However, we'll log only one error per (starting) time stamp of corrupt region.
-                if last_packet_error != ftime:
-                    if not stdout:
-                        logging.warning(f"{video_fname} at {ftime} ms: {e}")
-                    last_packet_error = ftime
-                if "decode" not in problems:
-                    problems.append("decode")
-                continue  # Skip this packet and try the next one
-
-            if next_scene >= len(tfs_s):
-                # no need to continue decoding video if we have all our scenes saved
-                break
-
-    # Done with the video media itself
-    container.close()
-
-    # Re-sort new array in terms of scene start time, then by TimeFrame id,
+    # Sort in terms of scene start time, then by TimeFrame id,
     # (so that subsamples come after the scenes from which they've been sampled.)
-    tfsi.sort(key=lambda f:(f[2],f[0]))
+    tfsi.sort(key=lambda f:(f[0]["start"],f[0]["tf_id"]))
+
+    # Re-encode the stills to fit the byte budget, if any
+    # (In sprite mode, the budget applies to the sheets instead.)
+    if params["image_mode"] != "sprite":
+        tfsi = fit_budget( tfsi, params, inline=(image_dirname is None), extras=extras, stdout=stdout )
 
     # Get ingredient code strings for inclusion in HTML files
     py_dir = os.path.dirname(__file__)
@@ -265,9 +270,9 @@ def create_visaid( video_path:str,
 
     # build up a list scene types, preserving order
     all_scene_types = []
-    for f in tfs:
-        if f[1] not in all_scene_types:
-            all_scene_types.append(f[1])
+    for f in tfsd:
+        if f["tf_label"] not in all_scene_types:
+            all_scene_types.append(f["tf_label"])
 
     subsamples_present = False
     for t in all_scene_types:
@@ -322,68 +327,36 @@ def create_visaid( video_path:str,
     # serialize metadata about process and visaid options
     visaid_options_str = json.dumps( [proc_swt_params,visaid_params], indent=2 )
 
-    # Build HTML strig for main body of visaid -- the collection of visaid scenes
-    # (This is the bulk of the visaid.)
-    visaid_body = ""
-    if len(tfsi) == 0:
-        visaid_body += ("<div class=''>(No annotated scenes.)</div>")
-
-    # Create a new item div for each row in tfsi
-    for f in tfsi:
-        label = f[1]
-        start_str = lilhelp.tconv(f[2], False)
-        end_str = lilhelp.tconv(f[3], False) 
-
-        if params["aapb_timecode_link"] and item_id:
-            # creating a link to the AAPB
-            start_sec = str(f[2]/1000)
-            html_start = ( "<a href='https://americanarchive.org/catalog/" +
-                           item_id + "?proxy_start_time=" + start_sec + "'>" + 
-                           start_str + "</a>" )
-        else:
-            html_start = start_str
-
-        div_class = "item" 
-        if label.find(" - - -") != -1:
-            div_class += " subsample"
-            scenetype = label[:label.find(" - - -")]
-        elif label.find("unlabeled sample") != -1:
-            div_class += " unsample"
-            scenetype = label
-        else:
-            div_class = div_class
-            scenetype = label
-
-        #html_div_open = "<div class='" + div_class + "' data-label='" + label + "'>"
-        html_div_open = f"<div class='{div_class}' data-label='{label}' data-scenetype='{scenetype}'>"
-
-        html_cap = f'<span>{html_start}-{end_str}: </span><span class="label">{label}</span><br>'
-
-        html_img_tag = f'<img src="data:image/jpeg;base64,{f[7]}" >'
-        img_fname = f'{item_id}_{media_length:08}_{f[4]:08}_{f[6]:08}' + ".jpg"
-        html_img_fname = "<span class='img-fname hidden'>" + img_fname + "<br></span>"
-
-        if params["display_image_ms"]:
-            html_img_ms = f"<span class='img-ms'>{f[4]:08} {f[6]:08}</span>"
-        else:
-            html_img_ms = f"<span class='img-ms hidden'><br>{f[4]:08} {f[6]:08}</span>"
-
-        # Add the new div to the growing HTML
-        visaid_body += (html_div_open + 
-                        html_cap + 
-                        html_img_tag + "\n" +
-                        "<div class='img-caption'>" +
-                        html_img_fname +
-                        html_img_ms + 
-                        "</div></div>" + "\n")
-
+    # Pack the stills into sprite sheets, if requested, and make a style element
+    # with a rule for each sheet (or nothing, when there are no sheets)
+    sprite_css = ""
+    # (Sheets are in the format of the stills, and fitted to the byte budget, if any.)
+    if params["image_mode"] == "sprite" and len(tfsi) > 0:
+        stills_data = [ base64.b64decode(img_str) for _, _, img_str in tfsi ]
+        sheet_mime, sheet_ext = lilhelp.image_type(stills_data[0])
+        sheet_format = next( k for k, v in lilhelp.IMG_FORMATS.items() if v[0] == sheet_mime )
+        sheets, sprites = fit_sprite_budget( stills_data, 
+                                             sheet_format, 
+                                             params, 
+                                             inline=(image_dirname is None), 
+                                             extras=extras, 
+                                             stdout=stdout )
+        for sheet_num, sheet_data in enumerate(sheets):
+            sheet_fname = f'{item_id}_{media_length:08}_sprites{sheet_num:03}.{sheet_ext}'
+            if image_dirname:
+                sheet_src = write_sidecar_image( sheet_data, sheet_fname, output_dirname, image_dirname )
+            else:
+                sheet_src = f"data:{sheet_mime};base64," + base64.b64encode(sheet_data).decode('utf-8')
+            sprite_css += f"div.sprite-{sheet_num} {{ background-image: url('{sheet_src}'); }}\n"
+        sprite_css = '<style id="sprite-sheets">\n' + sprite_css + '</style>\n'
 
     # Map values from Python variables into HTML placeholders.
     # (This dictionary provides values for the placeholder fields in the string read
-    # from the HTML structure file.)
+    # from the HTML structure file, except for the main body.)
     html_field_map = {
         "video_identifier": video_identifier,
         "css_str": css_str,
+        "sprite_css": sprite_css,
         "js_str": js_str,
         "job_info": job_info,
         "video_duration": video_duration,
@@ -391,21 +364,438 @@ def create_visaid( video_path:str,
         "sample_type_checkboxes": sample_type_checkboxes,
         "visaid_options_str": visaid_options_str,
         "mmif_metadata_str": mmif_metadata_str,
-        "visaid_body": visaid_body,
         "MODULE_VERSION": __version__
     }
-    # Create final HTML string from the structure string and substitution map
-    html_str = structure_str.format_map(html_field_map)
+    # Fill in the parts of the structure before and after the main body
+    html_head, html_tail = split_structure( structure_str, "visaid_body" )
+    html_head = html_head.format_map(html_field_map)
+    html_tail = html_tail.format_map(html_field_map)
 
-    # Write output to stdout or to a file
     if stdout:
-        print(html_str)
         hfilename = None
         hfilepath = None
     else:
         hfilepath = output_dirname + "/" + hfilename
-        with open(hfilepath, "w") as html_file:
-            html_file.write(html_str)
+
+    # Write the HTML to stdout or to a file, streaming the main body of the visaid
+    # (the collection of visaid scenes, which is the bulk of it) one item at a time
+    with html_writer(hfilepath) as html_file:
+        html_file.write(html_head)
+        if len(tfsi) == 0:
+            html_file.write("<div class=''>(No annotated scenes.)</div>")
+
+        # Create a new item div for each row in tfsi
+        for inum, (f, ftime, img_str) in enumerate(tfsi):
+            label = f["tf_label"]
+            tp_time = f["tp_time"]
+            start_str = lilhelp.tconv(f["start"], False)
+            end_str = lilhelp.tconv(f["end"], False) 
+
+            if params["aapb_timecode_link"] and item_id:
+                # creating a link to the AAPB
+                start_sec = str(f["start"]/1000)
+                html_start = ( "<a href='https://americanarchive.org/catalog/" +
+                               item_id + "?proxy_start_time=" + start_sec + "'>" + 
+                               start_str + "</a>" )
+            else:
+                html_start = start_str
+
+            div_class = "item" 
+            if label.find(" - - -") != -1:
+                div_class += " subsample"
+                scenetype = label[:label.find(" - - -")]
+            elif label.find("unlabeled sample") != -1:
+                div_class += " unsample"
+                scenetype = label
+            else:
+                div_class = div_class
+                scenetype = label
+
+            #html_div_open = "<div class='" + div_class + "' data-label='" + label + "'>"
+            html_div_open = f"<div class='{div_class}' data-label='{label}' data-scenetype='{scenetype}'>"
+
+            html_cap = f'<span>{html_start}-{end_str}: </span><span class="label">{label}</span><br>'
+
+            img_mime, img_ext = lilhelp.image_type( base64.b64decode(img_str[:24]) )
+            img_fname = f'{item_id}_{media_length:08}_{tp_time:08}_{ftime:08}' + "." + img_ext
+            if params["image_mode"] == "sprite":
+                html_img_tag = sprite_tag( *sprites[inum] )
+            else:
+                if image_dirname:
+                    img_src = write_sidecar_image( base64.b64decode(img_str), img_fname, output_dirname, image_dirname )
+                else:
+                    img_src = f"data:{img_mime};base64,{img_str}"
+                html_img_tag = f'<img src="{img_src}" >'
+            html_img_fname = "<span class='img-fname hidden'>" + img_fname + "<br></span>"
+
+            if tp_time in keyframe_times:
+                # mark the actual time of an approximate still
+                ftime_str = f"<span class='keyframe' title='nearest keyframe'>~{ftime:08}</span>"
+            else:
+                ftime_str = f"{ftime:08}"
+
+            if params["display_image_ms"]:
+                html_img_ms = f"<span class='img-ms'>{tp_time:08} {ftime_str}</span>"
+            else:
+                html_img_ms = f"<span class='img-ms hidden'><br>{tp_time:08} {ftime_str}</span>"
+
+            # Write the new div
+            html_file.write(html_div_open + 
+                            html_cap + 
+                            html_img_tag + "\n" +
+                            "<div class='img-caption'>" +
+                            html_img_fname +
+                            html_img_ms + 
+                            "</div></div>" + "\n")
+
+        html_file.write(html_tail)
     
     return hfilepath, problems, infos, extras
    
+
+
+
+def img_settings( img_format:str,
+                  img_profile:str,
+                  stdout:bool = False ) -> tuple:
+    """
+    Returns the (image format, image quality) for stills in the given format (one
+    of `lilhelp.IMG_FORMATS`) and named quality profile (one of 
+    `lilhelp.IMG_PROFILES`).  If the installed Pillow cannot save images in that
+    format, JPEG is used instead.
+    """
+    img_format = img_format.upper()
+    if not lilhelp.img_format_supported(img_format):
+        if not stdout:
+            logging.warning(f"Warning: Image format {img_format} is not supported here. Using JPEG.")
+        img_format = "JPEG"
+    return img_format, lilhelp.img_profile_quality(img_format, img_profile)
+
+
+def fit_budget( tfsi:list,
+                params:dict,
+                inline:bool,
+                extras:dict,
+                stdout:bool = False ) -> list:
+    """
+    Returns a copy of `tfsi` (a list of (scene, actual frame time, base64 image
+    data)), with the stills re-encoded as needed to fit the byte budget in 
+    `params`:  "img_budget_kb" for all the stills together, and "max_img_kb" for
+    each still (see `lilhelp.fit_image_budget`).  If the stills are `inline`,
+    their size counts as embedded in base64.
+
+    Reports the budget and the settings chosen in `extras["img_budget"]`.
+    """
+    if not ( params["img_budget_kb"] or params["max_img_kb"] ) or len(tfsi) == 0:
+        return tfsi
+
+    stills = [ base64.b64decode(img_str) for _, _, img_str in tfsi ]
+    img_mime = lilhelp.image_type(stills[0])[0]
+    img_format = next( k for k, v in lilhelp.IMG_FORMATS.items() if v[0] == img_mime )
+    stills, report = lilhelp.fit_image_budget( 
+        stills,
+        img_format=img_format,
+        img_quality=lilhelp.img_profile_quality(img_format, params["img_profile"]),
+        total_bytes=(params["img_budget_kb"] * 1024 if params["img_budget_kb"] else None),
+        max_img_bytes=(params["max_img_kb"] * 1024 if params["max_img_kb"] else None),
+        overhead=(4/3 if inline else 1.0) )
+
+    extras["img_budget"] = { "img_budget_kb": params["img_budget_kb"],
+                             "max_img_kb": params["max_img_kb"],
+                             "inline": inline,
+                             **report }
+    if not stdout:
+        logging.info(f'Image budget: {report["reencoded"]} stills re-encoded; {report["original_bytes"]} -> {report["final_bytes"]} bytes.')
+        if not report["met"]:
+            logging.warning("Warning: Could not fit the stills in the image byte budget.")
+
+    return [ (f, ftime, base64.b64encode(img_data).decode('utf-8')) 
+             for (f, ftime, _), img_data in zip(tfsi, stills) ]
+
+
+def fit_sprite_budget( stills:list,
+                       img_format:str,
+                       params:dict,
+                       inline:bool,
+                       extras:dict,
+                       stdout:bool = False ) -> tuple:
+    """
+    Packs stills (encoded image data) into sprite sheets (see `pack_sprites`) at 
+    the quality for `params["img_profile"]`, or, if the sheets would not fit in
+    `params["img_budget_kb"]`, at a lower quality and (if need be) a smaller 
+    scale, chosen as in `lilhelp.fit_settings`.  If the sheets are `inline`, their
+    size counts as embedded in base64.
+
+    Reports the budget and the settings chosen in `extras["img_budget"]`, as for
+    `fit_budget`.  Returns the `sheets` and `sprites`, as for `pack_sprites`.
+    """
+    img_quality = lilhelp.img_profile_quality(img_format, params["img_profile"])
+    sheets, sprites = pack_sprites( stills, img_format=img_format, img_quality=img_quality )
+    if not params["img_budget_kb"]:
+        return sheets, sprites
+
+    overhead = 4/3 if inline else 1.0
+    total_bytes = params["img_budget_kb"] * 1024
+    def size( sheets ):
+        return sum( len(s) for s in sheets ) * overhead
+
+    report = { "original_bytes": round(size(sheets)),
+               "quality": None,
+               "scale": None,
+               "sheets": len(sheets) }
+    if size(sheets) > total_bytes:
+        packed = {}
+        def estimate( quality, scale ):
+            if (quality, scale) not in packed:
+                packed[(quality, scale)] = pack_sprites( stills, 
+                                                         img_format=img_format, 
+                                                         img_quality=quality, 
+                                                         scale=scale )
+            return size(packed[(quality, scale)][0])
+        quality, scale = lilhelp.fit_settings( estimate, total_bytes, img_quality )
+        estimate( quality, scale )
+        sheets, sprites = packed[(quality, scale)]
+        report["quality"] = quality
+        report["scale"] = scale
+    report["final_bytes"] = round(size(sheets))
+    report["met"] = size(sheets) <= total_bytes
+
+    extras["img_budget"] = { "img_budget_kb": params["img_budget_kb"],
+                             "max_img_kb": None,
+                             "inline": inline,
+                             **report }
+    if not stdout:
+        logging.info(f'Image budget: {len(sheets)} sprite sheets; {report["original_bytes"]} -> {report["final_bytes"]} bytes.')
+        if not report["met"]:
+            logging.warning("Warning: Could not fit the sprite sheets in the image byte budget.")
+
+    return sheets, sprites
+
+
+def split_structure( structure_str:str,
+                     body_field:str ) -> tuple:
+    """
+    Splits an HTML structure string (with placeholder fields, as for `format_map`)
+    at the placeholder for the main body, `body_field`, and returns the parts 
+    before and after it.  (Each part can then be filled in separately, and the 
+    body streamed between them.)
+    """
+    head, found, tail = structure_str.partition( "{" + body_field + "}" )
+    if not found:
+        raise ValueError(f"No {{{body_field}}} placeholder in HTML structure.")
+    return head, tail
+
+
+@contextlib.contextmanager
+def html_writer( hfilepath:str = None ):
+    """
+    Context manager for writing HTML to a file, or to stdout if `hfilepath` is 
+    None.  A file is written under a temporary name, and only takes its own name
+    when the writing is done (so a failure never leaves a partial file).
+    """
+    if hfilepath is None:
+        yield sys.stdout
+        # (ending with a newline, as `print` would)
+        sys.stdout.write("\n")
+        return
+    tmp_path = hfilepath + ".tmp"
+    try:
+        with open(tmp_path, "w") as html_file:
+            yield html_file
+        os.replace(tmp_path, hfilepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def sidecar_dirname( hfilename:str ) -> str:
+    """
+    Returns the name of the directory for the sidecar image files of an HTML file
+    """
+    return os.path.splitext(hfilename)[0] + "_files"
+
+
+def write_sidecar_image( img_data:bytes,
+                         img_fname:str,
+                         output_dirname:str,
+                         image_dirname:str ) -> str:
+    """
+    Saves an image (a still or a sprite sheet) in the directory `image_dirname`
+    (within `output_dirname`), and returns its URL relative to `output_dirname`.
+
+    The file is named for its contents:  `img_fname` with a hash of the image data
+    added.  So an image that is already there (e.g., from an earlier run) is not
+    written again, and a changed image never has the name of an old one.
+    """
+    stem, ext = os.path.splitext(img_fname)
+    name = f"{stem}_{hashlib.sha1(img_data).hexdigest()[:12]}{ext}"
+    img_path = output_dirname + "/" + image_dirname + "/" + name
+    if not os.path.exists(img_path):
+        with open(img_path + ".tmp", "wb") as img_file:
+            img_file.write(img_data)
+        os.replace(img_path + ".tmp", img_path)
+    return urllib.parse.quote(image_dirname + "/" + name)
+
+
+def pack_sprites( stills:list,
+                  columns:int = SPRITE_COLUMNS,
+                  max_items:int = SPRITE_MAX_ITEMS,
+                  img_format:str = "JPEG",
+                  img_quality:int = 75,
+                  scale:float = 1.0 ) -> tuple:
+    """
+    Packs stills (encoded image data) into sprite sheets, in order, with up to
+    `max_items` stills per sheet, in rows of up to `columns` stills.  Stills are
+    scaled by `scale` first.
+
+    Returns a tuple of
+      `sheets` - list of the image data for each sheet (in the given format)
+      `sprites` - list, with an item for each still, of (sheet number, x, y, 
+      width, height, sheet width, sheet height), giving where the still is in 
+      its sheet
+    """
+    sheets = []
+    sprites = []
+    for first in range(0, len(stills), max_items):
+        images = [ Image.open(io.BytesIO(img_data)) for img_data in stills[first:first+max_items] ]
+        if scale < 1.0:
+            images = [ image.resize( ( max(1, round(image.width * scale)),
+                                       max(1, round(image.height * scale)) ),
+                                     Image.BILINEAR )
+                       for image in images ]
+
+        # Lay out the rows, each as tall as its tallest still
+        places = []
+        sheet_width = sheet_height = 0
+        for row_start in range(0, len(images), columns):
+            row = images[row_start:row_start+columns]
+            x = 0
+            for image in row:
+                places.append( (x, sheet_height) )
+                x += image.width
+            sheet_width = max( sheet_width, x )
+            sheet_height += max( image.height for image in row )
+
+        sheet = Image.new("RGB", (sheet_width, sheet_height))
+        for image, (x, y) in zip(images, places):
+            sheet.paste( image, (x, y) )
+            sprites.append( (len(sheets), x, y, image.width, image.height, sheet_width, sheet_height) )
+
+        buffer = io.BytesIO()
+        sheet.save( buffer, 
+                    format=img_format, 
+                    quality=img_quality, 
+                    **lilhelp.IMG_SAVE_OPTIONS.get(img_format, {}) )
+        sheets.append(buffer.getvalue())
+
+    return sheets, sprites
+
+
+def sprite_tag( sheet_num:int,
+                x:int,
+                y:int,
+                width:int,
+                height:int,
+                sheet_width:int,
+                sheet_height:int ) -> str:
+    """
+    Returns the HTML for an element showing a still from a sprite sheet (as placed
+    by `pack_sprites`).  The sheet is scaled along with the element, so the still
+    can be displayed at any size.
+    """
+    # (Percentage positions align that fraction of the sheet with the same
+    # fraction of the element.)
+    pos_x = 100 * x / (sheet_width - width) if sheet_width > width else 0
+    pos_y = 100 * y / (sheet_height - height) if sheet_height > height else 0
+    style = ( f"aspect-ratio: {width} / {height}; "
+              f"background-size: {100 * sheet_width / width:.4f}% {100 * sheet_height / height:.4f}%; "
+              f"background-position: {pos_x:.4f}% {pos_y:.4f}%;" )
+    return ( f'<div class="sprite sprite-{sheet_num}" role="img" '
+             f'data-sprite="{sheet_num}" data-x="{x}" data-y="{y}" data-w="{width}" data-h="{height}" '
+             f'style="{style}"></div>' )
+
+
+def extract_images( video_path:str,
+                    target_times:list,
+                    img_heights:list = [ VISAID_DEFAULTS["max_img_height"] ],
+                    stdout:bool = False,
+                    strategy:str = "auto",
+                    stretch_threshold:float = STRETCH_THRESHOLD,
+                    skip_frames:str = "none",
+                    skip_window:int = lilhelp.SKIP_WINDOW,
+                    preview_tolerance:int = None,
+                    thread_type:str = lilhelp.DECODE_THREAD_TYPE,
+                    thread_count:int = lilhelp.DECODE_THREADS,
+                    workers:int = 1,
+                    encode_threads:int = lilhelp.ENCODE_THREADS,
+                    cache_dir:str = None,
+                    index_dir:str = None,
+                    index_next_to_media:bool = False,
+                    interpolation:str = lilhelp.INTERPOLATION,
+                    encoder:str = lilhelp.ENCODER,
+                    lowres:bool = False,
+                    img_format:str = "JPEG",
+                    img_quality:int = 75 ):
+    """
+    Decodes the video once and extracts a still for each target time, as the first
+    frame at or after that time.  Each still is saved as a base64 image string (in
+    the given format and quality; see `img_settings`) at each of the maximum image
+    heights in `img_heights`.  (See `frame_plan` for
+    extracting stills for several artifacts at once.)
+
+    `strategy` says how to get to the frames (see `lilhelp.EXTRACT_STRATEGIES`),
+    and `skip_frames` and `skip_window` say which frames the decoder may skip on 
+    the way (see `lilhelp.iter_target_frames`).
+    If `preview_tolerance` is not None, each still is instead the nearest keyframe
+    within that many ms of the target, when there is one (see `frame_plan`).
+    `thread_type` and `thread_count` configure multi-threaded decoding (see 
+    `lilhelp.set_decode_threads`), and `workers` is the number of processes to
+    split the decoding among (see `frame_plan.FramePlan.run`).  Stills are 
+    encoded on `encode_threads` threads while decoding continues.
+    If `cache_dir` is given, stills are reused from (and saved to) the thumbnail
+    cache there (see `thumb_cache`).  The media index is saved in `index_dir` (or
+    else with the thumbnail cache, or else next to the video if
+    `index_next_to_media`), so that later runs need not build it again (see
+    `media_index.get_index`).
+    Stills are stretched if the sample aspect ratio differs from 1 by more than
+    `stretch_threshold`, and scaled (in one pass) with the given interpolation 
+    method (see `lilhelp.INTERPOLATIONS`), and encoded with `encoder` (see
+    `lilhelp.ENCODERS`).
+    If `lowres` is True, frames are decoded at reduced resolution when the codec
+    allows and the stills are small enough (see `frame_plan.FramePlan.run`).
+
+    Returns a tuple of
+      `images` - dictionary keyed by image height, of dictionaries keyed by 
+      target time, with values (actual frame time, base64 image data)
+      `problems`, `infos`, `extras` - as for `create_visaid`
+    """
+
+    # One request per image height.  (The video is still decoded only once.)
+    plan = frame_plan.FramePlan( video_path, 
+                                 stdout=stdout, 
+                                 cache_dir=cache_dir,
+                                 index_dir=index_dir,
+                                 index_next_to_media=index_next_to_media )
+    for max_img_height in img_heights:
+        plan.request( max_img_height, 
+                      target_times, 
+                      stretch_threshold=stretch_threshold,
+                      max_img_height=max_img_height,
+                      img_format=img_format,
+                      img_quality=img_quality,
+                      preview_tolerance=preview_tolerance,
+                      interpolation=interpolation,
+                      encoder=encoder )
+    plan.run( strategy=strategy, 
+              skip_frames=skip_frames, 
+              skip_window=skip_window,
+              thread_type=thread_type,
+              thread_count=thread_count,
+              workers=workers,
+              encode_threads=encode_threads,
+              lowres=lowres )
+
+    images = { h: plan.stills_b64(h) for h in img_heights }
+    _, problems, infos, extras = plan.stills(img_heights[0])
+
+    return images, problems, infos, extras
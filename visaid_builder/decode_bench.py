@@ -0,0 +1,264 @@
+"""
+decode_bench.py
+
+Measures decoding throughput for video files under different decode threading
+configurations (see `lilhelp.set_decode_threads`), to help choose the
+"decode_thread_type" and "decode_threads" options for a machine and its sources.
+
+Usage:
+    python -m visaid_builder.decode_bench VIDEO [VIDEO ...] [-t TYPE ...] [-n COUNT ...] [-l FACTOR ...]
+    python -m visaid_builder.decode_bench [VIDEO ...] --scaler [-i INTERPOLATION ...] [--heights HEIGHT ...]
+
+For each video, each thread type, and each thread count, decodes the first
+`--seconds` seconds of video (every frame) and reports frames decoded per second.
+With `--lowres`, the full-resolution baseline is also decoded at each reduced
+resolution factor (see `lilhelp.set_lowres`), for codecs that allow it.
+
+With `--scaler`, instead measures the time to prepare stills from decoded frames
+(stretched for the sample aspect ratio and scaled to each of `--heights`, then
+converted to a PIL image), comparing the former two-pass scaling (see
+`two_pass_image`) with the single pass of `lilhelp.frame_to_image`, for each
+interpolation method.  If no video is given, a synthetic anamorphic clip (720x480
+MPEG-2 with a sample aspect ratio of 8:9, as for 480i) is used.
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from fractions import Fraction
+
+import av
+from PIL import Image, ImageDraw
+
+from . import lilhelp
+
+
+def bench_decode( video_path:str,
+                  thread_type:str = lilhelp.DECODE_THREAD_TYPE,
+                  thread_count:int = lilhelp.DECODE_THREADS,
+                  max_seconds:float = 60,
+                  lowres:int = 0 ) -> dict:
+    """
+    Decodes every frame of the first `max_seconds` of the video with the given
+    threading configuration (at reduced resolution, if `lowres` is more than 0).
+
+    Returns a dictionary with the number of frames decoded, the elapsed time (s),
+    and the frames decoded per second.
+    """
+    with av.open(video_path) as container:
+        video_stream = container.streams.video[0]
+        lilhelp.set_decode_threads(video_stream, thread_type, thread_count)
+        lilhelp.set_lowres(video_stream, lowres)
+
+        frames = 0
+        start = time.perf_counter()
+        for frame in container.decode(video_stream):
+            frames += 1
+            if frame.time is not None and frame.time >= max_seconds:
+                break
+        elapsed = time.perf_counter() - start
+
+    return { "frames": frames,
+             "seconds": elapsed,
+             "fps": frames / elapsed if elapsed > 0 else 0.0 }
+
+
+def synthetic_clip( video_path:str,
+                    seconds:float = 4,
+                    width:int = 720,
+                    height:int = 480,
+                    sar:Fraction = Fraction(8, 9),
+                    codec:str = "mpeg2video" ):
+    """
+    Writes a synthetic clip (at 30000/1001 fps) with the given frame size and
+    sample aspect ratio, with detail for the scaler to work on
+    """
+    with av.open(video_path, "w") as container:
+        stream = container.add_stream(codec, rate=Fraction(30000, 1001))
+        stream.width = width
+        stream.height = height
+        stream.pix_fmt = "yuv420p"
+        stream.codec_context.sample_aspect_ratio = sar
+        for fnum in range( int(seconds * 30) ):
+            image = Image.effect_noise( (width, height), 30 ).convert("RGB")
+            draw = ImageDraw.Draw(image)
+            for k in range(0, width, 24):
+                draw.line( ( (k + fnum * 4) % width, 0, (k * 3 + fnum * 4) % width, height ), 
+                           fill=( k % 256, 255 - k % 256, 128 ), width=2 )
+            draw.rectangle( ( 40, 40, 300, 120 ), fill=(20, 20, 20) )
+            draw.text( ( 60, 70 ), f"SLATE {fnum}", fill=(255, 255, 255) )
+            for packet in stream.encode( av.VideoFrame.from_image(image) ):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+
+def two_pass_image( frame,
+                    sar:float,
+                    max_img_height:int,
+                    interpolation:str = lilhelp.INTERPOLATION,
+                    stretch_threshold:float = lilhelp.STRETCH_THRESHOLD ):
+    """
+    Returns a PIL image of the frame as stills were prepared before
+    `lilhelp.frame_to_image`:  stretched for the sample aspect ratio in one 
+    scaler pass, and then scaled down to `max_img_height` in another.
+    """
+    interpolation = interpolation.upper()
+    stretched_frame = frame
+    if abs( 1 - sar ) > stretch_threshold:
+        if sar > 1.0:
+            new_width, new_height = int( sar * frame.width ), frame.height
+        else:
+            new_width, new_height = frame.width, int( frame.height / sar )
+        stretched_frame = frame.reformat( width=new_width, height=new_height, interpolation=interpolation )
+
+    res_frame = stretched_frame
+    if max_img_height is not None and stretched_frame.height > max_img_height:
+        res_factor = max_img_height / stretched_frame.height
+        new_width = int( stretched_frame.width * res_factor )
+        res_frame = stretched_frame.reformat( width=new_width, height=max_img_height, interpolation=interpolation )
+    return res_frame.to_image()
+
+
+def bench_scaler( video_path:str,
+                  max_img_height:int,
+                  interpolation:str = lilhelp.INTERPOLATION,
+                  num_frames:int = 60,
+                  repeats:int = 5 ) -> dict:
+    """
+    Decodes the first `num_frames` frames of the video, and times preparing a
+    still of each (see `two_pass_image` and `lilhelp.frame_to_image`), taking the
+    best of `repeats` runs for each method.  (The runs of the two methods take
+    turns, so that both see the same conditions.)
+
+    Returns a dictionary with the still size, the number of scaler passes in the
+    two-pass method (1 if the still is only stretched, not scaled down), and the
+    time (ms) per frame for the two-pass and the single-pass ("fused") scaling.
+    """
+    with av.open(video_path) as container:
+        video_stream = container.streams.video[0]
+        sar = float(video_stream.sample_aspect_ratio or 1)
+        frames = []
+        for frame in container.decode(video_stream):
+            frames.append(frame)
+            if len(frames) >= num_frames:
+                break
+
+    width, height = lilhelp.still_geometry( frames[0].width, 
+                                            frames[0].height, 
+                                            sar, 
+                                            max_img_height=max_img_height )
+    _, stretched_height = lilhelp.still_geometry( frames[0].width, frames[0].height, sar )
+    passes = int( abs( 1 - sar ) > lilhelp.STRETCH_THRESHOLD ) + int( height < stretched_height )
+
+    methods = { "two_pass": lambda f: two_pass_image( f, sar, max_img_height, interpolation ),
+                "fused": lambda f: lilhelp.frame_to_image( f, width, height, interpolation ) }
+    best = {}
+    for _ in range(repeats):
+        for name, prepare in methods.items():
+            start = time.perf_counter()
+            for frame in frames:
+                prepare(frame)
+            elapsed = time.perf_counter() - start
+            best[name] = min( best.get(name, elapsed), elapsed )
+    two_pass_ms = best["two_pass"] * 1000 / len(frames)
+    fused_ms = best["fused"] * 1000 / len(frames)
+
+    return { "frame_size": ( frames[0].width, frames[0].height ),
+             "sar": sar,
+             "still_size": ( width, height ),
+             "two_pass_passes": passes,
+             "two_pass_ms": two_pass_ms,
+             "fused_ms": fused_ms }
+
+
+def main_scaler( args ):
+    """
+    Runs the scaler comparison (for `--scaler`)
+    """
+    tmp_dir = None
+    video_paths = args.video_paths
+    if not video_paths:
+        tmp_dir = tempfile.mkdtemp(prefix="decode_bench_")
+        video_paths = [ os.path.join(tmp_dir, "synthetic_480i.mpg") ]
+        synthetic_clip( video_paths[0] )
+
+    print(f"{'video':30} {'frame':>9} {'SAR':>5} {'still':>9} {'interpolation':13} {'passes':>6} "
+          f"{'two-pass ms':>11} {'fused ms':>9} {'speedup':>7}")
+    for video_path in video_paths:
+        video_fname = os.path.basename(video_path)
+        for max_img_height in args.heights:
+            for interpolation in args.interpolations:
+                r = bench_scaler( video_path, max_img_height, interpolation, num_frames=args.frames )
+                frame_size = "{}x{}".format(*r["frame_size"])
+                still_size = "{}x{}".format(*r["still_size"])
+                print(f"{video_fname[:30]:30} {frame_size:>9} {r['sar']:>5.3f} {still_size:>9} {interpolation:13} {r['two_pass_passes']:>6} "
+                      f"{r['two_pass_ms']:>11.2f} {r['fused_ms']:>9.2f} {r['two_pass_ms'] / r['fused_ms']:>6.2f}x")
+
+    if tmp_dir:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='decode_bench',
+        description='Measures video decoding throughput versus decode threading.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("video_paths", metavar="VIDEO", type=str, nargs="*",
+        help="Path to a video file (optional with --scaler)")
+    parser.add_argument("-t", "--thread_types", type=str, nargs="+",
+        default=["slice", "frame", "auto"], choices=lilhelp.DECODE_THREAD_TYPES,
+        help="Thread types to try")
+    parser.add_argument("-n", "--thread_counts", type=int, nargs="+",
+        default=sorted(set([1, 2, 4, 8, os.cpu_count() or 1])),
+        help="Thread counts to try")
+    parser.add_argument("-l", "--lowres", type=int, nargs="+", default=[],
+        help="Reduced resolution factors to try (single-threaded)")
+    parser.add_argument("-s", "--seconds", type=float, default=60,
+        help="How many seconds of each video to decode")
+    parser.add_argument("--scaler", action="store_true",
+        help="Compare two-pass and single-pass scaling of stills instead of decoding throughput")
+    parser.add_argument("-i", "--interpolations", type=str, nargs="+",
+        default=lilhelp.INTERPOLATIONS, choices=lilhelp.INTERPOLATIONS,
+        help="Interpolation methods to try (with --scaler)")
+    parser.add_argument("--heights", type=int, nargs="+", default=[360, 540],
+        help="Maximum still heights to try (with --scaler)")
+    parser.add_argument("--frames", type=int, default=60,
+        help="How many frames of each video to scale (with --scaler)")
+
+    args = parser.parse_args()
+
+    if args.scaler:
+        main_scaler(args)
+        return
+    if not args.video_paths:
+        parser.error("at least one VIDEO is required (except with --scaler)")
+
+    print(f"{'video':30} {'codec':10} {'type':6} {'threads':>7} {'lowres':>6} {'frames':>7} {'fps':>9}")
+    for video_path in args.video_paths:
+        video_fname = os.path.basename(video_path)
+        with av.open(video_path) as container:
+            codec_name = container.streams.video[0].codec_context.name
+
+        # single-threaded decoding, as a baseline
+        configs = [ ("none", 1, 0) ]
+        configs += [ ("none", 1, f) for f in args.lowres
+                     if 0 < f <= lilhelp.LOWRES_CODECS.get(codec_name, 0) ]
+        configs += [ (t, n, 0) for t in args.thread_types for n in args.thread_counts
+                     if t != "none" ]
+        for thread_type, thread_count, lowres in configs:
+            result = bench_decode( video_path,
+                                   thread_type,
+                                   thread_count,
+                                   max_seconds=args.seconds,
+                                   lowres=lowres )
+            print(f"{video_fname[:30]:30} {codec_name:10} {thread_type:6} {thread_count:>7} {lowres:>6} "
+                  f"{result['frames']:>7} {result['fps']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+format_bench.py
+
+Compares image formats and quality profiles for stills (see `lilhelp.IMG_FORMATS`
+and `lilhelp.IMG_PROFILES`), to help choose the "img_format" and "img_profile" 
+options.
+
+Usage:
+    python -m visaid_builder.format_bench VIDEO [VIDEO ...] [-f FORMAT ...] [-p PROFILE ...] [-e]
+
+For each video, finds `--stills` frames spread evenly through it, and encodes each
+one (scaled to `--height`) in each format and profile.  Reports the average bytes
+per still, the average encoding time per still, the fidelity (PSNR against the 
+scaled frame), and the total size relative to JPEG in the "standard" profile.
+
+With `--encoders`, also compares the JPEG encoders (see `lilhelp.ENCODERS`) in 
+each profile:  the same measures for each encoder, plus the PSNR of each
+encoder's stills against Pillow's, and whether that is at least 
+`EQUIVALENT_PSNR` (i.e., the stills look the same).
+"""
+
+import io
+import math
+import time
+import argparse
+
+import av
+from PIL import Image, ImageChops, ImageStat
+
+from . import lilhelp
+from . import media_index
+
+
+# PSNR (dB) against Pillow's stills above which an encoder's stills count as
+# visually equivalent.  (Both sets of stills are lossy, so this cannot be much
+# higher than the PSNR of Pillow's stills against the frames, which is about 30
+# dB for detailed HD frames in the "small" profile.)
+EQUIVALENT_PSNR = 30.0
+
+
+def psnr( original,
+          decoded ) -> float:
+    """
+    Returns the peak signal-to-noise ratio (dB) of a decoded image against the
+    original (both PIL images of the same size)
+    """
+    diff = ImageChops.difference( original.convert("RGB"), decoded.convert("RGB") )
+    stat = ImageStat.Stat(diff)
+    mse = sum( s / c for s, c in zip(stat.sum2, stat.count) ) / len(stat.count)
+    return 10 * math.log10( 255 ** 2 / max(mse, 1e-10) )
+
+
+def sample_frames( video_path:str,
+                   num_stills:int = 20 ) -> tuple:
+    """
+    Returns a list of `num_stills` frames, spread evenly through the video, and
+    the sample aspect ratio of the video
+    """
+    index = media_index.get_index(video_path)
+    length = media_index.media_length(index)
+    target_times = [ int( (i + 0.5) * length / num_stills ) for i in range(num_stills) ]
+
+    frames = []
+    with av.open(video_path) as container:
+        video_stream = container.streams.video[0]
+        sar = float(video_stream.sample_aspect_ratio or 1)
+        for _, _, frame in lilhelp.iter_target_frames( container, 
+                                                       video_stream, 
+                                                       target_times, 
+                                                       strategy="seek" ):
+            frames.append(frame)
+    return frames, sar
+
+
+def bench_formats( video_path:str,
+                   img_formats:list,
+                   profiles:list,
+                   num_stills:int = 20,
+                   max_img_height:int = 360 ) -> list:
+    """
+    Encodes `num_stills` frames, spread evenly through the video, in each of the
+    formats and profiles given.
+
+    Returns a list of dictionaries, one for each (format, profile), with the 
+    average bytes per still, encoding time per still (ms), and PSNR (dB).
+    """
+    frames, sar = sample_frames( video_path, num_stills )
+
+    results = []
+    for img_format in img_formats:
+        for profile in profiles:
+            img_quality = lilhelp.img_profile_quality(img_format, profile)
+            total_bytes = 0
+            elapsed = 0.0
+            psnrs = []
+            for frame in frames:
+                width, height = lilhelp.still_geometry( frame.width, frame.height, sar, 
+                                                        max_img_height=max_img_height )
+                start = time.perf_counter()
+                img_data = lilhelp.encode_image( frame, width, height, img_format, img_quality )
+                elapsed += time.perf_counter() - start
+                total_bytes += len(img_data)
+
+                psnrs.append( psnr( lilhelp.frame_to_image(frame, width, height), 
+                                    Image.open(io.BytesIO(img_data)) ) )
+
+            n = max( len(frames), 1 )
+            results.append( { "format": img_format,
+                              "profile": profile,
+                              "quality": img_quality,
+                              "stills": len(frames),
+                              "bytes": total_bytes / n,
+                              "ms": elapsed * 1000 / n,
+                              "psnr": sum(psnrs) / n } )
+    return results
+
+
+def compare_encoders( frames:list,
+                      sar:float,
+                      profiles:list,
+                      max_img_height:int = 360 ) -> list:
+    """
+    Encodes the frames as JPEG stills with each of `lilhelp.ENCODERS`, in each of
+    the profiles given.
+
+    Returns a list of dictionaries, one for each (encoder, profile), with the 
+    average bytes per still, encoding time per still (ms), PSNR (dB) against the
+    scaled frame, and average and lowest PSNR against the Pillow stills (None 
+    for Pillow itself), and whether the lowest is at least `EQUIVALENT_PSNR`.
+    """
+    results = []
+    for profile in profiles:
+        img_quality = lilhelp.img_profile_quality("JPEG", profile)
+        references = {}
+        for encoder in [ "pillow" ] + [ e for e in lilhelp.ENCODERS if e != "pillow" ]:
+            total_bytes = 0
+            elapsed = 0.0
+            psnrs = []
+            vs_pillow = []
+            for fnum, frame in enumerate(frames):
+                width, height = lilhelp.still_geometry( frame.width, frame.height, sar, 
+                                                        max_img_height=max_img_height )
+                start = time.perf_counter()
+                img_data = lilhelp.encode_image( frame, width, height, "JPEG", img_quality, 
+                                                 encoder=encoder )
+                elapsed += time.perf_counter() - start
+                total_bytes += len(img_data)
+
+                image = Image.open(io.BytesIO(img_data))
+                psnrs.append( psnr( lilhelp.frame_to_image(frame, width, height), image ) )
+                if encoder == "pillow":
+                    references[fnum] = image
+                else:
+                    vs_pillow.append( psnr( references[fnum], image ) )
+
+            n = max( len(frames), 1 )
+            results.append( { "encoder": encoder,
+                              "profile": profile,
+                              "quality": img_quality,
+                              "stills": len(frames),
+                              "bytes": total_bytes / n,
+                              "ms": elapsed * 1000 / n,
+                              "psnr": sum(psnrs) / n,
+                              "psnr_vs_pillow": sum(vs_pillow) / n if vs_pillow else None,
+                              "min_psnr_vs_pillow": min(vs_pillow) if vs_pillow else None,
+                              "equivalent": not vs_pillow or min(vs_pillow) >= EQUIVALENT_PSNR } )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='format_bench',
+        description='Compares image formats and quality profiles for stills.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("video_paths", metavar="VIDEO", type=str, nargs="+",
+        help="Path to a video file")
+    parser.add_argument("-f", "--formats", type=str, nargs="+",
+        default=list(lilhelp.IMG_FORMATS), choices=list(lilhelp.IMG_FORMATS),
+        help="Image formats to try")
+    parser.add_argument("-p", "--profiles", type=str, nargs="+",
+        default=list(lilhelp.IMG_PROFILES), choices=list(lilhelp.IMG_PROFILES),
+        help="Quality profiles to try")
+    parser.add_argument("-n", "--stills", type=int, default=20,
+        help="How many stills to take from each video")
+    parser.add_argument("--height", type=int, default=360,
+        help="Maximum height of the stills")
+    parser.add_argument("-e", "--encoders", action="store_true",
+        help="Also compare the JPEG encoders")
+
+    args = parser.parse_args()
+
+    img_formats = []
+    for img_format in args.formats:
+        if lilhelp.img_format_supported(img_format):
+            img_formats.append(img_format)
+        else:
+            print(f"Skipping {img_format}, which the installed Pillow cannot save.")
+
+    print(f"{'video':30} {'format':6} {'profile':8} {'quality':>7} {'bytes':>9} {'ms':>7} {'PSNR':>6} {'vs JPEG':>8}")
+    for video_path in args.video_paths:
+        video_fname = video_path[video_path.rfind("/")+1:]
+        results = bench_formats( video_path, 
+                                 img_formats, 
+                                 args.profiles, 
+                                 num_stills=args.stills,
+                                 max_img_height=args.height )
+        baseline = next( ( r["bytes"] for r in results 
+                           if r["format"] == "JPEG" and r["profile"] == "standard" ), None )
+        for r in results:
+            relative = f"{r['bytes'] / baseline:>8.2f}" if baseline else f"{'':>8}"
+            print(f"{video_fname[:30]:30} {r['format']:6} {r['profile']:8} {r['quality']:>7} "
+                  f"{r['bytes']:>9.0f} {r['ms']:>7.2f} {r['psnr']:>6.1f} {relative}")
+
+    if args.encoders:
+        print()
+        print(f"{'video':30} {'encoder':7} {'profile':8} {'quality':>7} {'bytes':>9} {'ms':>7} {'PSNR':>6} {'vs pillow (min)':>16} {'same':>5}")
+        for video_path in args.video_paths:
+            video_fname = video_path[video_path.rfind("/")+1:]
+            frames, sar = sample_frames( video_path, args.stills )
+            for r in compare_encoders( frames, sar, args.profiles, max_img_height=args.height ):
+                vs_pillow = ( f"{r['psnr_vs_pillow']:>7.1f} ({r['min_psnr_vs_pillow']:>5.1f})" 
+                              if r["psnr_vs_pillow"] is not None else "" )
+                print(f"{video_fname[:30]:30} {r['encoder']:7} {r['profile']:8} {r['quality']:>7} "
+                      f"{r['bytes']:>9.0f} {r['ms']:>7.2f} {r['psnr']:>6.1f} {vs_pillow:>16} "
+                      f"{'yes' if r['equivalent'] else 'NO':>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,600 @@
+"""
+frame_plan.py
+
+Defines a class for extracting the stills needed by several artifacts in one
+pass through a video.
+
+Each artifact registers (with `FramePlan.request`) the target times it needs,
+along with how its stills should be stretched, scaled, and encoded.  Then
+`FramePlan.run` decodes the video once (see `lilhelp.iter_target_frames`), and
+each still is prepared and encoded only once, even if several artifacts need
+the same still in the same style.
+
+If the plan has a cache directory, stills already extracted (in the same style)
+on earlier runs are taken from the cache (see `thumb_cache`), and only the rest
+are decoded.  If all are cached, the video is not opened.  (The duration of the video and 
+the spacing of its keyframes come from its index, which may be saved on disk for
+later runs; see `media_index`.)
+
+For long videos, the exact frames can be found by several worker processes at
+once, each seeking to and decoding its own segment of the video (see `FramePlan.run`).
+
+Artifacts are then assembled from the shared results, using `stills_b64` (for
+images embedded in HTML) or `save_stills` (for image files).
+
+A request may instead ask for a quick preview, taking the nearest keyframe within
+a tolerance of each target (see `lilhelp.iter_nearest_keyframes`).  Then only
+the targets with no keyframe near enough are found exactly.
+"""
+
+import os
+import base64
+import logging
+import multiprocessing
+import concurrent.futures
+
+import av
+
+from . import lilhelp
+from . import thumb_cache
+from . import media_index
+
+
+def encode_still( frame,
+                  style:tuple,
+                  sar:float,
+                  frame_size:tuple = None ) -> bytes:
+    """
+    Returns the encoded image data for a frame in the given style (as stored by 
+    `FramePlan.request`), for a video with the given sample aspect ratio.
+
+    The size of the still (stretched for SAR and scaled down) is worked out first,
+    so that the frame is scaled only once.  It is worked out from `frame_size`, 
+    the (width, height) of the video, if given.  (Frames decoded at reduced 
+    resolution then make stills of the same size as full frames.)
+    """
+    stretch_threshold, max_img_height, img_format, img_quality, interpolation, encoder = style
+
+    if frame_size is None:
+        frame_size = (frame.width, frame.height)
+    width, height = lilhelp.still_geometry( frame_size[0], 
+                                            frame_size[1], 
+                                            sar, 
+                                            stretch_threshold, 
+                                            max_img_height )
+
+    return lilhelp.encode_image( frame, 
+                                 width, 
+                                 height, 
+                                 img_format, 
+                                 img_quality, 
+                                 interpolation, 
+                                 encoder )
+
+
+def _extract_segment( video_path:str,
+                      threshold_styles:dict,
+                      sar:float,
+                      decode_opts:dict ) -> tuple:
+    """
+    Extracts and encodes the stills for one segment of a video, in a worker 
+    process.  `threshold_styles` maps each threshold in the segment to the styles
+    needed for it, and `decode_opts` holds keyword arguments for 
+    `lilhelp.iter_target_frames`, plus "thread_type", "thread_count", 
+    "encode_threads", "lowres" (see `lilhelp.set_lowres`), and "frame_size" (see
+    `encode_still`).
+
+    Returns a tuple of
+      dictionary keyed by threshold, with values (frame time, {style: image data})
+      list of (frame time, error message) for packets that could not be decoded
+      dictionary of decoding statistics
+    """
+    decode_opts = dict(decode_opts)
+    thread_type = decode_opts.pop("thread_type")
+    thread_count = decode_opts.pop("thread_count")
+    encode_threads = decode_opts.pop("encode_threads")
+    lowres = decode_opts.pop("lowres")
+    frame_size = decode_opts.pop("frame_size")
+
+    found = {}
+    errors = []
+    stats = {}
+    with av.open(video_path) as container, lilhelp.EncodePool(encode_threads) as pool:
+        video_stream = next(s for s in container.streams if s.type == 'video')
+        lilhelp.set_decode_threads(video_stream, thread_type, thread_count)
+        lilhelp.set_lowres(video_stream, lowres)
+        target_frames = lilhelp.iter_target_frames( container,
+                                                    video_stream,
+                                                    list(threshold_styles),
+                                                    on_error=lambda e, ftime: errors.append( (ftime, str(e)) ),
+                                                    stats=stats,
+                                                    **decode_opts )
+        encoded = {}
+        encoded_ftime = None
+        for threshold, ftime, frame in target_frames:
+            if ftime != encoded_ftime:
+                encoded = {}
+                encoded_ftime = ftime
+            for style in threshold_styles[threshold]:
+                if style not in encoded:
+                    encoded[style] = pool.submit( encode_still, frame, style, sar, frame_size )
+            found[threshold] = ( ftime, { style: encoded[style] for style in threshold_styles[threshold] } )
+
+    # (The pool has finished encoding.)
+    found = { threshold: ( ftime, { style: future.result() for style, future in by_style.items() } )
+              for threshold, (ftime, by_style) in found.items() }
+    return found, errors, stats
+
+
+class FramePlan:
+    """
+    Frame requests from several artifacts for one video, and the stills extracted
+    for them.
+    """
+
+    def __init__( self,
+                  video_path:str,
+                  stdout:bool = False,
+                  cache_dir:str = None,
+                  index_dir:str = None,
+                  index_next_to_media:bool = False ):
+        self.video_path = video_path
+        self.video_fname = video_path[video_path.rfind("/")+1:]
+        self.stdout = stdout
+
+        # thumbnail cache (if any), and the fingerprint of the video in it
+        self.cache_dir = cache_dir
+        self.fingerprint = None
+
+        # where the media index is saved (see `media_index.get_index`):  in
+        # `index_dir`, or else with the thumbnail cache, or else (if
+        # `index_next_to_media`) next to the video
+        self.index_dir = index_dir or cache_dir
+        self.index_next_to_media = index_next_to_media
+
+        # requests keyed by name, with the stills extracted for each
+        self.requests = {}
+
+        # results of the decode pass
+        self.problems = []
+        self.extras = {}
+        self.sar = 1.0
+        self.frame_size = None
+        self.lowres = False
+        self.stats = {}
+        self.done = False
+
+
+    def request( self,
+                 name,
+                 target_times:list,
+                 tolerance:int = 0,
+                 stretch_threshold:float = lilhelp.STRETCH_THRESHOLD,
+                 max_img_height:int = None,
+                 img_format:str = lilhelp.IMG_FORMAT,
+                 img_quality:int = lilhelp.IMG_QUALITY,
+                 preview_tolerance:int = None,
+                 interpolation:str = lilhelp.INTERPOLATION,
+                 encoder:str = lilhelp.ENCODER ):
+        """
+        Registers a request for the stills at `target_times` (in ms), where the
+        still for each target is the first frame no earlier than `tolerance` ms
+        before it.
+
+        If `preview_tolerance` is not None, the still for each target is instead the
+        nearest keyframe, if there is one within `preview_tolerance` ms.
+
+        Stills are stretched if the sample aspect ratio differs from 1 by more than
+        `stretch_threshold`, and scaled down to `max_img_height` (if not None), 
+        with the given interpolation method (see `lilhelp.INTERPOLATIONS`), and 
+        encoded with the given encoder (see `lilhelp.ENCODERS`).
+        """
+        if self.done:
+            raise RuntimeError("Cannot add requests to a frame plan that has already run.")
+
+        self.requests[name] = { "times": sorted(set(target_times)),
+                                "tolerance": tolerance,
+                                "style": ( stretch_threshold,
+                                           max_img_height,
+                                           img_format,
+                                           img_quality,
+                                           interpolation,
+                                           encoder ),
+                                "preview_tolerance": preview_tolerance,
+                                "keyframe_times": set(),
+                                "cached_times": set(),
+                                "stills": {} }
+
+
+    def run( self,
+             strategy:str = "auto",
+             skip_frames:str = "none",
+             skip_window:int = lilhelp.SKIP_WINDOW,
+             thread_type:str = lilhelp.DECODE_THREAD_TYPE,
+             thread_count:int = lilhelp.DECODE_THREADS,
+             workers:int = 1,
+             encode_threads:int = lilhelp.ENCODE_THREADS,
+             lowres:bool = False ):
+        """
+        Decodes the video once, extracting stills for all the requests.
+
+        `strategy` says how to get to the frames (see `lilhelp.EXTRACT_STRATEGIES`).
+        `skip_frames` and `skip_window` say which frames the decoder may skip while
+        the next target is far away (see `lilhelp.iter_target_frames`).
+        `thread_type` and `thread_count` configure multi-threaded decoding (see
+        `lilhelp.set_decode_threads`).
+
+        If `workers` is more than 1, the target times are split into that many 
+        segments, and each segment is extracted by a separate worker process, which
+        opens the video and seeks to the start of its segment.  (This is only done
+        for formats in which seeking is exact, and not with the "linear" strategy.)
+        The worker processes are spawned, so a script that calls this with
+        `workers` more than 1 must guard its top-level code with
+        `if __name__ == "__main__":`.
+
+        Stills are scaled and encoded by a pool of `encode_threads` threads, while
+        decoding continues (see `lilhelp.EncodePool`).
+
+        If `lowres` is True, frames are decoded at reduced resolution, by the 
+        largest factor that still gives every request frames big enough for its
+        stills (see `lilhelp.lowres_factor`).  This is only possible for some
+        codecs (see `lilhelp.LOWRES_CODECS`); others are decoded at full resolution.
+        """
+        self.lowres = lowres
+
+        # Take what we can from the thumbnail cache.  If that is everything, there
+        # is no need to open the video.
+        if self.cache_dir and self._load_from_cache():
+            self.done = True
+            return
+
+        # find the first video stream
+        # (The container and the encoding threads are closed even if decoding or
+        # encoding fails.)
+        container = av.open(self.video_path)
+        try:
+            video_stream = next((s for s in container.streams if s.type == 'video'), None)
+            if video_stream is None:
+                raise Exception("No video stream found in {}".format(self.video_path) )
+            lilhelp.set_decode_threads(video_stream, thread_type, thread_count)
+
+            # get technical stats on the video stream; assumes FPS is constant
+            fps = video_stream.average_rate.numerator / video_stream.average_rate.denominator
+            self.extras["fps"] = float(f"{fps:.2f}")
+
+            if video_stream.sample_aspect_ratio is not None:
+                self.sar = float(video_stream.sample_aspect_ratio)
+                self.extras["sar"] = float(f"{self.sar:.3f}")
+            else:
+                # If SAR cannot be determined, assume it is 1 for present purposes
+                self.sar = 1.0
+                # But report it as None
+                self.extras["sar"] = None
+
+            if not self.stdout and any( self._stretch(r["style"]) for r in self.requests.values() ):
+                logging.info(f'Sample aspect ratio: {self.sar:.3f}. Will stretch anamorphic frames.')
+
+            # get the duration and keyframe spacing from the media index (which is
+            # saved in the index directory or with the thumbnail cache, if any)
+            index = media_index.get_index( self.video_path, 
+                                           self.index_dir, 
+                                           self.index_next_to_media )
+            self.extras["media_length"] = media_index.media_length(index)
+            gop_ms = media_index.gop_ms(index)
+
+            # Decode at reduced resolution, if requested and possible for all requests
+            self.frame_size = ( video_stream.codec_context.width, video_stream.codec_context.height )
+            factor = 0
+            if lowres:
+                factor = min( lilhelp.lowres_factor( video_stream.codec_context.name,
+                                                     *self.frame_size,
+                                                     self.sar,
+                                                     req["style"][0],
+                                                     req["style"][1] ) 
+                              for req in self.requests.values() )
+                lilhelp.set_lowres(video_stream, factor)
+                logging.debug(f"Decoding {self.video_fname} with low-res factor {factor}.")
+            self.stats["lowres"] = factor
+
+            # Log only one decode error per (starting) time stamp of corrupt region.
+            last_packet_error = 0
+            def on_decode_error(e, ftime):
+                nonlocal last_packet_error
+                if last_packet_error != ftime:
+                    if not self.stdout:
+                        logging.warning(f"{self.video_fname} at {ftime} ms: {e}")
+                    last_packet_error = ftime
+                if "decode" not in self.problems:
+                    self.problems.append("decode")
+
+            # Stills are encoded on other threads while decoding continues.  Until
+            # the pool is closed, the stills hold futures for the image data.
+            with lilhelp.EncodePool(encode_threads) as pool:
+
+                # stills already encoded from the current frame, keyed by style
+                encoded = {}
+                encoded_ftime = None
+
+                def save_still( name, target_time, ftime, frame ):
+                    nonlocal encoded, encoded_ftime
+                    if ftime != encoded_ftime:
+                        encoded = {}
+                        encoded_ftime = ftime
+                    style = self.requests[name]["style"]
+                    if style not in encoded:
+                        encoded[style] = pool.submit( encode_still, frame, style, self.sar, self.frame_size )
+                    self.requests[name]["stills"][target_time] = (ftime, encoded[style])
+
+                # Previews first:  Collect the preview requests for each target time, for
+                # a pass through the keyframes.  (Keyframe tolerance is per target time, so 
+                # the most tolerant preview request for a time determines what is decoded.)
+                previews = {}
+                for name, req in self.requests.items():
+                    if req["preview_tolerance"] is not None:
+                        for target_time in req["times"]:
+                            previews.setdefault( target_time, [] ).append( name )
+
+                if previews:
+                    tolerance = max( req["preview_tolerance"] for req in self.requests.values() 
+                                     if req["preview_tolerance"] is not None )
+                    keyframes = lilhelp.iter_nearest_keyframes( container,
+                                                                video_stream,
+                                                                list(previews),
+                                                                tolerance,
+                                                                on_error=on_decode_error,
+                                                                stats=self.stats )
+                    for target_time, ftime, frame in keyframes:
+                        for name in previews[target_time]:
+                            req = self.requests[name]
+                            if abs( ftime - target_time ) <= req["preview_tolerance"]:
+                                save_still( name, target_time, ftime, frame )
+                                req["keyframe_times"].add( target_time )
+
+                    # Start over for exact frames
+                    container.close()
+                    container = av.open(self.video_path)
+                    video_stream = next(s for s in container.streams if s.type == 'video')
+                    lilhelp.set_decode_threads(video_stream, thread_type, thread_count)
+                    lilhelp.set_lowres(video_stream, factor)
+
+                # Each target, less its tolerance, is a threshold for the first frame
+                # that will do.  Collect the (request, target) pairs for each threshold.
+                # (This includes previews with no keyframe near enough.)
+                thresholds = {}
+                for name, req in self.requests.items():
+                    for target_time in req["times"]:
+                        if ( target_time not in req["keyframe_times"] and 
+                             target_time not in req["cached_times"] ):
+                            thresholds.setdefault( target_time - req["tolerance"], [] ).append( (name, target_time) )
+
+                if ( workers > 1 and len(thresholds) > 1 and strategy != "linear" 
+                     and lilhelp.is_seekable(container) ):
+                    container.close()
+                    decode_opts = { "strategy": strategy,
+                                    "gop_ms": gop_ms,
+                                    "skip_frames": skip_frames,
+                                    "skip_window": skip_window,
+                                    "thread_type": thread_type,
+                                    "thread_count": thread_count,
+                                    "encode_threads": encode_threads,
+                                    "lowres": factor,
+                                    "frame_size": self.frame_size }
+                    self._run_segments( thresholds, workers, decode_opts, on_decode_error )
+                else:
+                    target_frames = lilhelp.iter_target_frames( container,
+                                                                video_stream,
+                                                                list(thresholds),
+                                                                strategy=strategy,
+                                                                gop_ms=gop_ms,
+                                                                skip_frames=skip_frames,
+                                                                skip_window=skip_window,
+                                                                on_error=on_decode_error,
+                                                                stats=self.stats )
+                    for threshold, ftime, frame in target_frames:
+                        for name, target_time in thresholds[threshold]:
+                            save_still( name, target_time, ftime, frame )
+        finally:
+            # Done with the video media itself
+            container.close()
+        self._finish()
+
+
+    def _finish( self ):
+        """
+        Replaces the futures of the stills (which have all been encoded) with the
+        image data.
+        """
+        for req in self.requests.values():
+            for target_time, (ftime, img_data) in req["stills"].items():
+                if isinstance(img_data, concurrent.futures.Future):
+                    req["stills"][target_time] = (ftime, img_data.result())
+        self.done = True
+
+        if self.cache_dir:
+            self._save_to_cache()
+
+
+    def _cache_keys( self ) -> dict:
+        """
+        Returns a dictionary, keyed by (request name, target time), of the keys for 
+        the stills in the thumbnail cache.  (Previews are not cached.  Stills 
+        decoded at reduced resolution are kept apart from full resolution ones.)
+        """
+        lowres = ("lowres",) if self.lowres else ()
+        return { (name, target_time): thumb_cache.still_key( target_time, 
+                                                             req["tolerance"], 
+                                                             req["style"] + lowres )
+                 for name, req in self.requests.items() 
+                 if req["preview_tolerance"] is None
+                 for target_time in req["times"] }
+
+
+    def _load_from_cache( self ) -> bool:
+        """
+        Fills in the stills found in the thumbnail cache.  Returns True if every 
+        still needed was found (and the technical stats of the video were restored
+        from the cache).
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.fingerprint = thumb_cache.media_fingerprint(self.video_path)
+
+        keys = self._cache_keys()
+        meta, found = thumb_cache.load_stills( self.cache_dir, 
+                                               self.fingerprint, 
+                                               sorted(set(keys.values())) )
+        for (name, target_time), key in keys.items():
+            if key in found:
+                req = self.requests[name]
+                if found[key] is not None:
+                    req["stills"][target_time] = found[key]
+                req["cached_times"].add(target_time)
+
+        all_cached = ( meta is not None and
+                       all( req["preview_tolerance"] is None and 
+                            len(req["cached_times"]) == len(req["times"])
+                            for req in self.requests.values() ) )
+        if all_cached:
+            self.extras = dict(meta["extras"])
+            self.sar = meta["sar"]
+            self.problems = meta["problems"][:]
+            logging.debug(f"All {len(keys)} stills for {self.video_fname} found in thumbnail cache.")
+        return all_cached
+
+
+    def _save_to_cache( self ):
+        """
+        Saves the stills that were newly extracted (other than previews) to the 
+        thumbnail cache, along with the technical stats of the video.  (Targets 
+        with no frame are saved as such.)
+        """
+        stills = {}
+        for (name, target_time), key in self._cache_keys().items():
+            req = self.requests[name]
+            if target_time not in req["cached_times"]:
+                stills[key] = req["stills"].get(target_time)
+        meta = { "extras": self.extras,
+                 "sar": self.sar,
+                 "problems": self.problems }
+        try:
+            thumb_cache.save_stills( self.cache_dir, 
+                                     self.fingerprint, 
+                                     meta, 
+                                     stills, 
+                                     media_path=self.video_path )
+        except Exception as e:
+            logging.warning(f"Warning: Could not save stills to thumbnail cache: {e}")
+
+
+    def _run_segments( self,
+                       thresholds:dict,
+                       workers:int,
+                       decode_opts:dict,
+                       on_error ):
+        """
+        Extracts the stills for `thresholds` (keyed by threshold, with lists of 
+        (request name, target time)) in segments of consecutive thresholds, with 
+        a pool of `workers` processes.  Decode errors reported by the workers are 
+        passed to `on_error`, in order of time.
+        """
+        ordered = sorted(thresholds)
+        num_segments = min( workers, len(ordered) )
+        bounds = [ round( i * len(ordered) / num_segments ) for i in range(num_segments + 1) ]
+
+        # styles needed for each threshold, in the order first requested
+        segments = []
+        for i in range(num_segments):
+            segment = {}
+            for threshold in ordered[bounds[i]:bounds[i+1]]:
+                styles = [ self.requests[name]["style"] for name, _ in thresholds[threshold] ]
+                segment[threshold] = list(dict.fromkeys(styles))
+            segments.append(segment)
+
+        # (Worker processes are spawned, not forked, since this process may have
+        # threads running, such as those encoding previews.)
+        with concurrent.futures.ProcessPoolExecutor( max_workers=num_segments,
+                                                     mp_context=multiprocessing.get_context("spawn") ) as pool:
+            futures = [ pool.submit( _extract_segment, 
+                                     self.video_path, 
+                                     segment, 
+                                     self.sar, 
+                                     decode_opts ) 
+                        for segment in segments ]
+            results = [ f.result() for f in futures ]
+
+        # Merge the results in segment order
+        for found, errors, stats in results:
+            for ftime, message in errors:
+                on_error(message, ftime)
+            for key, count in stats.items():
+                self.stats[key] = self.stats.get(key, 0) + count
+            for threshold, (ftime, by_style) in found.items():
+                for name, target_time in thresholds[threshold]:
+                    style = self.requests[name]["style"]
+                    self.requests[name]["stills"][target_time] = (ftime, by_style[style])
+
+
+    def _stretch( self,
+                  style:tuple ) -> bool:
+        return abs( 1 - self.sar ) > style[0]
+
+
+    def stills_b64( self,
+                    name ) -> dict:
+        """
+        Returns a dictionary, keyed by target time, of (actual frame time, base64
+        image data) for the stills extracted for the named request.
+        """
+        return { target_time: (ftime, base64.b64encode(img_data).decode('utf-8'))
+                 for target_time, (ftime, img_data) in self.requests[name]["stills"].items() }
+
+
+    def stills( self,
+                name ) -> tuple:
+        """
+        Returns the stills for the named request in the form returned by
+        `create_visaid.extract_images` (and accepted by `create_visaid` and
+        `create_cataid`).
+        """
+        req = self.requests[name]
+        infos = [ f'SAR-{self.sar:.3f}' ] if self._stretch(req["style"]) else []
+        images = { req["style"][1]: self.stills_b64(name) }
+        extras = dict(self.extras)
+        if req["preview_tolerance"] is not None:
+            extras["preview"] = self.preview_report(name)
+        return images, self.problems[:], infos, extras
+
+
+    def preview_report( self,
+                        name ) -> dict:
+        """
+        Returns a summary of how the stills for a preview request were found:  
+        how many targets were served by keyframes within tolerance, and how many
+        fell back to exact decoding, along with the target times served by 
+        keyframes.
+        """
+        req = self.requests[name]
+        within = len(req["keyframe_times"])
+        return { "tolerance": req["preview_tolerance"],
+                 "within_tolerance": within,
+                 "fallback": len(req["times"]) - within,
+                 "keyframe_times": sorted(req["keyframe_times"]) }
+
+
+    def save_stills( self,
+                     name,
+                     fname:str,
+                     dest_path:str,
+                     filetype_ext:str = "jpg" ) -> list:
+        """
+        Saves the stills for the named request as image files in `dest_path`, named
+        as by `lilhelp.extract_stills`, and returns the list of file names.
+        """
+        length = self.extras["media_length"]
+        image_list = []
+        for target_time, (ftime, img_data) in sorted(self.requests[name]["stills"].items()):
+            ifilename =  f'{fname}_{length:08}_{target_time:08}_{ftime:08}' + "." + filetype_ext
+            with open(dest_path + "/" + ifilename, "wb") as img_file:
+                img_file.write(img_data)
+            image_list.append(ifilename)
+        return image_list
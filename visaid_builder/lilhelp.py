@@ -4,15 +4,108 @@ Provides helper functions for using data extracted from MMIF files
 """
 
 # Import statements
+import io
 import math
 import os
 import av
 import logging
+import collections
+import concurrent.futures
+from fractions import Fraction
+from statistics import median
+
+from PIL import Image
+
+from . import media_index
 
 IMG_FORMAT = "JPEG"
 IMG_QUALITY = 80
 STRETCH_THRESHOLD = 0.01
 
+# Image formats for stills (as named by Pillow), with their MIME types and file
+# extensions.  (WebP and AVIF need a Pillow built with support for them; see
+# `img_format_supported`.)
+IMG_FORMATS = { "JPEG": ("image/jpeg", "jpg"),
+                "WEBP": ("image/webp", "webp"),
+                "AVIF": ("image/avif", "avif") }
+
+# Options for encoding each format with Pillow, trading encoding time for size
+IMG_SAVE_OPTIONS = { "WEBP": { "method": 4 },
+                     "AVIF": { "speed": 10 } }
+
+# Named quality profiles, with the quality setting for each format.  (Within a 
+# profile, the settings give about the same fidelity in each format, as measured
+# by PSNR.  See `format_bench`.)
+IMG_PROFILES = { "small":    { "JPEG": 60, "WEBP": 70, "AVIF": 45 },
+                 "standard": { "JPEG": 75, "WEBP": 80, "AVIF": 55 },
+                 "high":     { "JPEG": 90, "WEBP": 90, "AVIF": 75 } }
+IMG_PROFILE = "standard"
+
+# Interpolation methods for scaling stills (as for FFmpeg's scaler)
+INTERPOLATIONS = ["fast_bilinear", "bilinear", "bicubic", "area", "lanczos", "spline"]
+INTERPOLATION = "bilinear"
+
+# Ways of encoding stills
+#   "pillow" - convert the scaled frame to RGB and encode it with Pillow
+#   "libav"  - encode the scaled YUV frame with FFmpeg's MJPEG encoder (JPEG only;
+#              other formats are encoded with Pillow)
+ENCODERS = ["pillow", "libav"]
+ENCODER = "pillow"
+
+# Strategies for getting to the frames for a list of target times
+#   "linear" - decode every frame from the start of the video to the last target
+#   "seek"   - seek to the keyframe before each target more than one GOP ahead
+#   "auto"   - seek only across gaps of at least `AUTO_SEEK_GOPS` GOPs 
+# (All three find the same frames.  See `iter_target_frames`.)
+EXTRACT_STRATEGIES = ["linear", "seek", "auto"]
+AUTO_SEEK_GOPS = 4
+
+# Levels of frame skipping while decoding toward a target that is still far away
+#   "none"   - decode every frame
+#   "nonref" - skip frames that no other frames refer to (e.g., most B-frames)
+#   "nonkey" - skip everything but keyframes, in GOPs that end before the target
+# Frames less than `SKIP_WINDOW` ms before a target are always fully decoded.
+# (All levels find the same frames.  See `iter_target_frames`.)
+SKIP_FRAMES_LEVELS = ["none", "nonref", "nonkey"]
+SKIP_WINDOW = 1000
+
+# Kinds of multi-threaded decoding (as for FFmpeg codec contexts)
+#   "none"  - decode on one thread
+#   "slice" - decode the slices of each frame in parallel (if the codec has slices)
+#   "frame" - decode several frames in parallel (adds a few frames of latency)
+#   "auto"  - let the codec use both kinds
+# With a thread count of 0, FFmpeg chooses the number of threads from the number 
+# of cores.
+DECODE_THREAD_TYPES = ["none", "slice", "frame", "auto"]
+DECODE_THREAD_TYPE = "auto"
+DECODE_THREADS = 0
+
+# Codecs (as named by FFmpeg) that can decode at reduced resolution, with the
+# largest reduction factor each allows.  (At factor n, frames are decoded at 
+# 1/2**n of their width and height, skipping most of the IDCT work.)
+LOWRES_CODECS = { "mpeg1video": 3,
+                  "mpeg2video": 3,
+                  "mpeg4": 3,
+                  "h263": 3,
+                  "msmpeg4v3": 3,
+                  "wmv2": 3,
+                  "mjpeg": 3,
+                  "dvvideo": 3 }
+
+# Smallest reduction factor worth using.  (Full-resolution decoding has optimized
+# IDCTs that halving does not beat, so factor 1 is usually slower.)
+LOWRES_MIN_FACTOR = 2
+
+# Number of threads for scaling and encoding stills while decoding continues
+# (0 to encode each still before decoding the next frame)
+ENCODE_THREADS = 4
+
+# Container formats (as named by FFmpeg) with indexes that make seeking exact.
+# (In other formats, such as MPEG program and transport streams, frame timestamps 
+# after a seek may not match those found by decoding from the start, so frames
+# are always decoded linearly.)
+SEEK_FORMATS = ["mov", "mp4", "matroska", "webm", "avi"]
+
 
 # Define time prettification helper functions
 def tconv( msec: int, frac: bool = True ) -> str:
@@ -36,12 +129,34 @@ def extract_stills(video_path:str,
             fname:str = "mediaitem",
             dest_path:str = "",
             filetype_ext:str="jpg",
-            verbose:bool=True):
+            verbose:bool=True,
+            strategy:str="auto",
+            skip_frames:str="none",
+            skip_window:int=SKIP_WINDOW,
+            thread_type:str=DECODE_THREAD_TYPE,
+            thread_count:int=DECODE_THREADS,
+            encode_threads:int=ENCODE_THREADS,
+            interpolation:str=INTERPOLATION,
+            encoder:str=ENCODER,
+            img_format:str=IMG_FORMAT,
+            img_quality:int=IMG_QUALITY,
+            index_dir:str=None,
+            index_next_to_media:bool=False):
     """Performs extraction of stills from the video 
     `video_path` is the path to the video file to be extracted
     `time_points` is a list of integers representign the frames to be extracted in ms
     `fname` is a string used in the naming of the output files (and output dir, if not specified)
     `dest_path` is the path to an existing directory to put the stills in
+    `strategy` says how to get to the frames (one of `EXTRACT_STRATEGIES`)
+    `skip_frames` says which frames may be skipped when far from a target (one of `SKIP_FRAMES_LEVELS`)
+    `skip_window` is how far (in ms) before each target all frames are decoded
+    `thread_type` and `thread_count` say how to spread decoding over threads (see `set_decode_threads`)
+    `encode_threads` is the number of threads for saving stills while decoding continues (see `EncodePool`)
+    `interpolation` is the method for stretching anamorphic frames (one of `INTERPOLATIONS`)
+    `encoder` says how to encode the stills (one of `ENCODERS`)
+    `img_format` and `img_quality` give the image format (one of `IMG_FORMATS`, 
+    matching `filetype_ext`) and quality setting (see `IMG_PROFILES`)
+    `index_dir` and `index_next_to_media` say where the media index is saved for later runs (see `media_index.get_index`)
 
     Returns a list of the names of the image files extracted.
 
@@ -88,9 +203,7 @@ def extract_stills(video_path:str,
     video_stream = next((s for s in container.streams if s.type == 'video'), None)
     if video_stream is None:
         raise Exception("No video stream found in {}".format(video_path) ) 
-
-    # get technical stats on the video stream; assumes FPS is constant
-    fps = video_stream.average_rate.numerator / video_stream.average_rate.denominator
+    set_decode_threads(video_stream, thread_type, thread_count)
 
     # determine whether anamorphic stills will need to be stretched
     if video_stream.sample_aspect_ratio is not None:
@@ -99,13 +212,12 @@ def extract_stills(video_path:str,
         # If SAR cannot be determined, assume it is 1
         sar = 1.0
     if abs( 1 - sar ) > STRETCH_THRESHOLD:
-        stretch = True
         logging.debug(f'Sample aspect ratio: {sar:.3f}. Will stretch anamorphic frames.')
-    else:
-        stretch = False
 
-    # calculate duration in ms
-    length = int((video_stream.frames / fps) * 1000)
+    # get the duration in ms (from the packet timestamps) and the keyframe spacing
+    # (for planning seeks) from the media index
+    index = media_index.get_index(video_path, index_dir, index_next_to_media)
+    length = media_index.media_length(index)
 
     if time_points[-1] > length :
         print("Warning: Some specified time points are beyond video length and will not be extracted.")
@@ -113,63 +225,825 @@ def extract_stills(video_path:str,
     # Initialize counters for iteration
     image_list = []
     stills_count = 0
-    fcount = 0
+    decode_stats = {}
 
-    # going to loop through every frame in the video stream, starting at the beginning 
-    target_time = time_points[stills_count]
+    # Log only one error per (starting) time stamp of corrupt region.
     last_packet_error = 0
+    def on_decode_error(e, ftime):
+        nonlocal last_packet_error
+        if last_packet_error != ftime:
+            logging.warning(f"{video_fname} at {ftime} ms: {e}")
+            last_packet_error = ftime
+
+    # Grab the first still within 15 ms of each target (decoding linearly or 
+    # seeking, according to the strategy)
+    target_frames = iter_target_frames( container,
+                                        video_stream,
+                                        time_points,
+                                        strategy=strategy,
+                                        gop_ms=media_index.gop_ms(index),
+                                        tolerance=15,
+                                        skip_frames=skip_frames,
+                                        skip_window=skip_window,
+                                        errors=(Exception,),
+                                        on_error=on_decode_error,
+                                        stats=decode_stats )
+
+    def save_still(frame, ipathname):
+        # Stretch anamorphic frames, if necessary
+        width, height = still_geometry( frame.width, frame.height, sar, STRETCH_THRESHOLD )
+        img_data = encode_image( frame, width, height, img_format, img_quality, interpolation, encoder )
+        with open(ipathname, "wb") as img_file:
+            img_file.write(img_data)
+
+    # Stills are saved on other threads while decoding continues
+    with EncodePool(encode_threads) as pool:
+        for target_time, ftime, frame in target_frames:
+            ifilename =  f'{fname}_{length:08}_{target_time:08}_{ftime:08}' + "." + filetype_ext
+            pool.submit( save_still, frame, stills_dir + ifilename )
+            image_list.append(ifilename)
+            stills_count += 1
+    fcount = decode_stats["frames_decoded"]
+
+    if verbose: print("Extracted", stills_count, "stills out of", fcount, "video frames checked.") 
+
+    container.close()
+
+    return image_list
+
+
+# Define helper functions for preparing stills
+def still_geometry( width:int, 
+                    height:int, 
+                    sar:float, 
+                    stretch_threshold:float = STRETCH_THRESHOLD, 
+                    max_img_height:int = None ) -> tuple:
+    """
+    Returns the (width, height) of the still for a frame of the given size:  
+    stretched for the sample aspect ratio if it differs from 1 by more than 
+    `stretch_threshold`, and then scaled down to `max_img_height` (if not None).
+    """
+    # Check for anamorphic and stretch if necessary
+    if abs( 1 - sar ) > stretch_threshold:
+        if sar > 1.0:
+            # stretch the width
+            width = int( sar * width )
+        else:
+            # stretch the height
+            height = int( height / sar )
+
+    # Reduce the size of the image, if necessary
+    if max_img_height is not None and height > max_img_height:
+        res_factor = max_img_height / height
+        width = int( width * res_factor )
+        height = max_img_height
+
+    return width, height
+
+
+def frame_to_image( frame, 
+                    width:int, 
+                    height:int, 
+                    interpolation:str = INTERPOLATION ):
+    """
+    Returns a PIL image of the frame at the given size, scaled in a single pass 
+    with the given interpolation method (one of `INTERPOLATIONS`).
+
+    Scaling is done in the frame's own pixel format, and the (smaller) result is
+    then converted to RGB.  (This is much faster than scaling and converting in
+    one call to FFmpeg's scaler.)
+    """
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError(f"Invalid interpolation method: {interpolation}")
+    if width == frame.width and height == frame.height:
+        return frame.to_image()
+    res_frame = frame.reformat( width=width, 
+                                height=height, 
+                                interpolation=interpolation.upper() )
+    return res_frame.to_image()
+
+
+def _jpeg_qscale( img_quality:int ) -> int:
+    """
+    Returns the MJPEG quantizer scale (1 to 31) giving about the same size and 
+    fidelity as a JPEG quality (1 to 100) in Pillow (i.e., libjpeg).
+    """
+    # libjpeg scales its quantization tables by this percentage
+    scale = 5000 / img_quality if img_quality < 50 else 200 - 2 * img_quality
+    return min( 31, max( 1, round(scale / 16) ) )
+
+
+def _libav_jpeg( frame, 
+                 width:int, 
+                 height:int, 
+                 img_quality:int,
+                 interpolation:str ) -> bytes:
+    """
+    Returns JPEG data for the frame at the given size, encoded from YUV with 
+    FFmpeg's MJPEG encoder.  (Scaling and conversion to full-range YUV are done 
+    in one pass, and there is no conversion to RGB.)
+    """
+    yuv_frame = frame.reformat( width=width,
+                                height=height,
+                                format="yuvj420p",
+                                interpolation=interpolation.upper() )
+    yuv_frame.pts = None
+
+    codec_context = av.CodecContext.create("mjpeg", "w")
+    codec_context.width = width
+    codec_context.height = height
+    codec_context.pix_fmt = "yuvj420p"
+    codec_context.time_base = Fraction(1, 25)
+    codec_context.qmin = codec_context.qmax = _jpeg_qscale(img_quality)
+
+    packets = codec_context.encode(yuv_frame) + codec_context.encode(None)
+    return b"".join( bytes(p) for p in packets )
+
+
+def encode_image( frame,
+                  width:int, 
+                  height:int, 
+                  img_format:str = IMG_FORMAT,
+                  img_quality:int = IMG_QUALITY,
+                  interpolation:str = INTERPOLATION,
+                  encoder:str = ENCODER ) -> bytes:
+    """
+    Returns the frame, scaled to the given size, as image data in the given 
+    format and quality, encoded as specified by `encoder` (one of `ENCODERS`).
+    """
+    if encoder not in ENCODERS:
+        raise ValueError(f"Invalid image encoder: {encoder}")
+    if encoder == "libav" and img_format.upper() in ("JPEG", "JPG"):
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(f"Invalid interpolation method: {interpolation}")
+        return _libav_jpeg( frame, width, height, img_quality, interpolation )
+
+    buf = io.BytesIO()
+    frame_to_image(frame, width, height, interpolation).save( buf, 
+                                                              format=img_format, 
+                                                              quality=img_quality,
+                                                              **IMG_SAVE_OPTIONS.get(img_format.upper(), {}) )
+    return buf.getvalue()
+
+
+def img_format_supported( img_format:str ) -> bool:
+    """
+    Returns True if the installed Pillow can save images in the given format
+    """
+    Image.init()
+    return img_format.upper() in Image.SAVE
+
+
+def img_profile_quality( img_format:str,
+                         profile:str = IMG_PROFILE ) -> int:
+    """
+    Returns the quality setting for the given format (one of `IMG_FORMATS`) in the
+    named quality profile (one of `IMG_PROFILES`)
+    """
+    if profile not in IMG_PROFILES:
+        raise ValueError(f"Invalid image quality profile: {profile}")
+    if img_format.upper() not in IMG_FORMATS:
+        raise ValueError(f"Invalid image format: {img_format}")
+    return IMG_PROFILES[profile][img_format.upper()]
+
+
+def image_type( img_data:bytes ) -> tuple:
+    """
+    Returns the (MIME type, file extension) of encoded image data (only the first
+    16 bytes are needed), recognizing the formats in `IMG_FORMATS`, and assuming
+    JPEG otherwise.
+    """
+    if img_data[:4] == b"RIFF" and img_data[8:12] == b"WEBP":
+        return IMG_FORMATS["WEBP"]
+    if img_data[4:8] == b"ftyp" and img_data[8:12] in (b"avif", b"avis"):
+        return IMG_FORMATS["AVIF"]
+    return IMG_FORMATS["JPEG"]
+
+
+# Limits for re-encoding stills to fit a byte budget (see `fit_image_budget`):
+# the lowest quality setting, the scales tried (in order) if that is not enough,
+# and the number of stills sampled to estimate sizes at each quality
+BUDGET_MIN_QUALITY = 30
+BUDGET_SCALES = [0.85, 0.7, 0.6, 0.5, 0.4, 0.3, 0.25]
+BUDGET_SAMPLE = 24
+
+
+def _reencode( image,
+               img_format:str,
+               img_quality:int,
+               scale:float = 1.0 ) -> bytes:
+    """
+    Returns a PIL image encoded in the given format and quality, after scaling
+    it by `scale`
+    """
+    if scale < 1.0:
+        image = image.resize( ( max(1, round(image.width * scale)),
+                                max(1, round(image.height * scale)) ),
+                              Image.BILINEAR )
+    buf = io.BytesIO()
+    image.save( buf,
+                format=img_format,
+                quality=img_quality,
+                **IMG_SAVE_OPTIONS.get(img_format.upper(), {}) )
+    return buf.getvalue()
+
+
+def fit_settings( estimate,
+                  max_bytes:float,
+                  img_quality:int ) -> tuple:
+    """
+    Returns the (quality, scale) to re-encode at, for which `estimate(quality, 
+    scale)` is no more than `max_bytes`:  the largest scale (full scale, or else
+    one of `BUDGET_SCALES`) at which the lowest quality fits, with the highest
+    quality below `img_quality` that fits at that scale (found by bisection).
+    If nothing fits, returns the lowest quality at the smallest scale.
+    """
+    for scale in [1.0] + BUDGET_SCALES:
+        lo, hi = BUDGET_MIN_QUALITY, img_quality - 1
+        if scale < 1.0:
+            # (Smaller stills may keep the original quality.)
+            hi = img_quality
+        if hi >= lo and estimate(lo, scale) <= max_bytes:
+            # invariant:  `lo` fits
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if estimate(mid, scale) <= max_bytes:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            return lo, scale
+    return BUDGET_MIN_QUALITY, BUDGET_SCALES[-1]
+
+
+def fit_image_budget( stills:list,
+                      img_format:str = IMG_FORMAT,
+                      img_quality:int = IMG_QUALITY,
+                      total_bytes:int = None,
+                      max_img_bytes:int = None,
+                      overhead:float = 1.0 ) -> tuple:
+    """
+    Re-encodes stills (a list of encoded image data, in the given format and
+    quality) as needed to fit a byte budget:  no still bigger than `max_img_bytes`,
+    and all the stills together no bigger than `total_bytes` (either may be None).
+    Sizes are multiplied by `overhead` before comparing them to the budget (e.g.,
+    4/3 for stills embedded as base64).
+
+    The quality is lowered first, and then, if even `BUDGET_MIN_QUALITY` is not
+    enough, the dimensions.  For a still over the per-still cap, the quality is
+    found by bisection on that still.  For the total, one quality (and scale) is
+    found for all the stills, by bisection, estimating sizes from a sample of
+    the stills.
+
+    Returns a tuple of
+      list of the image data for the stills (unchanged ones are passed through)
+      dictionary reporting the sizes before and after, the quality and scale
+      chosen for the total (or None if unchanged), the lowest quality and scale
+      used for any still, the number of stills re-encoded, and whether the
+      budget was met
+    """
+    originals = stills
+    stills = list(stills)
+    report = { "original_bytes": round( sum( len(s) for s in stills ) * overhead ),
+               "quality": None,
+               "scale": None,
+               "min_quality": img_quality,
+               "min_scale": 1.0,
+               "reencoded": 0 }
+
+    def size( img_data ):
+        return len(img_data) * overhead
+
+    def note( quality, scale ):
+        report["min_quality"] = min( report["min_quality"], quality )
+        report["min_scale"] = min( report["min_scale"], scale )
+
+    # Cap each still
+    if max_img_bytes:
+        for snum, img_data in enumerate(stills):
+            if size(img_data) > max_img_bytes:
+                image = Image.open(io.BytesIO(img_data))
+                image.load()
+                encoded = {}
+                def estimate( quality, scale ):
+                    if (quality, scale) not in encoded:
+                        encoded[(quality, scale)] = _reencode(image, img_format, quality, scale)
+                    return size(encoded[(quality, scale)])
+                quality, scale = fit_settings( estimate, max_img_bytes, img_quality )
+                stills[snum] = encoded[(quality, scale)]
+                note( quality, scale )
+
+    # Fit the total, with the same settings for every still
+    if total_bytes and sum( size(s) for s in stills ) > total_bytes:
+        images = []
+        for img_data in stills:
+            image = Image.open(io.BytesIO(img_data))
+            image.load()
+            images.append(image)
+
+        # Estimate the total from an evenly spaced sample, in proportion to the
+        # current sizes of the stills in the sample
+        step = max( 1, len(stills) // BUDGET_SAMPLE )
+        sample = list(range(0, len(stills), step))
+        current_total = sum( size(s) for s in stills )
+        current_sample = sum( size(stills[i]) for i in sample )
+        sample_sizes = {}
+        def estimate( quality, scale ):
+            if (quality, scale) not in sample_sizes:
+                sample_sizes[(quality, scale)] = sum( size(_reencode(images[i], img_format, quality, scale))
+                                                      for i in sample )
+            return current_total * sample_sizes[(quality, scale)] / current_sample
+
+        # (The estimate may be off, so aim lower until the real total fits.)
+        target = total_bytes
+        for _ in range(4):
+            quality, scale = fit_settings( estimate, target, img_quality )
+            # (Stills already smaller than they would be re-encoded are kept.)
+            refit = [ _reencode(image, img_format, quality, scale) for image in images ]
+            refit = [ new if len(new) < len(old) else old for new, old in zip(refit, stills) ]
+            if sum( size(s) for s in refit ) <= total_bytes or (quality, scale) == (BUDGET_MIN_QUALITY, BUDGET_SCALES[-1]):
+                break
+            target *= total_bytes / sum( size(s) for s in refit )
+        stills = refit
+        report["quality"] = quality
+        report["scale"] = scale
+        note( quality, scale )
+
+    report["reencoded"] = sum( 1 for new, old in zip(stills, originals) if new is not old )
+    final = sum( size(s) for s in stills )
+    report["final_bytes"] = round(final)
+    report["met"] = ( (not total_bytes or final <= total_bytes) and
+                      (not max_img_bytes or all( size(s) <= max_img_bytes for s in stills )) )
+    return stills, report
+
+
+# Define helper functions for finding the frames for target times
+class EncodePool:
+    """
+    A bounded pool of threads for preparing and encoding stills while decoding 
+    continues.  (FFmpeg's scaler and Pillow's encoders release the GIL, so this 
+    work overlaps with decoding.)  
+
+    `submit` returns a `concurrent.futures.Future`.  No more than twice as many
+    tasks as threads are queued or running at once; when that many are, `submit` 
+    waits for the oldest one to finish.  (This limits the number of decoded 
+    frames held in memory.)  With 0 threads, each task is run when it is submitted.
+
+    Use as a context manager, or call `close` when done.  Either way waits for 
+    all tasks to finish, and raises the first exception raised by a task, if any.
+    """
+
+    def __init__( self,
+                  threads:int = ENCODE_THREADS ):
+        self.threads = threads
+        self.max_pending = 2 * threads
+        self.pending = collections.deque()
+        self.executor = None
+        if threads > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def submit( self, fn, *args ) -> concurrent.futures.Future:
+        if self.executor is None:
+            future = concurrent.futures.Future()
+            future.set_result( fn(*args) )
+            return future
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        future = self.executor.submit(fn, *args)
+        self.pending.append(future)
+        return future
+
+    def close( self ):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            while self.pending:
+                self.pending.popleft().result()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc, tb ):
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        return False
+
+
+def set_decode_threads( video_stream,
+                        thread_type:str = DECODE_THREAD_TYPE,
+                        thread_count:int = DECODE_THREADS ):
+    """
+    Configures multi-threaded decoding for a video stream.  `thread_type` is one 
+    of `DECODE_THREAD_TYPES`, and `thread_count` is the number of threads (or 0 
+    for as many as FFmpeg thinks best).  
+
+    This must be called before the first packet of the stream is decoded.
+    """
+    if thread_type not in DECODE_THREAD_TYPES:
+        raise ValueError(f"Invalid decode thread type: {thread_type}")
+    video_stream.codec_context.thread_type = thread_type.upper()
+    video_stream.codec_context.thread_count = thread_count
+
+
+def lowres_factor( codec_name:str,
+                   width:int,
+                   height:int,
+                   sar:float,
+                   stretch_threshold:float = STRETCH_THRESHOLD,
+                   max_img_height:int = None ) -> int:
+    """
+    Returns the largest factor (see `LOWRES_CODECS`) at which frames of the given
+    size could be decoded and still be big enough for their stills (see 
+    `still_geometry`) in both dimensions.  
+
+    Returns 0 (decode at full resolution) for codecs that cannot decode at reduced
+    resolution, and when stills are not scaled down by at least a factor of 
+    `LOWRES_MIN_FACTOR`.
+    """
+    if max_img_height is None:
+        return 0
+    still_width, still_height = still_geometry( width, height, sar, stretch_threshold, max_img_height )
+    for factor in range( LOWRES_CODECS.get(codec_name, 0), LOWRES_MIN_FACTOR - 1, -1 ):
+        # (FFmpeg rounds reduced sizes up.)
+        reduced = still_geometry( -(-width >> factor), -(-height >> factor), sar, stretch_threshold )
+        if reduced[0] >= still_width and reduced[1] >= still_height:
+            return factor
+    return 0
+
+
+def set_lowres( video_stream,
+                factor:int ):
+    """
+    Configures a video stream to be decoded at reduced resolution (by the given
+    factor; see `lowres_factor`).  A factor of 0 leaves it at full resolution.
+
+    This must be called before the first packet of the stream is decoded.
+    """
+    if factor > 0:
+        codec_context = video_stream.codec_context
+        codec_context.options = { **codec_context.options, "lowres": str(factor) }
+
+
+def probe_gop( video_path:str, 
+               max_keyframes:int = 32, 
+               max_packets:int = 5000 ):
+    """
+    Returns an estimate of the GOP duration (the interval between keyframes) in ms 
+    for the first video stream of a media file, based on the keyframes among the 
+    first packets of the stream.  (This only demuxes; it does not decode.)
+
+    Returns None if fewer than two keyframes are found, or if the file cannot be
+    demuxed.
+    """
+    keyframe_times = []
+    try:
+        with av.open(video_path) as container:
+            video_stream = next((s for s in container.streams if s.type == 'video'), None)
+            if video_stream is None:
+                return None
+            for pnum, packet in enumerate(container.demux(video_stream)):
+                if packet.is_keyframe and packet.pts is not None:
+                    keyframe_times.append( float(packet.pts * video_stream.time_base) * 1000 )
+                if len(keyframe_times) >= max_keyframes or pnum >= max_packets:
+                    break
+    except av.error.FFmpegError as e:
+        logging.debug(f"Could not probe GOP structure of {video_path}: {e}")
+        return None
+
+    keyframe_times.sort()
+    if len(keyframe_times) < 2:
+        return None
+    return median( [ b - a for a, b in zip(keyframe_times, keyframe_times[1:]) ] )
+
+
+def plan_seeks( target_times:list, 
+                gop_ms:float,
+                min_gap_gops:float = AUTO_SEEK_GOPS ) -> list:
+    """
+    Given sorted target times, returns a list with a boolean for each one, saying
+    whether to seek to get to that target (True), or to decode forward from the
+    previous target (False).
+
+    Seeking is planned for gaps longer than `min_gap_gops` GOPs.  (Decoding across
+    a gap costs a decode for every frame in it, while seeking costs about half a
+    GOP of decodes, plus the overhead of the seek.)  If `gop_ms` is None, no 
+    seeking is planned.
+    """
+    plan = []
+    prev_time = 0
+    for target_time in target_times:
+        plan.append( gop_ms is not None and (target_time - prev_time) > min_gap_gops * gop_ms )
+        prev_time = target_time
+    return plan
+
+
+def is_seekable( container ) -> bool:
+    """
+    Returns whether the container's format is one in which seeking finds the same
+    frames as decoding from the start (see `SEEK_FORMATS`).
+    """
+    return any( f in SEEK_FORMATS for f in container.format.name.split(",") )
+
+
+def _seek_before( container, 
+                  video_stream, 
+                  before_ms:float ):
+    """
+    Seeks to the last keyframe strictly before the time `before_ms`.  
+    """
+    # stream timestamp strictly before the given time
+    offset = math.ceil( Fraction(before_ms) / 1000 / video_stream.time_base ) - 1
+    if video_stream.start_time is not None:
+        offset = max( offset, video_stream.start_time )
+    container.seek( max(offset, 0), backward=True, any_frame=False, stream=video_stream )
+
+
+# Number of times to retry a seek that overshoots its target (the last retry goes 
+# back to where the previous target was found)
+_MAX_SEEK_RETRIES = 4
+
+
+def _keyframe_lookahead( demuxed,
+                         time_base ):
+    """
+    Generates (packet, time in ms of the next keyframe packet) for the packets
+    from `demuxed`, reading ahead to the next keyframe.  The time is None after
+    the last keyframe.
+    """
+    gop = []
+    for packet in demuxed:
+        if packet.is_keyframe and packet.pts is not None and gop:
+            keyframe_ms = float(packet.pts * time_base) * 1000
+            for p in gop:
+                yield p, keyframe_ms
+            gop = []
+        gop.append(packet)
+    for p in gop:
+        yield p, None
+
+
+def iter_target_frames( container, 
+                        video_stream,
+                        target_times:list,
+                        strategy:str = "linear",
+                        tolerance:int = 0,
+                        gop_ms:float = None,
+                        errors:tuple = (av.error.InvalidDataError,),
+                        on_error = None,
+                        stats:dict = None,
+                        skip_frames:str = "none",
+                        skip_window:int = SKIP_WINDOW ):
+    """
+    Generates a (target time, frame time, frame) tuple for each distinct target 
+    time (in ms), in order of target time, where the frame is the first frame 
+    whose time in ms is no earlier than `tolerance` ms before the target time.
+    Target times after the end of the video get no frame.
+
+    `strategy` is one of `EXTRACT_STRATEGIES`.  For "seek" and "auto", `gop_ms`
+    is the GOP duration of the stream; if it is not given, it is found with 
+    `probe_gop`.  (If the GOP duration cannot be found, frames are decoded linearly.)
+
+    Every strategy finds the same frame as decoding from the start would.  Seeking
+    is only done in container formats listed in `SEEK_FORMATS`.  After each seek, 
+    the first frame decoded must be before the target; if it is not, the seek is
+    retried from further back in the video.
+
+    `skip_frames` is one of `SKIP_FRAMES_LEVELS`.  It sets the decoder to skip 
+    frames while the next target is still far away.  The decision is made per 
+    packet, from the packet's own timestamp, so frame reordering does not matter:
+      "nonref" skips non-reference frames in packets more than `skip_window` ms
+      before the next target.  (No frame refers to these, so they cannot affect
+      the frames chosen.)
+      "nonkey" also skips non-keyframes in GOPs whose following keyframe is more
+      than `skip_window` ms before the next target.  (The GOP containing the 
+      target is always fully decoded.  This reads ahead one GOP of packets to find
+      the following keyframe.)
+    Packets without timestamps are always fully decoded.
+
+    Exceptions of the types in `errors` raised while decoding a packet are passed,
+    with the time of the last frame decoded, to `on_error` (if given), and the 
+    packet is skipped.
+
+    If a `stats` dictionary is passed, counts of "frames_decoded", "seeks", and 
+    "packets_skipping" (packets decoded with frame skipping on) are added to it.
+    """
+
+    if strategy not in EXTRACT_STRATEGIES:
+        raise ValueError(f"Invalid extraction strategy: {strategy}")
+    if skip_frames not in SKIP_FRAMES_LEVELS:
+        raise ValueError(f"Invalid frame skipping level: {skip_frames}")
+
+    if stats is None:
+        stats = {}
+    stats.setdefault("frames_decoded", 0)
+    stats.setdefault("seeks", 0)
+    stats.setdefault("packets_skipping", 0)
+
+    times = sorted(set(target_times))
+    if len(times) == 0:
+        return
+
+    seekable = is_seekable(container)
+    if strategy != "linear" and not seekable:
+        logging.debug(f"Cannot seek exactly in '{container.format.name}' format. Decoding linearly.")
+
+    if strategy != "linear" and seekable and gop_ms is None:
+        gop_ms = probe_gop(container.name)
+
+    if strategy == "linear" or not seekable:
+        seeks = [ False ] * len(times)
+    elif strategy == "seek":
+        seeks = plan_seeks( times, gop_ms, min_gap_gops=1 )
+    else:
+        seeks = plan_seeks( times, gop_ms, min_gap_gops=AUTO_SEEK_GOPS )
+
+    # Packets, paired with the time of the next keyframe (when looking ahead)
+    def packets():
+        if skip_frames == "nonkey":
+            return _keyframe_lookahead( container.demux(video_stream), video_stream.time_base )
+        else:
+            return ( (packet, None) for packet in container.demux(video_stream) )
+
+    codec_context = video_stream.codec_context
+    skip_mode = "DEFAULT"
+    codec_context.skip_frame = skip_mode
+
+    ti = 0
+    target_time = times[ti]
+    ftime = 0
+    prev_ftime = None   # time of the last frame decoded before the most recent seek
+
+    # seek attempts for the current target (0 means no seek is pending or in progress)
+    attempts = 0
+    if seeks[ti]:
+        attempts = 1
+        _seek_before( container, video_stream, target_time - tolerance )
+        stats["seeks"] += 1
+    landing = attempts > 0
+
+    demuxed = packets()
+    while True:
+        try:
+            packet, next_keyframe_ms = next(demuxed)
+        except StopIteration:
+            break
+
+        # Set frame skipping for this packet
+        if skip_frames != "none":
+            new_mode = "DEFAULT"
+            if packet.pts is not None:
+                far_ms = target_time - tolerance - skip_window
+                if next_keyframe_ms is not None and next_keyframe_ms < far_ms:
+                    new_mode = "NONKEY"
+                elif float(packet.pts * video_stream.time_base) * 1000 < far_ms:
+                    new_mode = "NONREF"
+            if new_mode != skip_mode:
+                skip_mode = new_mode
+                codec_context.skip_frame = skip_mode
+            if skip_mode != "DEFAULT":
+                stats["packets_skipping"] += 1
 
-    # looping through packets instead of frames allows exception handling for each
-    # particular decode step.  This main loop originally iterated over frames in
-    # `container.decode(video_stream)`.
-    for packet in container.demux(video_stream):
         try:
             for frame in packet.decode():
-                # calculate the time of the frame
-                ftime = int(frame.time * 1000)   
-
-                # Grab the still for each target mentioned (even if it's the same still)
-                while ( ftime+15 >= target_time ):
-
-                    # Check for anamorphic and stretch if necessary
-                    if stretch:
-                        if sar > 1.0:
-                            # stretch the width
-                            new_width = int( sar * frame.width)
-                            new_height = frame.height
+                ftime = int(frame.time * 1000)
+                stats["frames_decoded"] += 1
+
+                if landing:
+                    landing = False
+                    if ftime + tolerance >= target_time and attempts <= _MAX_SEEK_RETRIES:
+                        # The seek overshot (possibly skipping the right frame).
+                        # Try again, seeking back further.
+                        if attempts < _MAX_SEEK_RETRIES:
+                            back_ms = gop_ms * (4 ** attempts)
+                            _seek_before( container, video_stream, target_time - tolerance - back_ms )
                         else:
-                            # stretch the height
-                            new_width = frame.width
-                            new_height = int(frame.height / sar)
-                        stretched_frame = frame.reformat( width=new_width, height=new_height )
-                    else:
-                        stretched_frame = frame
-
-                    ifilename =  f'{fname}_{length:08}_{target_time:08}_{ftime:08}' + "." + filetype_ext
-                    ipathname = stills_dir + ifilename
-                    stretched_frame.to_image().save(ipathname, format=IMG_FORMAT, quality=IMG_QUALITY)
-                    image_list.append(ifilename)
-                    stills_count += 1
-                    if ( stills_count >= len(time_points) ):
+                            # as a last resort, go back to where linear decoding left off 
+                            _seek_before( container, video_stream, 
+                                          (prev_ftime + 1) if prev_ftime is not None else 0 )
+                        demuxed = packets()
+                        attempts += 1
+                        stats["seeks"] += 1
+                        landing = True
+                        break
+                    attempts = 0
+
+                # Yield a frame for each target it satisfies (in case one frame is 
+                # the first frame after more than one target)
+                while ftime + tolerance >= target_time:
+                    yield target_time, ftime, frame
+                    ti += 1
+                    if ti >= len(times):
+                        codec_context.skip_frame = "DEFAULT"
+                        return
+                    target_time = times[ti]
+                    if seeks[ti] and ftime + tolerance < target_time:
+                        # skip ahead to the next target
+                        prev_ftime = ftime
+                        attempts = 1
+                        _seek_before( container, video_stream, target_time - tolerance )
+                        demuxed = packets()
+                        stats["seeks"] += 1
+                        landing = True
                         break
-                    else:
-                        target_time = time_points[stills_count]
-                fcount += 1
-
-        except Exception as e:
-            if last_packet_error != ftime:
-                logging.warning(f"{video_fname} at {ftime} ms: {e}")
-                last_packet_error = ftime
+                if landing:
+                    break
+
+        except errors as e:
+            if on_error is not None:
+                on_error(e, ftime)
+            continue  # Skip this packet and try the next one
+
+    codec_context.skip_frame = "DEFAULT"
+
+
+def iter_nearest_keyframes( container,
+                            video_stream,
+                            target_times:list,
+                            tolerance:int,
+                            errors:tuple = (av.error.InvalidDataError,),
+                            on_error = None,
+                            stats:dict = None ):
+    """
+    Generates a (target time, frame time, frame) tuple for each distinct target 
+    time (in ms) that has a keyframe within `tolerance` ms of it (before or after),
+    in order of target time, where the frame is the keyframe nearest the target.
+
+    Only keyframe packets are decoded, so this is much faster than finding exact
+    frames with `iter_target_frames`, but the frames found may come before their
+    targets.  Targets with no keyframe near enough get no frame.
+
+    Errors are handled as by `iter_target_frames`.  If a `stats` dictionary is
+    passed, counts of "keyframes_decoded", "within_tolerance", and "fallback" 
+    (targets with no frame) are added to it.
+    """
+
+    if stats is None:
+        stats = {}
+    stats.setdefault("keyframes_decoded", 0)
+    stats.setdefault("within_tolerance", 0)
+    stats.setdefault("fallback", 0)
+
+    times = sorted(set(target_times))
+    ti = 0
+
+    # the previous keyframe decoded, as (time, frame)
+    prev = None
+
+    def nearest( target_time, kf_ms, kf ):
+        # Chooses between the previous keyframe and the one at `kf_ms` 
+        # (if any), preferring the later one in case of a tie.
+        candidates = []
+        if kf is not None:
+            candidates.append( (kf_ms - target_time, kf_ms, kf) )
+        if prev is not None:
+            candidates.append( (target_time - prev[0], *prev) )
+        if candidates:
+            dist, ftime, frame = min( candidates, key=lambda c:c[0] )
+            if dist <= tolerance:
+                stats["within_tolerance"] += 1
+                return ftime, frame
+        stats["fallback"] += 1
+        return None
+
+    codec_context = video_stream.codec_context
+    codec_context.skip_frame = "NONKEY"
+
+    for packet in container.demux(video_stream):
+
+        # Send only keyframes to the decoder (and the empty packets that flush it)
+        if packet.size > 0 and not packet.is_keyframe:
             continue
 
-        finally:
-            # prevent this from running longer than necessary
-            if ( stills_count >= len(time_points) ):
-                break
+        ftime = prev[0] if prev is not None else 0
+        try:
+            frames = packet.decode()
+        except errors as e:
+            if on_error is not None:
+                on_error(e, ftime)
+            continue
 
-    if verbose: print("Extracted", stills_count, "stills out of", fcount, "video frames checked.") 
+        for frame in frames:
+            ftime = int(frame.time * 1000)
+            stats["keyframes_decoded"] += 1
 
-    container.close()
+            # Every target between the previous keyframe and this one gets the
+            # nearer of the two.
+            while ti < len(times) and times[ti] <= ftime:
+                found = nearest( times[ti], ftime, frame )
+                if found is not None:
+                    yield times[ti], *found
+                ti += 1
+            prev = (ftime, frame)
 
-    return image_list
+            if ti >= len(times):
+                codec_context.skip_frame = "DEFAULT"
+                return
+
+    # Targets after the last keyframe
+    while ti < len(times):
+        found = nearest( times[ti], None, None )
+        if found is not None:
+            yield times[ti], *found
+        ti += 1
 
+    codec_context.skip_frame = "DEFAULT"
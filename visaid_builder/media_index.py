@@ -0,0 +1,207 @@
+"""
+media_index.py
+
+Defines functions for an index of the video stream of a media file:  its stream
+parameters, its accurate duration, and the presentation timestamps of its packets
+and of its keyframes.
+
+The index is built by demuxing the whole video stream, without decoding it (which
+takes a fraction of a second, even for long videos).  This gives a duration even
+for containers that do not record a frame count (such as MPEG program and
+transport streams and Matroska), and tells seek planning where the keyframes are.
+
+Indexes are kept in memory for the rest of the process, and (optionally) saved on
+disk, either in a cache directory (named for a fingerprint of the media file; see
+`thumb_cache.media_fingerprint`, and counted and evicted along with the thumbnail
+entries there) or next to the media file.  Saved indexes written
+by a different version of this package, in a different format, or for a media
+file that has since changed, are ignored.
+
+The primary function here is `get_index`.
+"""
+
+import os
+import json
+import logging
+
+from fractions import Fraction
+from statistics import median
+from importlib.metadata import version
+
+import av
+
+__version__ = version("visaid_builder")
+from . import thumb_cache
+
+
+# Version of the structure of saved indexes
+INDEX_FORMAT = 1
+
+# Suffix for indexes saved next to their media files
+SIDECAR_SUFFIX = ".mindex.json"
+
+# Indexes built or loaded by this process, keyed by (real path, size, mtime)
+_INDEXES = {}
+
+
+def build_index( video_path:str ) -> dict:
+    """
+    Demuxes the first video stream of a media file and returns its index, a
+    dictionary of
+      "format", "codec" - names of the container format and the video codec (as
+      for FFmpeg)
+      "width", "height" - coded frame size
+      "fps" - average frame rate (or None if unknown)
+      "sar" - sample aspect ratio (or None if unknown)
+      "time_base" - [numerator, denominator] of the stream time base
+      "start_ms", "duration_ms" - start time and duration of the video, from the
+      timestamps of its packets
+      "frames" - number of packets with timestamps (normally one per frame)
+      "packet_pts" - sorted presentation timestamps of the packets (in time base
+      units)
+      "keyframe_pts" - sorted presentation timestamps of the keyframes
+    """
+    with av.open(video_path) as container:
+        video_stream = next((s for s in container.streams if s.type == 'video'), None)
+        if video_stream is None:
+            raise Exception("No video stream found in {}".format(video_path) )
+
+        packet_pts = []
+        keyframe_pts = []
+        end_pts = None
+        for packet in container.demux(video_stream):
+            if packet.pts is None:
+                continue
+            packet_pts.append(packet.pts)
+            if packet.is_keyframe:
+                keyframe_pts.append(packet.pts)
+            packet_end = packet.pts + (packet.duration or 0)
+            if end_pts is None or packet_end > end_pts:
+                end_pts = packet_end
+
+        time_base = video_stream.time_base
+        packet_pts.sort()
+        keyframe_pts.sort()
+        if packet_pts:
+            start_ms = float(packet_pts[0] * time_base) * 1000
+            duration_ms = float((end_pts - packet_pts[0]) * time_base) * 1000
+        else:
+            start_ms = duration_ms = 0.0
+
+        fps = video_stream.average_rate
+        sar = video_stream.sample_aspect_ratio
+        return { "format": container.format.name,
+                 "codec": video_stream.codec_context.name,
+                 "width": video_stream.codec_context.width,
+                 "height": video_stream.codec_context.height,
+                 "fps": float(fps) if fps else None,
+                 "sar": float(sar) if sar is not None else None,
+                 "time_base": [ time_base.numerator, time_base.denominator ],
+                 "start_ms": start_ms,
+                 "duration_ms": duration_ms,
+                 "frames": len(packet_pts),
+                 "packet_pts": packet_pts,
+                 "keyframe_pts": keyframe_pts }
+
+
+def index_path( video_path:str,
+                cache_dir:str = None,
+                fingerprint:str = None ) -> str:
+    """
+    Returns the path where the index for a media file is saved:  in `cache_dir`,
+    named for the fingerprint of the media file, or, if `cache_dir` is None, next
+    to the media file.
+    """
+    if cache_dir:
+        if fingerprint is None:
+            fingerprint = thumb_cache.media_fingerprint(video_path)
+        return os.path.join( cache_dir, f"mindex_{fingerprint}.json" )
+    else:
+        return video_path + SIDECAR_SUFFIX
+
+
+def get_index( video_path:str,
+               cache_dir:str = None,
+               next_to_media:bool = False ) -> dict:
+    """
+    Returns the index of a media file (see `build_index`), from memory or disk if
+    it has already been built, and otherwise by building it.
+
+    Newly built indexes are saved in `cache_dir` if given, or else next to the
+    media file if `next_to_media` is True.  (If neither, the index is only kept
+    in memory.)  Failures to save are logged and otherwise ignored.
+    """
+    st = os.stat(video_path)
+    mem_key = ( os.path.realpath(video_path), st.st_size, st.st_mtime_ns )
+    if mem_key in _INDEXES:
+        return _INDEXES[mem_key]
+
+    path = None
+    fingerprint = None
+    if cache_dir or next_to_media:
+        fingerprint = thumb_cache.media_fingerprint(video_path)
+        path = index_path(video_path, cache_dir, fingerprint)
+
+    index = None
+    if path and os.path.isfile(path):
+        try:
+            with open(path, "r") as index_file:
+                saved = json.load(index_file)
+            if ( saved["version"] == __version__ and
+                 saved.get("format") == INDEX_FORMAT and
+                 saved.get("fingerprint") == fingerprint ):
+                index = saved["index"]
+                logging.debug(f"Using saved media index for {video_path}")
+                # touch the index, so that it counts as recently used (see
+                # `thumb_cache.evict`)
+                os.utime(path)
+        except Exception as e:
+            logging.warning(f"Warning: Ignoring unreadable media index {path}: {e}")
+
+    if index is None:
+        index = build_index(video_path)
+        if path:
+            saved = { "version": __version__,
+                      "format": INDEX_FORMAT,
+                      "fingerprint": fingerprint,
+                      "media_path": video_path,
+                      "index": index }
+            try:
+                if cache_dir and not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w") as index_file:
+                    json.dump(saved, index_file)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logging.warning(f"Warning: Could not save media index {path}: {e}")
+
+    _INDEXES[mem_key] = index
+    return index
+
+
+def media_length( index:dict ) -> int:
+    """
+    Returns the duration (in ms) of the video in an index
+    """
+    return int(index["duration_ms"])
+
+
+def keyframe_times( index:dict ) -> list:
+    """
+    Returns the presentation times (in ms) of the keyframes in an index
+    """
+    time_base = Fraction(*index["time_base"])
+    return [ float(pts * time_base) * 1000 for pts in index["keyframe_pts"] ]
+
+
+def gop_ms( index:dict ) -> float:
+    """
+    Returns the median interval (in ms) between keyframes in an index, as an
+    estimate of the GOP duration (see `lilhelp.probe_gop`).  Returns None if
+    there are fewer than two keyframes.
+    """
+    times = keyframe_times(index)
+    if len(times) < 2:
+        return None
+    return median( [ b - a for a, b in zip(times, times[1:]) ] )
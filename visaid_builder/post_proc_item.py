@@ -21,6 +21,28 @@ bother to set a proxy start time if the computed value is less than this.)
 look for the main program slate after this point. And we won't assign a proxy 
 start time after this point.)
 
+`mmif_loader` - How to read the MMIF file; one of `proc_swt.MMIF_LOADERS`.
+
+`swt_cache_dir` - Directory in which to cache the data read from MMIF files (see 
+the `swt_cache` module).  If None, no cache is used.
+
+`thumb_cache_dir` - Directory in which to cache the stills extracted from media
+files (see the `thumb_cache` module), along with the index of each media file
+(see the `media_index` module), so that re-running on the same media skips
+decoding frames already extracted.  If None, no cache is used.
+
+`media_index_dir` - Directory in which to save the index of each media file (see
+the `media_index` module), which otherwise takes a full read of the media file to
+build.  If None, indexes are saved in `thumb_cache_dir` (if any).
+
+`media_index_next_to_media` - Whether to save the index of each media file next 
+to the media file (as "<media file>.mindex.json"), if there is no directory for
+indexes.
+
+`shared_decode` - Whether to extract the stills for all the artifacts that need 
+them (slates, reps, visaids, cataids) in one pass through the media file (see 
+the `frame_plan` module), rather than once for each artifact.
+
 """
 
 # %%
@@ -33,8 +55,6 @@ import datetime
 
 from statistics import mean, median
 
-from mmif import Mmif
-
 from pprint import pprint # DIAG
 
 from importlib.metadata import version
@@ -42,8 +62,11 @@ from importlib.metadata import version
 __version__ = version("visaid_builder")
 from . import lilhelp
 from . import proc_swt
+from . import swt_cache
 from . import create_visaid
 from . import create_cataid
+from . import frame_plan
+from . import thumb_cache
 
 
 # These are the defaults specific to routines defined in this module.
@@ -52,7 +75,13 @@ POSTPROC_DEFAULTS = { "name": None,
                       "prog_start_min": 3000,
                       "prog_start_max": 150000,
                       "slate_rep_max": 180000,
-                      "adj_tfs": True }
+                      "adj_tfs": True,
+                      "mmif_loader": "mmif",
+                      "swt_cache_dir": None,
+                      "thumb_cache_dir": None,
+                      "media_index_dir": None,
+                      "media_index_next_to_media": False,
+                      "shared_decode": True }
 
 # Names of the artifact types that this module can create
 VALID_ARTIFACTS = [ "data", 
@@ -154,28 +183,30 @@ def run_post( item:dict,
     # Perform foundational processing of MMIF file
     #
     
-    # Open MMIF and start processing
+    # Open MMIF and call SWT MMIF processors to get a table of time frames
     mmif_path = item["mmif_paths"][-1]
-    with open(mmif_path, "r") as file:
-        mmif_str = file.read()
-
-    usemmif = Mmif(mmif_str)
-
-    # Get the right views
-    tp_view_id, tf_view_id = proc_swt.get_swt_view_ids(usemmif)
-    td_view_id = proc_swt.get_td_view_id(usemmif)
-
-    # call SWT MMIF processors to get a table of time frames
 
     print(ins + "Attempting to process MMIF into SWT scene list...")
 
-    tfsd = proc_swt.tfsd_from_mmif( usemmif, 
-                                    tp_view_id,
-                                    tf_view_id,
-                                    td_view_id )
-
-    # find the outer temporal boundaries of the TimePoint analysis
-    first_time, final_time = proc_swt.first_final_time_in_mmif( usemmif, tp_view_id=tp_view_id )
+    hits_before = swt_cache.CACHE_STATS["hits"]
+    swt = swt_cache.cached_load_swt( mmif_path, 
+                                     pp_params["swt_cache_dir"], 
+                                     loader=pp_params["mmif_loader"] )
+    tfsd = swt["tfsd"]
+    if pp_params["swt_cache_dir"]:
+        cache_result = "hit" if swt_cache.CACHE_STATS["hits"] > hits_before else "miss"
+        cinfo = swt_cache.cache_info(pp_params["swt_cache_dir"])
+        print(ins + f'  * SWT cache {cache_result} ({cinfo["hits"]} hits, {cinfo["misses"]} misses; {cinfo["entries"]} entries)')
+
+    # the outer temporal boundaries of the TimePoint analysis
+    first_time, final_time = swt["first_time"], swt["final_time"]
+
+    # report annotations that could not be joined
+    for kind in proc_swt.JOIN_PROBLEMS:
+        count = len([ p for p in swt["problems"] if p["problem"] == kind ])
+        if count:
+            print(ins + f"  * Warning: {count} x {kind}: {proc_swt.JOIN_PROBLEMS[kind]}")
+            problems.append("swt:" + kind)
 
     # print some stats
     print(ins + "  * SWT scene list length:", len(tfsd) )
@@ -198,21 +229,13 @@ def run_post( item:dict,
         dur = max( [ t["end"] - t["start"] for t in tfsd ] )
         print(ins + f"  * Max SWT scene length:    {lilhelp.tconv(dur)} ({dur} ms)" )
 
-        overlaps = proc_swt.find_overlaps( tfsd )
-        print(ins + "  * Number of scene overlaps: " + str(len(overlaps)) )
-        if overlaps:
-            # dur = int( mean( [ t["dur"] for t in overlaps ] ) )
-            # print(ins + f"  * Mean overlap length:   {lilhelp.tconv(dur)} ({dur} ms)" )
-
-            dur = int( median( [ t["dur"] for t in overlaps ] ) )
+        ovs = proc_swt.overlap_stats( tfsd )
+        print(ins + "  * Number of scene overlaps: " + str(ovs["count"]) )
+        if ovs["count"]:
+            dur = int( ovs["median_dur"] )
             print(ins + f"  * Median overlap length: {lilhelp.tconv(dur)} ({dur} ms)" )
 
-            # dur = max( [ t["dur"] for t in overlaps ] )
-            # print(ins + f"  * Max overlap length:    {lilhelp.tconv(dur)} ({dur} ms)" )
-
-            movls = sorted(overlaps, key=lambda t:t["dur"], reverse=True)
-            movl = movls[0]
-            print(ins + f'  * Max overlap at {lilhelp.tconv(movl["start"])} ({movl["start"]} ms) for {lilhelp.tconv(movl["dur"])} ({movl["dur"]} ms).')
+            print(ins + f'  * Max overlap at {lilhelp.tconv(ovs["max_start"])} ({ovs["max_start"]} ms) for {lilhelp.tconv(ovs["max_dur"])} ({ovs["max_dur"]} ms).')
 
     # Create an adjusted TimeFrame table (with scenes added and/or removed)
     if pp_params["adj_tfs"] and len(tfsd) and final_time is not None:
@@ -226,15 +249,87 @@ def run_post( item:dict,
         tfsd_adj = tfsd[:]
 
 
-    # create legacy tfs tables from tfsd tables
-    tfs = proc_swt.tfsd_to_tfs(tfsd)
-    tfs_adj = proc_swt.tfsd_to_tfs(tfsd_adj)
-
     # get mmif_metadata_str
-    mmif_metadata_str = proc_swt.get_mmif_metadata_str( usemmif,
-                                                        tp_view_id,
-                                                        tf_view_id,
-                                                        td_view_id )
+    mmif_metadata_str = swt["mmif_metadata_str"]
+
+
+    # The slate rep is the rep timepoint from from the first slate timeframe
+    # If there is not slate timeframe, then the value is None
+    slate_rep = None
+    slate_tfs = [ tf for tf in tfsd if tf["tf_label"] in SLATE_BINS ]
+    if len(slate_tfs) > 0:
+        slate_rep = int(slate_tfs[0]["tp_time"])
+
+    # Representative still times from the adjusted TimeFrame table
+    tps = sorted(set( tf["tp_time"] for tf in tfsd_adj ))
+
+
+    ########################################################################
+    # PLAN EXTRACTION OF STILLS
+    ########################################################################
+
+    # Each artifact that needs stills registers the times it needs (and how its
+    # stills are to be scaled and encoded), so that one pass through the media 
+    # file serves them all.  If this fails, each artifact extracts its own stills.
+    plan = None
+    if pp_params["shared_decode"]:
+        plan = frame_plan.FramePlan( item["media_path"], 
+                                     cache_dir=pp_params["thumb_cache_dir"],
+                                     index_dir=pp_params["media_index_dir"],
+                                     index_next_to_media=pp_params["media_index_next_to_media"] )
+
+        # slates and reps are extracted as by `lilhelp.extract_stills`
+        if ( "slates" in artifacts and slate_rep is not None and 
+             slate_rep <= pp_params["slate_rep_max"] ):
+            plan.request( "slates", [ slate_rep ], tolerance=15 )
+        if "reps" in artifacts and len(tps) > 0:
+            plan.request( "reps", tps, tolerance=15 )
+
+        # visaids and cataids are extracted as by `create_visaid.extract_images`
+        # (using the visaid options for how to decode)
+        vparams = { **create_visaid.VISAID_DEFAULTS, **visaid_params }
+        cparams = { **create_cataid.CATAID_DEFAULTS, **cataid_params }
+        vformat, vquality = create_visaid.img_settings( vparams["img_format"], vparams["img_profile"] )
+        cformat, cquality = create_visaid.img_settings( cparams["img_format"], cparams["img_profile"] )
+        if "visaids" in artifacts:
+            plan.request( "visaids", tps,
+                          stretch_threshold=create_visaid.STRETCH_THRESHOLD,
+                          max_img_height=vparams["max_img_height"],
+                          img_format=vformat,
+                          img_quality=vquality,
+                          preview_tolerance=(vparams["preview_tolerance"] if vparams["preview"] else None),
+                          interpolation=vparams["interpolation"],
+                          encoder=vparams["img_encoder"] )
+        if "cataids" in artifacts:
+            plan.request( "cataids", tps,
+                          stretch_threshold=create_cataid.STRETCH_THRESHOLD,
+                          max_img_height=cparams["max_img_height"],
+                          img_format=cformat,
+                          img_quality=cquality,
+                          interpolation=cparams["interpolation"],
+                          encoder=cparams["img_encoder"] )
+
+        if len(plan.requests) > 0:
+            print(ins + "Attempting to extract stills for " + ", ".join(plan.requests) + "...")
+            try:
+                plan.run( strategy=vparams["extract_strategy"],
+                          skip_frames=vparams["skip_frames"],
+                          skip_window=vparams["skip_window"],
+                          thread_type=vparams["decode_thread_type"],
+                          thread_count=vparams["decode_threads"],
+                          workers=vparams["decode_workers"],
+                          encode_threads=vparams["encode_threads"],
+                          lowres=vparams["lowres_decode"] )
+                print(ins + f'Extracted stills in one pass ({plan.stats.get("frames_decoded", 0)} frames decoded, {plan.stats.get("seeks", 0)} seeks).')
+                if pp_params["thumb_cache_dir"]:
+                    cinfo = thumb_cache.cache_info(pp_params["thumb_cache_dir"])
+                    print(ins + f'  * Thumbnail cache: {cinfo["hits"]} hits, {cinfo["misses"]} misses; {cinfo["entries"]} entries')
+            except Exception as e:
+                print(ins + "Shared extraction of stills failed.  Will try for each artifact.")
+                print(ins + "Error:", e)
+                plan = None
+        else:
+            plan = None
 
 
     ########################################################################
@@ -249,24 +344,22 @@ def run_post( item:dict,
         print(ins + "Attempting to save a slate...")
         slates_dir = artifacts_dir + "/" + artifact
 
-        # The slate rep is the rep timepoint from from the first slate timeframe
-        # If there is not slate timeframe, then the value is None
-        slate_rep = None
-        slate_tfs = [ tf for tf in tfs if tf[1] in SLATE_BINS ]
-        if len(slate_tfs) > 0:
-            slate_rep = int(slate_tfs[0][4])
-
         if slate_rep is not None :
             if slate_rep > pp_params["slate_rep_max"]:
                 print(ins + f'Detected slate occurs beyond {pp_params["slate_rep_max"]}ms.  Will not save.')
             else: 
                 try:
-                    slates = lilhelp.extract_stills( 
-                            item["media_path"], 
-                            [ slate_rep ], 
-                            item["asset_id"],
-                            slates_dir,
-                            verbose=False )
+                    if plan is not None:
+                        slates = plan.save_stills( "slates", item["asset_id"], slates_dir )
+                    else:
+                        slates = lilhelp.extract_stills( 
+                                item["media_path"], 
+                                [ slate_rep ], 
+                                item["asset_id"],
+                                slates_dir,
+                                verbose=False,
+                                index_dir=(pp_params["media_index_dir"] or pp_params["thumb_cache_dir"]),
+                                index_next_to_media=pp_params["media_index_next_to_media"] )
                     if len(slates) == 1:
                         print(ins + "Slate saved.")
                     else:
@@ -292,18 +385,19 @@ def run_post( item:dict,
         print(ins + "Attempting to save representative stills...")
         reps_dir = artifacts_dir + "/" + artifact
 
-        if len(tfs_adj) > 0:
-            tps = [ tf[4] for tf in tfs_adj ] 
-            tps = list(set(tps))
-            tps.sort()
-
+        if len(tfsd_adj) > 0:
             try:
-               rep_images = lilhelp.extract_stills( 
-                  item["media_path"], 
-                  tps, 
-                  item["asset_id"],
-                  reps_dir,
-                  verbose=False )
+               if plan is not None:
+                  rep_images = plan.save_stills( "reps", item["asset_id"], reps_dir )
+               else:
+                  rep_images = lilhelp.extract_stills( 
+                     item["media_path"], 
+                     tps, 
+                     item["asset_id"],
+                     reps_dir,
+                     verbose=False,
+                     index_dir=(pp_params["media_index_dir"] or pp_params["thumb_cache_dir"]),
+                     index_next_to_media=pp_params["media_index_next_to_media"] )
 
             except Exception as e:
                print(ins + "Extraction of frame failed.")
@@ -311,7 +405,7 @@ def run_post( item:dict,
                errors.append(pp_params["name"]+":"+"reps")
                rep_images = []
 
-            print(ins + "Saved", len(rep_images), "representative stills from", len(tfs_adj), "scenes.")
+            print(ins + "Saved", len(rep_images), "representative stills from", len(tfsd_adj), "scenes.")
 
         else:
             rep_images = []
@@ -345,8 +439,8 @@ def run_post( item:dict,
                 # extract the requersted frame time from the filename
                 tp = int(fname.split("_")[2])
 
-                # lookup label in tfs_adj array
-                label = [ tf[5] for tf in tfs_adj if tf[4] == tp ][0]
+                # lookup label in tfsd_adj array
+                label = [ (tf["tp_label"] or "") for tf in tfsd_adj if tf["tp_time"] == tp ][0]
 
                 if label.find(":") != -1:
                     label, sublabel = label.split(":")
@@ -429,7 +523,7 @@ def run_post( item:dict,
         try:
             visaid_path, visaid_problems, visaid_infos, visaid_extras = create_visaid.create_visaid( 
                 video_path=item["media_path"], 
-                tfs=tfs_adj, 
+                tfsd=tfsd_adj, 
                 stdout=False, 
                 output_dirname=visaids_dir,
                 job_id=cf["job_id"],
@@ -437,7 +531,11 @@ def run_post( item:dict,
                 item_id=item["asset_id"],
                 proc_swt_params=proc_swt_params,
                 visaid_params=visaid_params,
-                mmif_metadata_str=mmif_metadata_str
+                mmif_metadata_str=mmif_metadata_str,
+                stills=(plan.stills("visaids") if plan is not None else None),
+                thumb_cache_dir=pp_params["thumb_cache_dir"],
+                index_dir=pp_params["media_index_dir"],
+                index_next_to_media=pp_params["media_index_next_to_media"]
                 )
         except Exception as e:
             print(ins + "Creation of visaid failed.")
@@ -479,7 +577,11 @@ def run_post( item:dict,
                 proc_swt_params=proc_swt_params,
                 cataid_params=cataid_params,
                 mmif_metadata_str=mmif_metadata_str,
-                prompts_dir=cf["config_dir"]
+                prompts_dir=cf["config_dir"],
+                stills=(plan.stills("cataids") if plan is not None else None),
+                thumb_cache_dir=pp_params["thumb_cache_dir"],
+                index_dir=pp_params["media_index_dir"],
+                index_next_to_media=pp_params["media_index_next_to_media"]
                 )
         except Exception as e:
             print(ins + "Creation of cataid failed.")
@@ -529,17 +631,17 @@ def run_post( item:dict,
 
         # The end of the bars is the end of the last bars timeframe near the prog start
         bars_end = None
-        bars_tfs = [ tf for tf in tfs 
-                        if (tf[1] in BARS_BINS and tf[3] <= pp_params["prog_start_max"]) ]
+        bars_tfs = [ tf for tf in tfsd 
+                        if (tf["tf_label"] in BARS_BINS and tf["end"] <= pp_params["prog_start_max"]) ]
         if len(bars_tfs) > 0:
-            bars_end = int(bars_tfs[-1][3])
+            bars_end = int(bars_tfs[-1]["end"])
 
         # The beginning of the first slate timeframe near the prog start
         slate_begin = None
-        slate_tfs = [ tf for tf in tfs 
-                        if (tf[1] in SLATE_BINS and tf[3] <= pp_params["prog_start_max"]) ]
+        slate_tfs = [ tf for tf in tfsd 
+                        if (tf["tf_label"] in SLATE_BINS and tf["end"] <= pp_params["prog_start_max"]) ]
         if len(slate_tfs) > 0:
-            slate_begin = int(slate_tfs[0][2])
+            slate_begin = int(slate_tfs[0]["start"])
 
         # Proxy starts at the end of the bars or the beginning of the slate,
         # whichever is greater.
@@ -598,7 +700,7 @@ def run_post( item:dict,
                 "slate_begin_time": slate_begin_sec,
                 "proxy_start_time": proxy_start_sec
             },
-            "scene_data": tfsd
+            "scene_data": [ dict(tf) for tf in tfsd ]
         }]
         # print(data_artifact) # DIAG 
 
@@ -6,6 +6,17 @@ Defines functions that perform processing on MMIF output from SWT.
 The primary functions here are:
 `tfs_from_mmif` - creates a tfs array from an MMIF file
 `adjust_tfs` - makes adjustments to a tfs array
+`load_swt` - reads an MMIF file and returns the SWT data needed for visaids
+
+The functions that take a `Mmif` object also accept a `SwtViewIndex`, which 
+collects everything they need from an MMIF file in a single pass.  Building 
+one index and passing it to each function avoids re-scanning the file.
+
+`load_swt` can use either of the loaders in `MMIF_LOADERS`:
+    "mmif" - builds a full `Mmif` object from the file (the original approach)
+    "stream" - reads only the SWT and captioner annotations from the file, 
+    without building a `Mmif` object.  (Uses `ijson`, if available, to parse
+    the file incrementally.)
 
 The `adjust_tfs` function takes a parameter called `params_in` that tell it
 what adjustments to make.  These are the kinds of options specified by the
@@ -34,9 +45,13 @@ The valid keys for `params_in` are as follows:
 
 """
 
+import sys
 import json
 import logging
 from pprint import pprint 
+from bisect import bisect_left, bisect_right
+from statistics import median
+from urllib.parse import urlparse
 
 from mmif import Mmif
 from mmif import AnnotationTypes
@@ -44,6 +59,20 @@ from mmif import DocumentTypes
 
 from . import lilhelp
 
+# Use an incremental JSON parser for the "stream" loader, if available
+try:
+    import ijson
+    _IJSON = True
+except ImportError:
+    _IJSON = False
+
+# Use NumPy for bulk computation of samples in `adjust_tfsd`, if available
+try:
+    import numpy as np
+    _NUMPY = True
+except ImportError:
+    _NUMPY = False
+
 
 # These paramaters for which there are defaults are used by `adjust_tfs`.
 # These default values are used only if 
@@ -64,11 +93,425 @@ PROC_SWT_DEFAULTS = { "default_to_none": True,
                       "include_first_time": False,
                       "include_final_time": False }
 
+class Scene:
+    """
+    A row of a tfsd table: a scene (an SWT TimeFrame, or a sample or subsample
+    added by `adjust_tfsd`) with its representative time point.
+
+    Scenes use `__slots__`, and labels are interned, to keep long tables compact.
+    They also support dictionary-style access (`scene["start"]`, `keys()`, 
+    `get()`, `dict(scene)`), so code written for tfsd tables of dictionaries 
+    works unchanged.  `as_tfs_row()` gives the legacy tfs list view.
+    """
+
+    __slots__ = ( "tf_id", "tf_label", "start", "end", "td_id", "text",
+                  "tp_id", "tp_time", "tp_label" )
+
+    def __init__( self,
+                  tf_id:str,
+                  tf_label:str,
+                  start:int,
+                  end:int,
+                  tp_time:int,
+                  tp_label:str = None,
+                  tp_id:str = None,
+                  td_id:str = None,
+                  text:str = None ):
+        self.tf_id = tf_id
+        self.tf_label = sys.intern(tf_label) if isinstance(tf_label, str) else tf_label
+        self.start = start
+        self.end = end
+        self.tp_time = tp_time
+        self.tp_label = sys.intern(tp_label) if isinstance(tp_label, str) else tp_label
+        self.tp_id = tp_id
+        self.td_id = td_id
+        self.text = text
+
+    @classmethod
+    def from_tfs_row( cls, row:list ):
+        """
+        Creates a Scene from a row of a legacy tfs table
+        """
+        return cls( row[0], row[1], row[2], row[3], row[4], (row[5] or None) )
+
+    def as_tfs_row(self) -> list:
+        """
+        Returns the row of a legacy tfs table for this scene (see `tfsd_to_tfs`)
+        """
+        return [ self.tf_id, self.tf_label, self.start, self.end, self.tp_time, 
+                 (self.tp_label or "") ]
+
+    def keys(self):
+        return self.__slots__
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def __eq__(self, other):
+        if isinstance(other, (Scene, dict)):
+            return dict(self) == dict(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return "Scene(" + ", ".join( f"{k}={getattr(self, k)!r}" for k in self.__slots__ ) + ")"
+
+
+# Kinds of problems reported by `tfsd_from_mmif` when annotations cannot be joined
+JOIN_PROBLEMS = { "tp-missing": "TimeFrame refers to a TimePoint not found (ignored)",
+                  "tf-no-tps": "TimeFrame has no TimePoints found (TimeFrame skipped)",
+                  "tf-no-reps": "TimeFrame has no representatives found (chose among targets)",
+                  "td-unaligned": "TextDocument has no Alignment to a TimePoint",
+                  "td-orphan": "TextDocument origin is not a TimeFrame (ignored)" }
+
+# Valid values for the `loader` argument of `load_swt`
+MMIF_LOADERS = [ "mmif", "stream" ]
+
+# Annotation types and properties kept by the "stream" loader.  Everything else
+# (including, e.g., the classification scores of each TimePoint) is discarded as
+# the MMIF file is read.
+STREAM_ANN_TYPES = [ "TimePoint", "TimeFrame", "TextDocument", "Alignment" ]
+STREAM_ANN_PROPS = [ "id", "timePoint", "label", "frameType", "targets", 
+                     "representatives", "origin", "text", "source", "target" ]
+
+
+class SwtViewIndex:
+    """
+    Index of the parts of an MMIF file relevant to SWT processing, built once per 
+    MMIF file, so that the functions in this module do not each have to walk the 
+    views or annotations of the file again.
+
+    An index records:
+      `tp_view_id`, `tf_view_id`, `td_view_id` - IDs of the chosen views (or None)
+      `td_view_ids` - IDs of all the captioner views whose TextDocuments are used
+      (starting with `td_view_id`)
+      `app_vers` - dictionary of CLAMS app versions, keyed by view ID (all views)
+      `views_metadata` - dictionary of metadata dicts of the chosen views
+      `video_path` - path of the (first) VideoDocument in the file (or None)
+    
+    and, from the annotations of the chosen views (read in one pass, on first use):
+      `tps` - dictionary of TimePoints ("time", "tp_label") keyed by TP ID
+      `tf_anns` - list of TimeFrames ("tf_id", "tf_label", "targets", "representatives")
+      `tds` - list of TextDocuments ("td_id", "tf_id", "tp_id", "text"), where 
+      "tp_id" is None for TextDocuments without an Alignment
+      `first_time`, `final_time` - times of the first and final TimePoints
+
+    Views are chosen according to the criteria described for `get_swt_view_ids` 
+    and `get_td_view_id` (except that TextDocuments are taken from all captioner 
+    views), unless view IDs are passed in explicitly.
+
+    Use `SwtViewIndex.from_mmif` to index a `Mmif` object, or `SwtViewIndex.from_path`
+    to index an MMIF file without building a `Mmif` object.
+    """
+
+    def __init__(self):
+        self.tp_view_id = None
+        self.tf_view_id = None
+        self.td_view_id = None
+        self.td_view_ids = []
+        self.app_vers = {}
+        self.views_metadata = {}
+        self.video_path = None
+
+        # Annotation data is filled in by `_read_anns`, called on first use
+        self._read_anns = None
+        self._tps = {}
+        self._tf_anns = []
+        self._tds = []
+        self._first_time = None
+        self._final_time = None
+
+
+    @classmethod
+    def from_mmif( cls,
+                   usemmif:Mmif,
+                   view_ids:tuple = None ):
+        """
+        Creates an index from a `Mmif` object.  
+
+        `view_ids` is an optional tuple of (tp_view_id, tf_view_id, td_view_id) 
+        to use instead of the views that would be chosen automatically.
+        """
+        index = cls()
+
+        for view in usemmif.views:
+            index.app_vers[view.id] = _app_ver(view.metadata.app)
+
+        if view_ids is None:
+            tp_views = usemmif.get_all_views_contain(AnnotationTypes.TimePoint)
+            swt_tp_views = [ view.id for view in tp_views 
+                             if view.metadata.app.find("swt-detection") > -1 ]
+            tf_views = usemmif.get_all_views_contain(AnnotationTypes.TimeFrame)
+            swt_tf_views = [ view.id for view in tf_views 
+                             if view.metadata.app.find("swt-detection") > -1 ]
+            td_views = usemmif.get_all_views_contain(DocumentTypes.TextDocument)
+            cap_td_views = [ view.id for view in td_views 
+                             if view.metadata.app.find("captioner") > -1 ]
+            view_ids = _choose_views(swt_tp_views, swt_tf_views, cap_td_views)
+            index.td_view_ids = cap_td_views
+        elif view_ids[2] is not None:
+            index.td_view_ids = [ view_ids[2] ]
+        index.tp_view_id, index.tf_view_id, index.td_view_id = view_ids
+
+        for view_id in view_ids:
+            if view_id is not None:
+                view = usemmif.get_view_by_id(view_id)
+                index.views_metadata[view_id] = json.loads(str(view.metadata))
+
+        try:
+            index.video_path = usemmif.get_document_location( DocumentTypes.VideoDocument, 
+                                                              path_only=True )
+        except Exception:
+            index.video_path = None
+
+        def read_anns():
+            # Pull out the properties needed from each relevant annotation, calling
+            # `get_property` only once per property.
+            tp_props, tf_props, td_props, al_props = [], [], [], []
+            if index.tp_view_id is not None:
+                tp_view = usemmif.get_view_by_id(index.tp_view_id)
+                for ann in tp_view.get_annotations(AnnotationTypes.TimePoint):
+                    tp_props.append( { "id": ann.get_property("id"),
+                                       "timePoint": ann.get_property("timePoint"),
+                                       "label": ann.get_property("label") } )
+            if index.tf_view_id is not None:
+                tf_view = usemmif.get_view_by_id(index.tf_view_id)
+                for ann in tf_view.get_annotations(AnnotationTypes.TimeFrame):
+                    tf_props.append( { "id": ann.get_property("id"),
+                                       "label": ann.get_property("frameType"),
+                                       "targets": ann.get_property("targets"),
+                                       "representatives": ann.get_property("representatives") } )
+            for td_view_id in index.td_view_ids:
+                td_view = usemmif.get_view_by_id(td_view_id)
+                for ann in td_view.get_annotations(AnnotationTypes.Alignment):
+                    al_props.append( { "source": ann.get_property("source"),
+                                       "target": ann.get_property("target") } )
+                for ann in td_view.get_annotations(DocumentTypes.TextDocument):
+                    td_props.append( { "id": ann.get_property("id"),
+                                       "origin": ann.get_property("origin"),
+                                       "text": ann.get_property("text").value } )
+            index._add_anns(tp_props, tf_props, td_props, al_props)
+
+        index._read_anns = read_anns
+        return index
+
+
+    @classmethod
+    def from_path( cls,
+                   mmif_path:str,
+                   view_ids:tuple = None ):
+        """
+        Creates an index by reading an MMIF file directly (as the "stream" loader
+        does), without building a `Mmif` object.
+
+        `view_ids` is an optional tuple of (tp_view_id, tf_view_id, td_view_id) 
+        to use instead of the views that would be chosen automatically.
+        """
+        index = cls()
+
+        with open(mmif_path, "rb") as usefile:
+            if _IJSON:
+                documents, views = _read_mmif_events(usefile)
+            else:
+                documents, views = _read_mmif_plain(usefile)
+
+        views_by_id = {}
+        for view in views:
+            views_by_id[view["id"]] = view
+            index.app_vers[view["id"]] = _app_ver(view["metadata"].get("app", ""))
+
+        if view_ids is None:
+            def contains(view, type_name):
+                return any( _ann_type_name(t) == type_name 
+                            for t in view["metadata"].get("contains", {}) )
+            def app(view):
+                return view["metadata"].get("app", "")
+
+            swt_tp_views = [ v["id"] for v in views 
+                             if contains(v, "TimePoint") and app(v).find("swt-detection") > -1 ]
+            swt_tf_views = [ v["id"] for v in views 
+                             if contains(v, "TimeFrame") and app(v).find("swt-detection") > -1 ]
+            cap_td_views = [ v["id"] for v in views 
+                             if contains(v, "TextDocument") and app(v).find("captioner") > -1 ]
+            view_ids = _choose_views(swt_tp_views, swt_tf_views, cap_td_views)
+            index.td_view_ids = cap_td_views
+        elif view_ids[2] is not None:
+            index.td_view_ids = [ view_ids[2] ]
+        index.tp_view_id, index.tf_view_id, index.td_view_id = view_ids
+
+        doc_ids = set( d["properties"]["id"] for d in documents )
+        for view_id in set(view_ids[:2]) | set(index.td_view_ids):
+            if view_id is not None:
+                _long_ids(views_by_id[view_id], doc_ids)
+        for view_id in view_ids:
+            if view_id is not None:
+                index.views_metadata[view_id] = views_by_id[view_id]["metadata"]
+
+        video_docs = [ d for d in documents 
+                       if _ann_type_name(d.get("@type", "")) == "VideoDocument" ]
+        if video_docs and "location" in video_docs[0]["properties"]:
+            index.video_path = urlparse(video_docs[0]["properties"]["location"]).path
+
+        def anns(view_id, type_name):
+            if view_id is None:
+                return []
+            return [ a["properties"] for a in views_by_id[view_id]["annotations"] 
+                     if _ann_type_name(a["@type"]) == type_name ]
+
+        td_props = []
+        al_props = []
+        for td_view_id in index.td_view_ids:
+            for props in anns(td_view_id, "TextDocument"):
+                td_props.append( { "id": props["id"],
+                                   "origin": props.get("origin"),
+                                   "text": props.get("text", {}).get("@value") } )
+            al_props += anns(td_view_id, "Alignment")
+
+        index._add_anns( anns(index.tp_view_id, "TimePoint"), 
+                         anns(index.tf_view_id, "TimeFrame"), 
+                         td_props, 
+                         al_props )
+        return index
+
+
+    def _add_anns( self, 
+                   tp_props:list,
+                   tf_props:list,
+                   td_props:list,
+                   al_props:list ):
+        """
+        Fills in the annotation data of the index from lists of annotation 
+        properties, in one pass over each list.
+        """
+
+        # TimePoints, keeping track of the first and final times along the way
+        first_time = None
+        final_time = None
+        for props in tp_props:
+            time = props.get("timePoint")
+            self._tps[props["id"]] = { "time": time,
+                                       "tp_label": props.get("label") }
+            if first_time is None or time < first_time:
+                first_time = time
+            if final_time is None or time > final_time:
+                final_time = time
+        self._first_time, self._final_time = first_time, final_time
+
+        # TimeFrames
+        for props in tf_props:
+            self._tf_anns.append( { "tf_id": props["id"],
+                                    "tf_label": props.get("label", props.get("frameType")),
+                                    "targets": props.get("targets", []),
+                                    "representatives": props.get("representatives", []) } )
+
+        # TextDocuments, along with the source TP of each (from Alignments, indexed
+        # by target)
+        tas = {}
+        for props in al_props:
+            tas[props.get("target")] = props.get("source")
+        for props in td_props:
+            td = {}
+            td["td_id"] = props["id"]
+            td["tf_id"] = props["origin"]
+            td["tp_id"] = tas.get(td["td_id"])
+            td["text"] = props["text"]
+            self._tds.append(td)
+
+
+    def _ensure_anns(self):
+        if self._read_anns is not None:
+            read_anns = self._read_anns
+            self._read_anns = None
+            read_anns()
+
+    @property
+    def tps(self):
+        self._ensure_anns()
+        return self._tps
+
+    @property
+    def tf_anns(self):
+        self._ensure_anns()
+        return self._tf_anns
+
+    @property
+    def tds(self):
+        self._ensure_anns()
+        return self._tds
+
+    @property
+    def first_time(self):
+        self._ensure_anns()
+        return self._first_time
+
+    @property
+    def final_time(self):
+        self._ensure_anns()
+        return self._final_time
+
+
+def _choose_views( swt_tp_views:list,
+                   swt_tf_views:list,
+                   cap_td_views:list ):
+    """
+    Given lists of IDs of candidate views (in MMIF order), returns the tuple 
+    (tp_view_id, tf_view_id, td_view_id) of the views to use.
+    """
+    tp_view_id = swt_tp_views[-1] if len(swt_tp_views) else None
+    tf_view_id = swt_tf_views[-1] if len(swt_tf_views) else None
+    td_view_id = cap_td_views[0] if len(cap_td_views) else None
+    return (tp_view_id, tf_view_id, td_view_id)
+
+
+def _app_ver( app:str ):
+    """
+    Returns the version string at the end of a CLAMS app identifier
+    """
+    if app.rfind("/v") != -1:
+        return app[app.rfind("/v")+1:]
+    else:
+        return ""
+
+
+def _swt_index( usemmif, 
+                view_ids:tuple = None ):
+    """
+    Returns `usemmif` if it is already a `SwtViewIndex`.  Otherwise, indexes the 
+    `Mmif` object passed in.
+
+    When `view_ids` are given for an existing index, they must match the views
+    of the index.
+    """
+    if isinstance(usemmif, SwtViewIndex):
+        if view_ids is not None:
+            index_ids = (usemmif.tp_view_id, usemmif.tf_view_id, usemmif.td_view_id)
+            for view_id, index_id in zip(view_ids, index_ids):
+                if view_id is not None and view_id != index_id:
+                    raise ValueError(f"View ID '{view_id}' does not match the SwtViewIndex views {index_ids}.")
+        return usemmif
+    else:
+        return SwtViewIndex.from_mmif(usemmif, view_ids=view_ids)
+
 
 def get_swt_view_ids(usemmif:Mmif):
     """
-    Takes a MMIF string and returns the IDs of the TimePoint containg view and the 
-    TimeFrame containing view relevant to SWT processing
+    Takes a Mmif object (or SwtViewIndex) and returns the IDs of the TimePoint 
+    containg view and the TimeFrame containing view relevant to SWT processing
     
     NOTE:
     This function assumes that a valid view will have "swt-detection" as a substring 
@@ -78,31 +521,15 @@ def get_swt_view_ids(usemmif:Mmif):
     such view.
     """
 
-    tp_views = usemmif.get_all_views_contain(AnnotationTypes.TimePoint)
-    swt_tp_views = [ view for view in tp_views 
-                     if view.metadata.app.find("swt-detection") > -1 ]
-    if len(swt_tp_views):
-        tp_view = swt_tp_views[-1]
-        tp_view_id = tp_view.id
-    else:
-        tp_view_id= None
-    
-    tf_views = usemmif.get_all_views_contain(AnnotationTypes.TimeFrame)
-    swt_tf_views = [ view for view in tf_views 
-                     if view.metadata.app.find("swt-detection") > -1 ]
-    if len(swt_tf_views):
-        tf_view = swt_tf_views[-1]
-        tf_view_id = tf_view.id
-    else:
-        tf_view_id = None
+    index = _swt_index(usemmif)
 
-    return (tp_view_id, tf_view_id)
+    return (index.tp_view_id, index.tf_view_id)
 
 
 def get_td_view_id(usemmif:Mmif):
     """
-    Takes a MMIF string and returns the ID of a view with TextDocument annotations
-    from a captioner app.
+    Takes a Mmif object (or SwtViewIndex) and returns the ID of a view with 
+    TextDocument annotations from a captioner app.
     
     NOTE:
     This function assumes that a valid view will have "captioner" as a substring 
@@ -112,17 +539,9 @@ def get_td_view_id(usemmif:Mmif):
     such view.
     """
 
-    td_views = usemmif.get_all_views_contain(DocumentTypes.TextDocument)
-    cap_td_views = [ view for view in td_views 
-                     if view.metadata.app.find("captioner") > -1 ]
-
-    if len(cap_td_views):
-        td_view = cap_td_views[0]
-        td_view_id = td_view.id
-    else:
-        td_view_id= None
+    index = _swt_index(usemmif)
 
-    return td_view_id
+    return index.td_view_id
 
 
 def get_mmif_metadata_str( usemmif:Mmif, 
@@ -138,30 +557,11 @@ def get_mmif_metadata_str( usemmif:Mmif,
     CLAMS metadata for inclusion or display in CLAMS consuming procedures.
     """
 
-    if tp_view_id is None:
-        tp_d = {}
-    else:
-        tp_view = usemmif.get_view_by_id(tp_view_id)
-        tp_str = str(tp_view.metadata)
-        tp_d = json.loads(tp_str)
-
-    if tf_view_id is None:
-        tf_d = {}
-    else:
-        tf_view = usemmif.get_view_by_id(tf_view_id)
-        tf_str = str(tf_view.metadata)
-        tf_d = json.loads(tf_str)
+    index = _swt_index(usemmif, (tp_view_id, tf_view_id, td_view_id))
 
-    if td_view_id is None:
-        td_d = {}
-    else:
-        td_view = usemmif.get_view_by_id(td_view_id)
-        td_str = str(td_view.metadata)
-        td_d = json.loads(td_str)
-
-    md = { "TimePoint_view_metadata": tp_d,
-           "TimeFrame_view_metadata": tf_d,
-           "TextDocument_view_metadata": td_d }
+    md = { "TimePoint_view_metadata": index.views_metadata.get(tp_view_id, {}),
+           "TimeFrame_view_metadata": index.views_metadata.get(tf_view_id, {}),
+           "TextDocument_view_metadata": index.views_metadata.get(td_view_id, {}) }
 
     mstr = json.dumps( md, indent=2 )
 
@@ -179,13 +579,10 @@ def get_CLAMS_app_ver( usemmif:Mmif, view_id:str ):
 
     if view_id is None:
         ver = None
+    elif isinstance(usemmif, SwtViewIndex):
+        ver = usemmif.app_vers[view_id]
     else:
-        view = usemmif.get_view_by_id(view_id)
-        app = view.metadata.app
-        if app.rfind("/v") != -1:
-            ver = app[app.rfind("/v")+1:]
-        else:
-            ver = ""
+        ver = _app_ver(usemmif.get_view_by_id(view_id).metadata.app)
     
     return ver
 
@@ -193,31 +590,13 @@ def get_CLAMS_app_ver( usemmif:Mmif, view_id:str ):
 
 def first_final_time_in_mmif( usemmif:Mmif, tp_view_id:str ):
     """
-    Takes serialized MMIF as a string as input.
+    Takes a Mmif object (or SwtViewIndex) as input.
     Analyzes MMIF with TimePoints and returns the times of the first and final ones.
     """
 
-    # get the view
     if tp_view_id:
-        tp_view = usemmif.get_view_by_id(tp_view_id)
-    else:
-        tp_view = None
-
-    # get the annotations
-    if tp_view:
-        tpanns = tp_view.get_annotations(AnnotationTypes.TimePoint)
-    else:
-        tpanns = None
-
-    # get the first and last times
-    if tpanns:
-        first_time = 86400000
-        final_time = 0
-        for ann in tpanns:
-            if ann.get_property("timePoint") < first_time:
-                first_time = ann.get_property("timePoint")
-            if ann.get_property("timePoint") > final_time:
-                final_time = ann.get_property("timePoint")
+        index = _swt_index(usemmif, (tp_view_id, None, None))
+        first_time, final_time = index.first_time, index.final_time
     else:
         first_time, final_time = None, None
 
@@ -227,7 +606,8 @@ def first_final_time_in_mmif( usemmif:Mmif, tp_view_id:str ):
 def tfsd_from_mmif( usemmif:Mmif, 
                     tp_view_id:str, 
                     tf_view_id:str,
-                    td_view_id:str 
+                    td_view_id:str,
+                    problems:list = None
                     ):
     """
     Analyzes MMIF file from SWT, combining  TimeFrame and TimePoint annotations, 
@@ -237,7 +617,7 @@ def tfsd_from_mmif( usemmif:Mmif,
     This function is like the original `tfs_from_mmif` function for SWT, except 
     returning a list of dictionaries (and allowing additional fields).
 
-    Takes serialized MMIF as a string as input.
+    Takes a Mmif object (or SwtViewIndex) as input.
     Returns a list of dictionaries representing the TimeFrame annotations
 
     Columns of returned "tfsd" table:
@@ -250,68 +630,64 @@ def tfsd_from_mmif( usemmif:Mmif,
       (-) "tp_id":    TimePoint ID (from MMIF file) of representative time point
       (-) "td_id":    TextDocument ID (from MMIF file)
       (-) "text":     text from the TextDocument
+
+    Annotations that cannot be joined are skipped rather than causing an error.
+    If a `problems` list is passed in, a dictionary describing each one is appended
+    to it, with a "problem" key (one of the keys of `JOIN_PROBLEMS`) and the IDs
+    of the annotations involved.
     """
 
+    if problems is None:
+        problems = []
+
     # If there is no view with a TimeFrame, return an empty list.
     if tf_view_id is None:
         logging.info("MMIF file contained no SWT TimeFrame annotations.")
         tfsd = []
         return tfsd
 
-    # Otherwise, get the relevant views
-    tp_view = usemmif.get_view_by_id(tp_view_id)
-    tf_view = usemmif.get_view_by_id(tf_view_id)
-    if td_view_id is not None:
-        td_view = usemmif.get_view_by_id(td_view_id)
-    else:
+    # Otherwise, get the annotations from the relevant views
+    index = _swt_index(usemmif, (tp_view_id, tf_view_id, td_view_id))
+    if td_view_id is None:
         logging.info("MMIF file contained no captioner TextDocument annotations.")
-        td_view = None
 
-    # Collect TD annotations 
-    # (list of dictionaries of TDs)
-    tds = []
-    if td_view is not None:
-        # First, get mapping of TD ann to its ource TP ann
-        tas = {}
-        for ann in td_view.get_annotations(AnnotationTypes.Alignment):
-            tas[ann.get_property("target")] = ann.get_property("source") 
+    # TPs are already indexed by ID. 
+    tps = index.tps
 
-        # Build a list of TD anns along with source TP
-        for ann in td_view.get_annotations(DocumentTypes.TextDocument):
-            td = {}
-            td["td_id"] = ann.get_property("id")
-            td["tf_id"] = ann.get_property("origin")
-            td["tp_id"] = tas[td["td_id"]]
-            td["text"] = ann.get_property("text").value
-            tds.append(td)
-
-    # Collect TP anns
-    # (dictionary keyed by TP ann ID)
-    tps = {}
-    for ann in tp_view.get_annotations(AnnotationTypes.TimePoint):
-        tps[ann.get_property("id")] = {
-            "time": ann.get_property("timePoint"),
-            "tp_label": ann.get_property("label") }
+    # Index TDs by the ID of the TF they originate from (keeping MMIF order)
+    tds_by_tf = {}
+    for td in index.tds:
+        tds_by_tf.setdefault(td["tf_id"], []).append(td)
 
     # Build a list of TF anns
     # (list of dictionaries of TFs)
     tfsd = []
-    for ann in tf_view.get_annotations(AnnotationTypes.TimeFrame):
+    for ann in index.tf_anns:
         tf = {}
-        tf["tf_id"] = ann.get_property("id")
-        tf["tf_label"] = ann.get_property("frameType")
+        tf["tf_id"] = ann["tf_id"]
+        tf["tf_label"] = ann["tf_label"]
+
+        # IDs of TPs referenced by this TF, but not found
+        missing = set()
         
-        # iterate through target TPs to get start time and end time
-        tf["start"] = 36000000 # 10 hours
-        tf["end"] = -1
-        for tp_id in ann.get_property("targets"):
-            if tps[tp_id]["time"] < tf["start"]:
-                tf["start"] = tps[tp_id]["time"]
-            if tps[tp_id]["time"] > tf["end"]:
-                tf["end"] = tps[tp_id]["time"]
+        # look up target TPs to get start time and end time
+        target_times = []
+        for tp_id in ann["targets"]:
+            if tp_id in tps:
+                target_times.append(tps[tp_id]["time"])
+            elif tp_id not in missing:
+                missing.add(tp_id)
+                problems.append( { "problem": "tp-missing", 
+                                   "tf_id": tf["tf_id"], 
+                                   "tp_id": tp_id } )
+        if not target_times:
+            problems.append( { "problem": "tf-no-tps", "tf_id": tf["tf_id"] } )
+            continue
+        tf["start"] = min(target_times)
+        tf["end"] = max(target_times)
 
         # see if we have data from a TD
-        tftds = [ td for td in tds if td["tf_id"] == tf["tf_id"] ]
+        tftds = tds_by_tf.get(tf["tf_id"], [])
         if not len(tftds):
             tf["td_id"] = None
             tf["text"] = None
@@ -321,17 +697,34 @@ def tfsd_from_mmif( usemmif:Mmif,
             td = tftds[0]
             tf["td_id"] = td["td_id"]
             tf["text"] = td["text"]
-            if td["tp_id"] in ann.get_property("representatives"):
+            if td["tp_id"] is None:
+                problems.append( { "problem": "td-unaligned", 
+                                   "tf_id": tf["tf_id"], 
+                                   "td_id": td["td_id"] } )
+            elif td["tp_id"] in ann["representatives"] and td["tp_id"] in tps:
                 # we have a rep chosen by the TextDocumemnt annotator; choose that as the TF rep
                 tf["tp_id"] = td["tp_id"]
 
         # if we didn't get a rep TP before, then we have to choose one
         if "tp_id" not in tf:
             reps = []
-            for tp_id in ann.get_property("representatives"):
-                rep = { "tp_id": tp_id, 
-                        "time": tps[tp_id]["time"] }
-                reps.append(rep)
+            for tp_id in ann["representatives"]:
+                if tp_id in tps:
+                    rep = { "tp_id": tp_id, 
+                            "time": tps[tp_id]["time"] }
+                    reps.append(rep)
+                elif tp_id not in missing:
+                    missing.add(tp_id)
+                    problems.append( { "problem": "tp-missing", 
+                                       "tf_id": tf["tf_id"], 
+                                       "tp_id": tp_id } )
+
+            if not reps:
+                # fall back to choosing among the target TPs
+                problems.append( { "problem": "tf-no-reps", "tf_id": tf["tf_id"] } )
+                reps = [ { "tp_id": tp_id, "time": tps[tp_id]["time"] } 
+                         for tp_id in ann["targets"] if tp_id in tps ]
+
             reps.sort(key=lambda f:f["time"])
 
             # choose one from the middle
@@ -341,13 +734,197 @@ def tfsd_from_mmif( usemmif:Mmif,
         tf["tp_time"] = tps[tf["tp_id"]]["time"]
         tf["tp_label"] = tps[tf["tp_id"]]["tp_label"]
 
-        tfsd.append(tf)
+        tfsd.append(Scene(**tf))
+
+    # Report TDs that do not belong to any TF
+    tf_ids = set( ann["tf_id"] for ann in index.tf_anns )
+    for tf_id in tds_by_tf:
+        if tf_id not in tf_ids:
+            for td in tds_by_tf[tf_id]:
+                problems.append( { "problem": "td-orphan", 
+                                   "tf_id": tf_id, 
+                                   "td_id": td["td_id"] } )
 
     # all done; sort and return
     tfsd.sort(key=lambda f:f["start"])
     return tfsd
 
 
+def _ann_type_name( at_type:str ):
+    """
+    Returns the short name of an annotation type URI, e.g., 
+    "http://mmif.clams.ai/vocabulary/TimePoint/v4" -> "TimePoint"
+    """
+    parts = at_type.rstrip("/").split("/")
+    if len(parts) > 1 and parts[-1].startswith("v"):
+        return parts[-2]
+    else:
+        return parts[-1]
+
+
+def _read_mmif_events( mmif_file ):
+    """
+    Reads an open (binary) MMIF file incrementally with `ijson`, keeping only the 
+    annotation types in `STREAM_ANN_TYPES` and properties in `STREAM_ANN_PROPS`.
+
+    Returns a list of documents and a list of views (as dictionaries).
+    """
+
+    ann_prefix = "views.item.annotations.item"
+    props_prefix = ann_prefix + ".properties."
+
+    documents = []
+    views = []
+    view = None
+    ann = None
+
+    # An ObjectBuilder collects a whole JSON subtree (e.g., view metadata). While
+    # one is active, all parser events go to it until its subtree is closed.
+    builder = None
+    builder_prefix = None
+    builder_done = None
+
+    for prefix, event, value in ijson.parse(mmif_file, use_float=True):
+
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == builder_prefix and event in ("end_map", "end_array"):
+                builder_done(builder.value)
+                builder = None
+            continue
+
+        # start collecting a subtree (if `value` is compound) or take the value 
+        if prefix == "documents.item" and event == "start_map":
+            subtree_done = documents.append
+        elif prefix == "views.item.metadata" and event == "start_map":
+            subtree_done = lambda v: view.__setitem__("metadata", v)
+        elif ( prefix.startswith(props_prefix) and event != "map_key" and
+               prefix[len(props_prefix):] in STREAM_ANN_PROPS ):
+            key = prefix[len(props_prefix):]
+            subtree_done = lambda v, key=key: ann["properties"].__setitem__(key, v)
+        else:
+            subtree_done = None
+
+        if subtree_done is not None:
+            if event in ("start_map", "start_array"):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                builder_prefix = prefix
+                builder_done = subtree_done
+            else:
+                subtree_done(value)
+            continue
+
+        # keep track of the view and annotation being read
+        if prefix == "views.item":
+            if event == "start_map":
+                view = { "id": None, "metadata": {}, "annotations": [] }
+            elif event == "end_map":
+                views.append(view)
+        elif prefix == "views.item.id" and event == "string":
+            view["id"] = value
+        elif prefix == ann_prefix:
+            if event == "start_map":
+                ann = { "@type": "", "properties": {} }
+            elif event == "end_map":
+                if _ann_type_name(ann["@type"]) in STREAM_ANN_TYPES:
+                    view["annotations"].append(ann)
+        elif prefix == ann_prefix + ".@type":
+            ann["@type"] = value
+
+    return documents, views
+
+
+def _read_mmif_plain( mmif_file ):
+    """
+    Reads an open MMIF file with the standard `json` module (as a fallback when
+    `ijson` is not available), keeping only the annotation types and properties 
+    the "stream" loader keeps.
+
+    Returns a list of documents and a list of views (as dictionaries).
+    """
+
+    mmif_d = json.load(mmif_file)
+
+    views = []
+    for view_d in mmif_d.get("views", []):
+        view = { "id": view_d["id"], 
+                 "metadata": view_d.get("metadata", {}), 
+                 "annotations": [] }
+        for ann_d in view_d.get("annotations", []):
+            if _ann_type_name(ann_d["@type"]) in STREAM_ANN_TYPES:
+                props = { k: v for k, v in ann_d["properties"].items() 
+                          if k in STREAM_ANN_PROPS }
+                view["annotations"].append( { "@type": ann_d["@type"], 
+                                              "properties": props } )
+        views.append(view)
+
+    return mmif_d.get("documents", []), views
+
+
+def _long_ids( view:dict, doc_ids:set ):
+    """
+    Converts "short" annotation IDs (and references to them) in a view read by 
+    the "stream" loader to the "long" form (prefixed by the view ID), in the same
+    way that `Mmif` does when it deserializes a file.
+    """
+    vid = view["id"]
+    for ann in view["annotations"]:
+        props = ann["properties"]
+        for key in ["id", "source", "target"]:
+            if ( key in props and isinstance(props[key], str) and 
+                 props[key] not in doc_ids and ":" not in props[key] ):
+                props[key] = vid + ":" + props[key]
+        for key in ["targets", "representatives"]:
+            if key in props and isinstance(props[key], list):
+                props[key] = [ vid + ":" + i if (i not in doc_ids and ":" not in i) else i
+                               for i in props[key] ]
+
+
+def load_swt( mmif_path:str, 
+              loader:str = "mmif",
+              view_ids:tuple = None ):
+    """
+    Reads an MMIF file from SWT and returns a dictionary with the data needed to 
+    create visaids and other artifacts:
+      "tp_view_id", "tf_view_id", "td_view_id":  IDs of the views used 
+      "tfsd":  the (unadjusted) tfsd table, as returned by `tfsd_from_mmif`
+      "first_time", "final_time":  as returned by `first_final_time_in_mmif`
+      "mmif_metadata_str":  as returned by `get_mmif_metadata_str`
+      "video_path":  the path of the VideoDocument in the MMIF file (or None)
+      "problems":  list of join problems reported by `tfsd_from_mmif`
+
+    The `loader` is one of the values in `MMIF_LOADERS`.  The "stream" loader 
+    gives the same results as the "mmif" loader, but it is much faster and uses 
+    much less memory for large MMIF files.
+
+    `view_ids` is an optional tuple of (tp_view_id, tf_view_id, td_view_id) to 
+    use instead of the views that would be chosen automatically.
+    """
+
+    if loader == "mmif":
+        with open(mmif_path, "r") as usefile:
+            usemmif = Mmif(usefile.read())
+        index = SwtViewIndex.from_mmif(usemmif, view_ids=view_ids)
+    elif loader == "stream":
+        index = SwtViewIndex.from_path(mmif_path, view_ids=view_ids)
+    else:
+        raise ValueError(f"Invalid MMIF loader '{loader}'. Valid loaders: {MMIF_LOADERS}")
+
+    view_ids = (index.tp_view_id, index.tf_view_id, index.td_view_id)
+    problems = []
+
+    return { "tp_view_id": index.tp_view_id,
+             "tf_view_id": index.tf_view_id,
+             "td_view_id": index.td_view_id,
+             "tfsd": tfsd_from_mmif(index, *view_ids, problems=problems),
+             "first_time": index.first_time,
+             "final_time": index.final_time,
+             "mmif_metadata_str": get_mmif_metadata_str(index, *view_ids),
+             "video_path": index.video_path,
+             "problems": problems }
+
+
 def adjust_tfsd( tfsd_in:list, 
                  first_time:int,
                  final_time:int,
@@ -398,44 +975,45 @@ def adjust_tfsd( tfsd_in:list,
         else:
             params[key] = None
 
-    # Go ahead and filter out scene types, according to parameters
-    if params["include_only"] is not None:
-        tfsd = [ tf for tf in tfsd if tf["tf_label"] in params["include_only"] ]
-    
-    if params["exclude"] is not None and len(params["exclude"]) > 0:
-        tfsd = [ tf for tf in tfsd if tf["tf_label"] not in params["exclude"] ]
+    # Go ahead and filter out scene types, according to parameters (in one pass)
+    include_only = params["include_only"]
+    exclude = params["exclude"] or ()
+    if include_only is not None or len(exclude) > 0:
+        tfsd = [ tf for tf in tfsd 
+                 if ( (include_only is None or tf["tf_label"] in include_only) and
+                      tf["tf_label"] not in exclude ) ]
     
     # Sort just in case it was not already sorted
     tfsd.sort(key=lambda f:f["start"])
 
     # Add frames for first and final timepoints.
-    # These may be removed later, but we add them for now.
+    # These may be left out of the result, but we add them for now.
     # (The main reason for this is that we want to be able to find gaps where
     # there are no scene annotations, including the beginning and end of the video.
     # Logically, scene gaps must be between seens.  So we need beginning and ending
     # scenes in order to catch the gaps.)
-    first = {
-      "tf_id": 'f_0',
-      "tf_label": 'first frame checked',
-      "start": first_time,
-      "end": first_time, 
-      "tp_time": first_time,
-      "tp_label": None,
-      "tp_id": None,
-      "td_id": None,
-      "text": None }
+    first = Scene(
+      tf_id='f_0',
+      tf_label='first frame checked',
+      start=first_time,
+      end=first_time, 
+      tp_time=first_time,
+      tp_label=None,
+      tp_id=None,
+      td_id=None,
+      text=None )
     tfsd.insert(0, first)
 
-    final = {
-      "tf_id": 'f_n',
-      "tf_label": 'last frame checked',
-      "start": final_time,
-      "end": final_time, 
-      "tp_time": final_time,
-      "tp_label": None,
-      "tp_id": None,
-      "td_id": None,
-      "text": None }
+    final = Scene(
+      tf_id='f_n',
+      tf_label='last frame checked',
+      start=final_time,
+      end=final_time, 
+      tp_time=final_time,
+      tp_label=None,
+      tp_id=None,
+      td_id=None,
+      text=None )
     tfsd.append(final)
 
     #
@@ -447,6 +1025,7 @@ def adjust_tfsd( tfsd_in:list,
     # The "max_unsampled_gap" value controls the largest gap between scenes that does
     # not trigger the addtition of interspersed samples.
     # 
+    samples = []
     if params["max_unsampled_gap"]: 
         max_gap = params["max_unsampled_gap"]
 
@@ -457,64 +1036,25 @@ def adjust_tfsd( tfsd_in:list,
         # duration is somewhat arbitrary.
         sample_dur = max_gap // 2
 
-        # collect samples to add to the main table of scenes
-        samples = []
+        # For each time frame, after the first, look back to see how much time since 
+        # the end of the previous one.  Where that gap is bigger than the max_gap, 
+        # samples are spread evenly through it.  (Times for all the samples are 
+        # computed together; see `_gap_sample_times`.)
+        sample_times = _gap_sample_times( [ tf["end"] for tf in tfsd[:-1] ],
+                                          [ tf["start"] for tf in tfsd[1:] ],
+                                          max_gap,
+                                          sample_dur )
 
-        # index for use in the scene's id and label
-        next_sample_num = 1
-
-        # Iterate through existing time frames to identify gaps in which to 
-        # insert samples.  Specifically, for each time frame, after the first,
-        # look back to see how much time since the last one.  If that gap is 
-        # bigger than the max_gap, then make one or more samples.
-        for rnum in range(1, len(tfsd)) :
-            
-            # calculate the distance between the start of the current frame
-            # and the end of the previous
-            full_gap = tfsd[rnum]["start"] - tfsd[rnum-1]["end"]
-
-            if full_gap > max_gap :
-
-                # Figure out how many samples to make
-                num_samples = full_gap // max_gap
-
-                # Calculate the size of the gaps within which we'll locate new samples
-                gap_size = full_gap // num_samples
-
-                # collect samples (we'll add them into tfsd later)
-                for sample_count in range(num_samples):
-
-                    # gap starts from the end of the last main scene, then offset by the
-                    # samples we've already made in this full gap
-                    gap_start = tfsd[rnum-1]["end"] + ( sample_count * gap_size )
-
-                    sample_id = "s_" + str(next_sample_num)                    
-                    sample_label = "unlabeled sample"
-                    sample_start = gap_start + (gap_size - sample_dur)//2
-                    sample_end = sample_start + sample_dur
-                    sample_rep = sample_start + sample_dur//2
-
-                    sample = {
-                        "tf_id": sample_id,
-                        "tf_label": sample_label,
-                        "start": sample_start,
-                        "end": sample_end, 
-                        "tp_time": sample_rep,
-                        "tp_label": None,
-                        "tp_id": None,
-                        "td_id": None,
-                        "text": None }
-                    samples.append(sample)
-
-                    next_sample_num += 1
-
-        # add all the samples collected to the tfsd list 
-        tfsd += samples
+        samples = [ Scene( "s_" + str(sample_num), "unlabeled sample",
+                           sample_start, sample_end, sample_rep )
+                    for sample_num, (sample_start, sample_end, sample_rep) 
+                    in enumerate(sample_times, start=1) ]
 
     # 
     # Scene subsampling
     # (Add extra samples scenes for longer scenes (especially, e.g., credits sequences) )
     #
+    new_scenes = []
     if params["subsampling"] is not None or params["default_subsampling"] is not None:
 
         # First, collect the subsampling thresholds for each scene type
@@ -542,66 +1082,144 @@ def adjust_tfsd( tfsd_in:list,
         for scenetype in invalid_subsamples:
             del subsampling[scenetype]
 
-        # collect new rows for the new samples
-        new_scenes = []
-
-        # iterate through scene rows of tfsd for which the label is subejct to subsampling
-        for tf in [ tf for tf in tfsd if tf["tf_label"] in subsampling]:
-
-            # duration for the entire scene
-            scene_dur = tf["end"] - tf["start"]
-
-            # check to see whether this scene meets the subsampling threshold for its label
-            if scene_dur > subsampling[tf["tf_label"]] :
-
-                # We want enough subsample scenes so that each is shorter than the 
-                # subsampling threshold.
-                # Example: 36s scene with 10s subsampling -> 4 x 9s subsample scenes
-                num_subsamples = ( scene_dur // subsampling[tf["tf_label"]] ) + 1        
-                subsample_dur = scene_dur // num_subsamples
-
-                subsamples = []           # subsample scenes to be collected for this scene
-                next_start = tf["start"]  # first subsample starts at start of the long scene
-                
-                for _ in range(num_subsamples):
-                    subsample_id = tf["tf_id"] + "_s_" + str(len(subsamples))
-                    subsample_label = tf["tf_label"] + " - - -"
-                    subsample_start = next_start
-                    subsample_end = next_start + subsample_dur
-                    subsample_rep = next_start + ( subsample_dur // 2 )
-
-                    subsample = {
-                        "tf_id": subsample_id,
-                        "tf_label": subsample_label,
-                        "start": subsample_start,
-                        "end": subsample_end, 
-                        "tp_time": subsample_rep,
-                        "tp_label": None,
-                        "tp_id": None,
-                        "td_id": None,
-                        "text": None }
-                    subsamples.append(subsample)
-
-                    next_start = subsample_end
-                
-                # Done with this scene.  Add new samples to running list of new scenes
-                new_scenes += subsamples
-
-        # Done iterating through labeled scenes.  Add the new scenes the main list.
-        tfsd += new_scenes
+        # Scene rows of tfsd (and samples) for which the label is subject to subsampling
+        sub_tfs = [ tf for tf in tfsd + samples if tf["tf_label"] in subsampling ]
 
-        
-    # If appropriate, remove first frame and final scenes (which were inserted above)
-    to_remove = []
-    if not params["include_first_time"]:
-        to_remove.append('f_0')
-    if not params["include_final_time"]:
-        to_remove.append('f_n')
-    if len(to_remove) > 0:
-        tfsd = [ tf for tf in tfsd if tf["tf_id"] not in to_remove ]
+        # We want enough subsample scenes so that each is shorter than the 
+        # subsampling threshold.
+        # Example: 36s scene with 10s subsampling -> 4 x 9s subsample scenes
+        # (Times for all the subsamples are computed together; see `_subsample_times`.)
+        subsample_times = _subsample_times( [ tf["start"] for tf in sub_tfs ],
+                                            [ tf["end"] for tf in sub_tfs ],
+                                            [ subsampling[tf["tf_label"]] for tf in sub_tfs ] )
 
-    tfsd.sort(key=lambda f:f["start"])
-    return tfsd
+        # id prefixes and labels for subsamples of each scene
+        sub_ids = [ tf["tf_id"] + "_s_" for tf in sub_tfs ]
+        sub_labels = [ sys.intern(tf["tf_label"] + " - - -") for tf in sub_tfs ]
+
+        new_scenes = [ Scene( sub_ids[ri] + str(k), sub_labels[ri],
+                              subsample_start, subsample_end, subsample_rep )
+                       for ri, k, subsample_start, subsample_end, subsample_rep 
+                       in subsample_times ]
+
+    # Assemble the adjusted table once, leaving out the first frame and final 
+    # scenes (which were inserted above) unless they are wanted.
+    lo = 0 if params["include_first_time"] else 1
+    hi = len(tfsd) if params["include_final_time"] else len(tfsd) - 1
+    tfsd_adj = tfsd[lo:hi] + samples + new_scenes
+
+    tfsd_adj.sort(key=lambda f:f["start"])
+    return tfsd_adj
+
+
+def _gap_sample_times( prev_ends:list,
+                       next_starts:list,
+                       max_gap:int,
+                       sample_dur:int ) -> list:
+    """
+    Helper for `adjust_tfsd`.  For each pair of consecutive time frames (given by
+    the end of the one and the start of the next), if the gap between them is 
+    bigger than `max_gap`, the gap is divided into `gap // max_gap` equal parts, 
+    and a sample of duration `sample_dur` is centered in each part.
+
+    Returns a list of (start, end, rep) tuples for the samples, in order.
+
+    Uses NumPy array arithmetic when available (and when all times are integers,
+    so that results are the same as with plain Python arithmetic).
+    """
+
+    if _NUMPY and max_gap > 0 and _all_ints( prev_ends, next_starts, [max_gap, sample_dur] ):
+        prev_ends = np.asarray(prev_ends, dtype=np.int64)
+        full_gaps = np.asarray(next_starts, dtype=np.int64) - prev_ends
+
+        # keep only the gaps that need samples
+        sel = full_gaps > max_gap
+        prev_ends = prev_ends[sel]
+        full_gaps = full_gaps[sel]
+
+        # how many samples in each gap, and the size of each part of the gap
+        num_samples = full_gaps // max_gap
+        gap_sizes = full_gaps // num_samples
+
+        # one array element per sample; `counts` numbers samples within each gap
+        gi = np.repeat( np.arange(len(num_samples)), num_samples )
+        counts = np.arange(len(gi)) - np.repeat( np.cumsum(num_samples) - num_samples, num_samples )
+
+        starts = ( prev_ends[gi] + counts * gap_sizes[gi] + 
+                   (gap_sizes[gi] - sample_dur) // 2 )
+        return list(zip( starts.tolist(), 
+                         (starts + sample_dur).tolist(),
+                         (starts + sample_dur // 2).tolist() ))
+
+    times = []
+    for prev_end, next_start in zip(prev_ends, next_starts):
+        full_gap = next_start - prev_end
+        if full_gap > max_gap:
+            num_samples = full_gap // max_gap
+            gap_size = full_gap // num_samples
+            for sample_count in range(num_samples):
+                gap_start = prev_end + ( sample_count * gap_size )
+                sample_start = gap_start + (gap_size - sample_dur)//2
+                times.append( (sample_start, sample_start + sample_dur, sample_start + sample_dur//2) )
+    return times
+
+
+def _subsample_times( starts:list,
+                      ends:list,
+                      thresholds:list ) -> list:
+    """
+    Helper for `adjust_tfsd`.  For each scene (given by its start, end, and
+    subsampling threshold), if the scene is longer than the threshold, it is 
+    divided into `dur // threshold + 1` equal subsamples.
+
+    Returns a list of (row, count, start, end, rep) tuples for the subsamples,
+    in order, where `row` is the index of the scene the subsample belongs to, and
+    `count` numbers the subsamples within that scene.
+
+    Uses NumPy array arithmetic when available (and when all times are integers,
+    so that results are the same as with plain Python arithmetic).
+    """
+
+    if _NUMPY and _all_ints( starts, ends, thresholds ):
+        starts = np.asarray(starts, dtype=np.int64)
+        durs = np.asarray(ends, dtype=np.int64) - starts
+        thresholds = np.asarray(thresholds, dtype=np.int64)
+
+        # keep only the scenes that need subsampling
+        rows = np.nonzero( durs > thresholds )[0]
+        num_subsamples = durs[rows] // thresholds[rows] + 1
+        subsample_durs = durs[rows] // num_subsamples
+
+        # one array element per subsample; `counts` numbers subsamples within each scene
+        si = np.repeat( np.arange(len(rows)), num_subsamples )
+        counts = np.arange(len(si)) - np.repeat( np.cumsum(num_subsamples) - num_subsamples, num_subsamples )
+
+        sub_starts = starts[rows][si] + counts * subsample_durs[si]
+        return list(zip( rows[si].tolist(),
+                         counts.tolist(),
+                         sub_starts.tolist(),
+                         (sub_starts + subsample_durs[si]).tolist(),
+                         (sub_starts + subsample_durs[si] // 2).tolist() ))
+
+    times = []
+    for row, (start, end, threshold) in enumerate(zip(starts, ends, thresholds)):
+        scene_dur = end - start
+        if scene_dur > threshold:
+            num_subsamples = ( scene_dur // threshold ) + 1
+            subsample_dur = scene_dur // num_subsamples
+            next_start = start
+            for count in range(num_subsamples):
+                times.append( (row, count, next_start, next_start + subsample_dur,
+                               next_start + ( subsample_dur // 2 )) )
+                next_start += subsample_dur
+    return times
+
+
+def _all_ints( *value_lists ) -> bool:
+    """
+    Returns True if every value in the lists is a plain integer
+    """
+    return all( type(v) is int for values in value_lists for v in values )
 
 
 def tfsd_to_tfs(tfsd:list):
@@ -609,6 +1227,9 @@ def tfsd_to_tfs(tfsd:list):
     Takes a list in the tfsd style and returns the corresponding list in the
     deprecated tfs style.
 
+    (Only needed for code that still expects tfs tables.  The modules in this 
+    package all work with tfsd tables of `Scene` records.)
+
     Columns of returned "tfs" table of scene time frames:
         0: TimeFrame id (from MMIF file) (string)
         1: bin label (string)
@@ -631,43 +1252,81 @@ def tfsd_to_tfs(tfsd:list):
     return tfs
 
 
+def _iter_overlaps( tfsd: list ):
+    """
+    Generates (i, j) pairs of time frames from tfsd where j starts within i 
+    (i["start"] <= j["start"] <= i["end"]), in order of i and then j by start time.
+
+    Works by sorting once on start times and using binary search to find the range
+    of time frames starting within each one, so the cost is O(n log n) plus the 
+    number of overlaps, rather than O(n^2).
+    """
+
+    # order time frames by starting ms (stable, so ties keep their original order)
+    tfsd = sorted( tfsd, key=lambda f:f["start"] )
+    starts = [ f["start"] for f in tfsd ]
+
+    for i in tfsd:
+        # range of time frames starting between the start and end of this one
+        lo = bisect_left( starts, i["start"] )
+        hi = bisect_right( starts, i["end"] )
+        for j in tfsd[lo:hi]:
+            if i["tf_id"] != j["tf_id"]:
+                yield i, j
+
+
 def find_overlaps( tfsd: list) -> list:
     """
     This is a diagnostic function to identify overlapping scenes represented by the
     tfsd data structure.
 
     It returns a list of dictionaries describing overlaps.
+
+    (For just the number and lengths of overlaps, `overlap_stats` is cheaper.)
     """
     
-    # make a shallow copy of tfsd, since we'll be re-sorting
-    tfsd = tfsd[:]
-
-    # order time frames by starting ms
-    tfsd.sort( key=lambda f:f["start"] )
-
-    # iterate through timeframes and search for other time frames that start before
-    # the end of the current one.
     overlaps = []
-    for i in tfsd:
-        for j in tfsd:
-            if ( i["start"] <= j["start"] and
-                 i["end"] >= j["start"] and
-                 i["tf_id"] != j["tf_id"] 
-                ):
-                 overlap = {
-                    "tf_id": i["tf_id"],
-                    "tf_label": i["tf_label"],
-                    "ov_id": j["tf_id"],
-                    "ov_label": j["tf_label"],
-                    "start": j["start"],
-                    "end": min( i["end"], j["end"] ),
-                    "dur": min( i["end"], j["end"] ) - j["start"] 
-                 }
-                 overlaps.append(overlap)
+    for i, j in _iter_overlaps( tfsd ):
+        overlap = {
+            "tf_id": i["tf_id"],
+            "tf_label": i["tf_label"],
+            "ov_id": j["tf_id"],
+            "ov_label": j["tf_label"],
+            "start": j["start"],
+            "end": min( i["end"], j["end"] ),
+            "dur": min( i["end"], j["end"] ) - j["start"] 
+        }
+        overlaps.append(overlap)
                     
     return overlaps
 
 
+def overlap_stats( tfsd: list) -> dict:
+    """
+    This is an aggregate-only version of `find_overlaps`.  Instead of a list of 
+    overlaps, it returns a dictionary with the following keys:
+      "count":      number of overlaps
+      "median_dur": median overlap duration in ms (None if there are no overlaps)
+      "max_dur":    maximum overlap duration in ms (None if there are no overlaps)
+      "max_start":  start time in ms of the first overlap of maximum duration
+    """
+
+    durs = []
+    max_dur = None
+    max_start = None
+    for i, j in _iter_overlaps( tfsd ):
+        dur = min( i["end"], j["end"] ) - j["start"]
+        durs.append(dur)
+        if max_dur is None or dur > max_dur:
+            max_dur = dur
+            max_start = j["start"]
+
+    return { "count": len(durs),
+             "median_dur": median(durs) if durs else None,
+             "max_dur": max_dur,
+             "max_start": max_start }
+
+
 
 def display_tfs(tfs:list):
     """
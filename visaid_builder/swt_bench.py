@@ -0,0 +1,160 @@
+"""
+swt_bench.py
+
+Measures how the time to join SWT annotations into a tfsd table (see
+`proc_swt.tfsd_from_mmif`) grows with the number of TimeFrames, on synthetic MMIF
+files, to check that it stays linear.
+
+Usage:
+    python -m visaid_builder.swt_bench [-n COUNT ...] [-l LOADER ...] [-k]
+
+For each count, writes a synthetic MMIF file with that many TimeFrames (each with
+`--tps` TimePoints, and a captioner TextDocument aligned to its representative
+TimePoint) to a temporary directory, reads it with each loader, and reports the
+time to read and index the views and the time for the joins, with the join time
+per 1,000 TimeFrames (which should stay about the same as the count grows).
+"""
+
+import os
+import json
+import time
+import argparse
+import tempfile
+
+from . import proc_swt
+
+
+SWT_APP = "http://apps.clams.ai/swt-detection/v7.2"
+CAPTIONER_APP = "http://apps.clams.ai/llava-captioner/v1.0"
+VOCAB = "http://mmif.clams.ai/vocabulary/"
+
+
+def synthetic_mmif( num_tfs:int,
+                    tps_per_tf:int = 3,
+                    captioned:bool = True ) -> dict:
+    """
+    Returns a synthetic MMIF structure (as for `json.dump`), with an SWT TimePoint
+    view, an SWT TimeFrame view with `num_tfs` TimeFrames of `tps_per_tf`
+    TimePoints each (the middle one representative), and, if `captioned`, a
+    captioner view with a TextDocument for each TimeFrame, aligned to its
+    representative TimePoint
+    """
+    tps = []
+    tfs = []
+    tds = []
+    alignments = []
+    for i in range(num_tfs):
+        tp_ids = [ f"tp_{i * tps_per_tf + k}" for k in range(tps_per_tf) ]
+        for k, tp_id in enumerate(tp_ids):
+            tps.append( { "@type": VOCAB + "TimePoint/v4",
+                          "properties": { "id": tp_id,
+                                          "timePoint": (i * tps_per_tf + k) * 500,
+                                          "label": "S" } } )
+        rep_id = tp_ids[len(tp_ids) // 2]
+        tfs.append( { "@type": VOCAB + "TimeFrame/v5",
+                      "properties": { "id": f"tf_{i}",
+                                      "label": "slate",
+                                      "targets": [ "v_0:" + tp_id for tp_id in tp_ids ],
+                                      "representatives": [ "v_0:" + rep_id ] } } )
+        if captioned:
+            tds.append( { "@type": VOCAB + "TextDocument/v1",
+                          "properties": { "id": f"td_{i}",
+                                          "origin": f"v_1:tf_{i}",
+                                          "text": { "@value": f"Caption {i}" } } } )
+            alignments.append( { "@type": VOCAB + "Alignment/v1",
+                                 "properties": { "id": f"al_{i}",
+                                                 "source": "v_0:" + rep_id,
+                                                 "target": f"td_{i}" } } )
+
+    def view( view_id, app, annotations ):
+        types = sorted(set( a["@type"] for a in annotations ))
+        return { "id": view_id,
+                 "metadata": { "app": app, "contains": { t: {} for t in types } },
+                 "annotations": annotations }
+
+    views = [ view( "v_0", SWT_APP, tps ), view( "v_1", SWT_APP, tfs ) ]
+    if captioned:
+        views.append( view( "v_2", CAPTIONER_APP, tds + alignments ) )
+    return { "metadata": { "mmif": "http://mmif.clams.ai/1.0.4" },
+             "documents": [ { "@type": VOCAB + "VideoDocument/v1",
+                              "properties": { "id": "m1",
+                                              "mime": "video",
+                                              "location": "file:///synthetic.mp4" } } ],
+             "views": views }
+
+
+def bench_joins( mmif_path:str,
+                 loader:str = "stream" ) -> dict:
+    """
+    Reads and indexes the SWT views of an MMIF file with the given loader (one of
+    `proc_swt.MMIF_LOADERS`), and then joins them into a tfsd table.
+
+    Returns a dictionary with the number of rows and join problems, and the time
+    (s) to read and index the views and to join them.
+    """
+    start = time.perf_counter()
+    if loader == "stream":
+        index = proc_swt.SwtViewIndex.from_path(mmif_path)
+    elif loader == "mmif":
+        with open(mmif_path, "r") as mmif_file:
+            usemmif = proc_swt.Mmif(mmif_file.read())
+        index = proc_swt.SwtViewIndex.from_mmif(usemmif)
+    else:
+        raise ValueError(f"Invalid MMIF loader '{loader}'. Valid loaders: {proc_swt.MMIF_LOADERS}")
+    read_seconds = time.perf_counter() - start
+
+    problems = []
+    start = time.perf_counter()
+    tfsd = proc_swt.tfsd_from_mmif( index,
+                                    index.tp_view_id,
+                                    index.tf_view_id,
+                                    index.td_view_id,
+                                    problems=problems )
+    join_seconds = time.perf_counter() - start
+
+    return { "rows": len(tfsd),
+             "problems": len(problems),
+             "read_seconds": read_seconds,
+             "join_seconds": join_seconds }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='swt_bench',
+        description='Measures SWT annotation join time versus the number of TimeFrames.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("-n", "--counts", type=int, nargs="+", default=[1000, 5000, 50000],
+        help="Numbers of TimeFrames to try")
+    parser.add_argument("-t", "--tps", type=int, default=3,
+        help="TimePoints per TimeFrame")
+    parser.add_argument("-l", "--loaders", type=str, nargs="+", default=["stream"],
+        choices=proc_swt.MMIF_LOADERS,
+        help="MMIF loaders to try")
+    parser.add_argument("-k", "--keep", action="store_true",
+        help="Keep the synthetic MMIF files (and print where they are)")
+
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="swt_bench_")
+    print(f"{'TFs':>7} {'loader':7} {'rows':>7} {'problems':>8} {'read s':>8} {'join s':>8} {'join ms/1k TFs':>15}")
+    for count in args.counts:
+        mmif_path = os.path.join(tmp_dir, f"synthetic_{count}.mmif")
+        with open(mmif_path, "w") as mmif_file:
+            json.dump( synthetic_mmif(count, args.tps), mmif_file )
+        for loader in args.loaders:
+            r = bench_joins( mmif_path, loader )
+            per_k = r["join_seconds"] * 1000 / (count / 1000) if count else 0.0
+            print(f"{count:>7} {loader:7} {r['rows']:>7} {r['problems']:>8} "
+                  f"{r['read_seconds']:>8.3f} {r['join_seconds']:>8.3f} {per_k:>15.2f}")
+        if not args.keep:
+            os.remove(mmif_path)
+
+    if args.keep:
+        print(f"Synthetic MMIF files are in {tmp_dir}")
+    else:
+        os.rmdir(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+swt_cache.py
+
+Defines functions for an on-disk cache of the SWT data that `proc_swt.load_swt`
+reads from MMIF files.
+
+Re-rendering visaids with different customizations does not change anything
+read from the MMIF file, so the results of `load_swt` (including the unadjusted
+tfsd table and the first and final TimePoint times) can be saved and reused.
+
+Cache entries are small JSON files in a cache directory.  Each entry is keyed by
+a hash of the contents of the MMIF file, plus the view IDs selected (if not chosen
+automatically).  Entries written by a different version of this package, or in 
+a different entry format, are ignored.
+
+Eviction is by age and by total size.  An entry's age counts from when it was
+last used, so the size limit removes least recently used entries first.
+
+The primary function here is `cached_load_swt`, which is a drop-in replacement for
+`proc_swt.load_swt`, taking additional cache options.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+
+from importlib.metadata import version
+
+__version__ = version("visaid_builder")
+from . import proc_swt
+
+
+# Default limits used for cache eviction
+SWT_CACHE_DEFAULTS = { "max_mb": 500,
+                       "max_age_days": 90 }
+
+# Version of the structure of cache entries (increment when `load_swt` changes)
+CACHE_FORMAT = 3
+
+# Running counts of cache activity for this process
+CACHE_STATS = { "hits": 0,
+                "misses": 0,
+                "writes": 0,
+                "evictions": 0 }
+
+
+def mmif_hash( mmif_path:str ) -> str:
+    """
+    Returns a hex digest of the contents of an MMIF file
+    """
+    h = hashlib.sha256()
+    with open(mmif_path, "rb") as mmif_file:
+        for chunk in iter(lambda: mmif_file.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _entry_path( cache_dir:str,
+                 content_hash:str,
+                 view_ids:tuple ) -> str:
+
+    if view_ids is None:
+        views_key = "auto"
+    else:
+        views_key = "-".join( str(v) for v in view_ids ).replace(":", ".")
+    return os.path.join( cache_dir, f"swt_{content_hash}_{views_key}.json" )
+
+
+def cached_load_swt( mmif_path:str,
+                     cache_dir:str,
+                     loader:str = "mmif",
+                     view_ids:tuple = None,
+                     max_mb:float = SWT_CACHE_DEFAULTS["max_mb"],
+                     max_age_days:float = SWT_CACHE_DEFAULTS["max_age_days"] ):
+    """
+    Returns the same dictionary as `proc_swt.load_swt`, using a cached copy in
+    `cache_dir` when one exists.  Otherwise, calls `load_swt` and caches the result.
+
+    If `cache_dir` is None or empty, no cache is used.  Failures to save to the
+    cache are logged and otherwise ignored.
+    """
+
+    if not cache_dir:
+        return proc_swt.load_swt(mmif_path, loader=loader, view_ids=view_ids)
+
+    content_hash = mmif_hash(mmif_path)
+    entry_path = _entry_path(cache_dir, content_hash, view_ids)
+
+    # Try the cache
+    if os.path.isfile(entry_path):
+        try:
+            with open(entry_path, "r") as entry_file:
+                entry = json.load(entry_file)
+            if entry["version"] == __version__ and entry.get("format") == CACHE_FORMAT:
+                CACHE_STATS["hits"] += 1
+                # touch the entry, so that it counts as recently used
+                os.utime(entry_path)
+                logging.debug(f"SWT cache hit for {mmif_path}")
+                swt = entry["swt"]
+                swt["tfsd"] = [ proc_swt.Scene(**d) for d in swt["tfsd"] ]
+                return swt
+        except Exception as e:
+            logging.warning(f"Warning: Ignoring unreadable SWT cache entry {entry_path}: {e}")
+
+    # Cache miss; read the MMIF file and save the results
+    CACHE_STATS["misses"] += 1
+    swt = proc_swt.load_swt(mmif_path, loader=loader, view_ids=view_ids)
+
+    entry = { "version": __version__,
+              "format": CACHE_FORMAT,
+              "mmif_path": mmif_path,
+              "swt": { **swt, "tfsd": [ dict(tf) for tf in swt["tfsd"] ] } }
+    tmp_path = entry_path + ".tmp"
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp_path, "w") as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(tmp_path, entry_path)
+    except OSError as e:
+        logging.warning(f"Warning: Could not save SWT cache entry {entry_path}: {e}")
+        return swt
+    CACHE_STATS["writes"] += 1
+
+    evict(cache_dir, max_mb=max_mb, max_age_days=max_age_days)
+
+    return swt
+
+
+def _entries( cache_dir:str ) -> list:
+    """
+    Returns a list of (path, size, mtime) for the entries in the cache, oldest first
+    """
+    entries = []
+    for fname in os.listdir(cache_dir):
+        if fname.startswith("swt_") and fname.endswith(".json"):
+            path = os.path.join(cache_dir, fname)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append( (path, st.st_size, st.st_mtime) )
+    entries.sort(key=lambda e:e[2])
+    return entries
+
+
+def evict( cache_dir:str,
+           max_mb:float = SWT_CACHE_DEFAULTS["max_mb"],
+           max_age_days:float = SWT_CACHE_DEFAULTS["max_age_days"] ) -> int:
+    """
+    Removes cache entries not used in the last `max_age_days`, and then removes the
+    least recently used entries until the cache is no bigger than `max_mb`.
+    (Either limit can be None, to skip that part of the eviction.)
+
+    Returns the number of entries removed.
+    """
+
+    entries = _entries(cache_dir)
+    removed = 0
+
+    if max_age_days is not None:
+        cutoff = time.time() - max_age_days * 86400
+        old = [ e for e in entries if e[2] < cutoff ]
+        entries = [ e for e in entries if e[2] >= cutoff ]
+        for path, _, _ in old:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            removed += 1
+
+    if max_mb is not None:
+        total = sum( e[1] for e in entries )
+        max_bytes = max_mb * 1024 * 1024
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+
+    CACHE_STATS["evictions"] += removed
+    return removed
+
+
+def cache_info( cache_dir:str ) -> dict:
+    """
+    Returns statistics about the cache directory, along with the running counts
+    of cache activity for this process.
+    """
+
+    entries = _entries(cache_dir) if os.path.isdir(cache_dir) else []
+    info = { "entries": len(entries),
+             "total_bytes": sum( e[1] for e in entries ),
+             "oldest_use": (time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(entries[0][2]))
+                            if entries else None),
+             **CACHE_STATS }
+    return info
@@ -0,0 +1,256 @@
+"""
+thumb_cache.py
+
+Defines functions for an on-disk cache of the stills (thumbnails) extracted from
+media files by `frame_plan.FramePlan`.
+
+Re-running visaids or cataids on the same media with different scene adjustments
+mostly asks for stills that were already extracted, so encoded stills are saved
+and reused.  When every still requested is in the cache, the media file is not
+opened at all.
+
+Each media file has its own entry:  a directory in the cache directory, named for
+a fingerprint of the media file (its size, its modification time, and a hash of
+its first and last MB), holding an index and one image file per still.  A still
+is keyed by its target time, the tolerance for finding its frame, and the style
+it was prepared in (the threshold for stretching anamorphic frames, the maximum
+image height, the image format and quality, the interpolation method, and the
+encoder), and by whether it was decoded at reduced resolution.  The index also records the
+technical stats of the video, so that artifacts can be made without opening it.
+
+Entries written by a different version of this package, or in a different entry
+format, are ignored.  Eviction is by total size, removing the least recently used
+entries first.  Media indexes saved in the same directory (`mindex_*.json`; see
+`media_index`) count as entries too.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+from importlib.metadata import version
+
+__version__ = version("visaid_builder")
+
+
+# Default limit used for cache eviction
+THUMB_CACHE_DEFAULTS = { "max_mb": 2000 }
+
+# Version of the structure of cache entries
+CACHE_FORMAT = 2
+
+# How much of each end of a media file is hashed for its fingerprint
+FINGERPRINT_BYTES = 1 << 20
+
+# Running counts of cache activity for this process (hits and misses count stills)
+CACHE_STATS = { "hits": 0,
+                "misses": 0,
+                "writes": 0,
+                "evictions": 0 }
+
+
+def media_fingerprint( media_path:str ) -> str:
+    """
+    Returns a hex digest identifying the contents of a media file, computed
+    from its size, its modification time, and its first and last MB.
+    (This is cheap even for very large files.)
+    """
+    st = os.stat(media_path)
+    h = hashlib.sha256()
+    h.update(f"{st.st_size}:{st.st_mtime_ns}:".encode())
+    with open(media_path, "rb") as media_file:
+        h.update(media_file.read(FINGERPRINT_BYTES))
+        if st.st_size > FINGERPRINT_BYTES:
+            media_file.seek( max(FINGERPRINT_BYTES, st.st_size - FINGERPRINT_BYTES) )
+            h.update(media_file.read(FINGERPRINT_BYTES))
+    return h.hexdigest()[:32]
+
+
+def still_key( target_time:int,
+               tolerance:int,
+               style:tuple ) -> str:
+    """
+    Returns the key for a still in a cache entry.  `style` is a tuple of
+    (stretch threshold, max image height, image format, image quality, 
+    interpolation, encoder), as stored by `FramePlan.request`, followed by 
+    "lowres" for stills decoded at reduced resolution.
+    """
+    return "_".join( str(v) for v in (target_time, tolerance, *style) )
+
+
+def _entry_dir( cache_dir:str,
+                fingerprint:str ) -> str:
+    return os.path.join( cache_dir, f"thumbs_{fingerprint}" )
+
+
+def _read_index( entry_dir:str ) -> dict:
+    """
+    Returns the index of a cache entry, or None if there is no usable index.
+    """
+    index_path = os.path.join(entry_dir, "index.json")
+    if not os.path.isfile(index_path):
+        return None
+    try:
+        with open(index_path, "r") as index_file:
+            index = json.load(index_file)
+        if index["version"] == __version__ and index.get("format") == CACHE_FORMAT:
+            return index
+    except Exception as e:
+        logging.warning(f"Warning: Ignoring unreadable thumbnail cache entry {entry_dir}: {e}")
+    return None
+
+
+def load_stills( cache_dir:str,
+                 fingerprint:str,
+                 keys:list ) -> tuple:
+    """
+    Looks up stills in the cache entry for a media file.
+
+    Returns a tuple of
+      `meta` - the technical stats recorded for the media file (or None if there
+      is no entry for it)
+      `stills` - dictionary keyed by still key, with values (actual frame time,
+      image data), for the keys that were found.  (The value is None for targets
+      known to have no frame, such as targets past the end of the video.)
+    """
+    entry_dir = _entry_dir(cache_dir, fingerprint)
+    index = _read_index(entry_dir)
+    if index is None:
+        CACHE_STATS["misses"] += len(keys)
+        return None, {}
+
+    stills = {}
+    for key in keys:
+        if key in index["stills"]:
+            if index["stills"][key] is None:
+                stills[key] = None
+                continue
+            ftime, img_fname = index["stills"][key]
+            try:
+                with open(os.path.join(entry_dir, img_fname), "rb") as img_file:
+                    stills[key] = (ftime, img_file.read())
+            except FileNotFoundError:
+                continue
+    CACHE_STATS["hits"] += len(stills)
+    CACHE_STATS["misses"] += len(keys) - len(stills)
+
+    # touch the entry, so that it counts as recently used
+    os.utime(os.path.join(entry_dir, "index.json"))
+
+    return index["meta"], stills
+
+
+def save_stills( cache_dir:str,
+                 fingerprint:str,
+                 meta:dict,
+                 stills:dict,
+                 media_path:str = "",
+                 max_mb:float = THUMB_CACHE_DEFAULTS["max_mb"] ):
+    """
+    Adds stills (a dictionary keyed by still key, with values (actual frame time,
+    image data), or None for targets with no frame) to the cache entry for a 
+    media file, along with the technical stats in `meta`, and then evicts old 
+    entries if the cache is too big.
+    """
+    entry_dir = _entry_dir(cache_dir, fingerprint)
+    if not os.path.exists(entry_dir):
+        os.makedirs(entry_dir)
+
+    index = _read_index(entry_dir)
+    if index is None:
+        index = { "version": __version__,
+                  "format": CACHE_FORMAT,
+                  "media_path": media_path,
+                  "stills": {} }
+    index["meta"] = meta
+
+    for key, still in stills.items():
+        if still is None:
+            index["stills"][key] = None
+            continue
+        ftime, img_data = still
+        img_fname = hashlib.sha1(key.encode()).hexdigest()[:16] + ".img"
+        with open(os.path.join(entry_dir, img_fname), "wb") as img_file:
+            img_file.write(img_data)
+        index["stills"][key] = [ ftime, img_fname ]
+        CACHE_STATS["writes"] += 1
+
+    index_path = os.path.join(entry_dir, "index.json")
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as index_file:
+        json.dump(index, index_file)
+    os.replace(tmp_path, index_path)
+
+    evict(cache_dir, max_mb=max_mb)
+
+
+def _entries( cache_dir:str ) -> list:
+    """
+    Returns a list of (path, size, mtime) for the entries in the cache (thumbnail
+    directories and media index files), least recently used first
+    """
+    entries = []
+    for fname in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, fname)
+        try:
+            if fname.startswith("thumbs_"):
+                mtime = os.stat(os.path.join(path, "index.json")).st_mtime
+                size = sum( e.stat().st_size for e in os.scandir(path) if e.is_file() )
+            elif fname.startswith("mindex_") and fname.endswith(".json"):
+                st = os.stat(path)
+                mtime = st.st_mtime
+                size = st.st_size
+            else:
+                continue
+        except FileNotFoundError:
+            continue
+        entries.append( (path, size, mtime) )
+    entries.sort(key=lambda e:e[2])
+    return entries
+
+
+def evict( cache_dir:str,
+           max_mb:float = THUMB_CACHE_DEFAULTS["max_mb"] ) -> int:
+    """
+    Removes the least recently used entries until the cache is no bigger than
+    `max_mb`.  (If `max_mb` is None, nothing is removed.)
+
+    Returns the number of entries removed.
+    """
+    if max_mb is None:
+        return 0
+
+    entries = _entries(cache_dir)
+    removed = 0
+    total = sum( e[1] for e in entries )
+    max_bytes = max_mb * 1024 * 1024
+    for path, size, _ in entries:
+        if total <= max_bytes:
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+        removed += 1
+
+    CACHE_STATS["evictions"] += removed
+    return removed
+
+
+def cache_info( cache_dir:str ) -> dict:
+    """
+    Returns statistics about the entries (thumbnails and media indexes) in the
+    cache directory, along with the running counts of cache activity for this
+    process.
+    """
+    entries = _entries(cache_dir) if os.path.isdir(cache_dir) else []
+    info = { "entries": len(entries),
+             "total_bytes": sum( e[1] for e in entries ),
+             **CACHE_STATS }
+    return info
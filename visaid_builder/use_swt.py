@@ -22,47 +22,46 @@ import json
 import importlib.metadata
 from pprint import pprint
 
-from mmif import Mmif
-from mmif import DocumentTypes
-
 # Import local modules
 from . import proc_swt 
+from . import swt_cache
 from . import create_visaid
+from . import frame_plan
 from . import lilhelp
 
 # get version number from `pyproject.toml` file
 __version__ = importlib.metadata.version("visaid_builder")
 
+# Visaid options that say how the video is decoded (rather than how the stills 
+# look), which must be the same for all the customization sets of a sweep
+DECODE_OPTIONS = [ "extract_strategy",
+                   "skip_frames",
+                   "skip_window",
+                   "decode_thread_type",
+                   "decode_threads",
+                   "decode_workers",
+                   "encode_threads",
+                   "lowres_decode" ]
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(message)s"
 )
 
 
-def proc_display(mmif_path:str):
+def proc_display(mmif_path:str, loader:str="mmif", cache_dir:str=None):
     """
     This function simply prints a simple table of TimeFrame annotations from the MMIF file.
 
     It is one of the procedures conditionally called by the main() function.
     """
 
-    # Load up the MMIF serialization from a MMIF file
-    with open(mmif_path, "r") as usefile:
-        mmif_str = usefile.read()
-
-    usemmif = Mmif(mmif_str)
-
     logging.info("Attempting to process MMIF into a scene list...")
 
-    # Get the right views
-    tp_view_id, tf_view_id = proc_swt.get_swt_view_ids(usemmif)
-    td_view_id = proc_swt.get_td_view_id(usemmif)
+    # create TimeFrame table from the MMIF file
+    swt = swt_cache.cached_load_swt(mmif_path, cache_dir, loader=loader)
+    tfsd = swt["tfsd"]
 
-    # create TimeFrame table from the serialized MMIF
-    tfsd = proc_swt.tfsd_from_mmif( usemmif, 
-                                    tp_view_id,
-                                    tf_view_id,
-                                    td_view_id )
     # create legacy table structure
     tfs = proc_swt.tfsd_to_tfs(tfsd)
 
@@ -81,10 +80,19 @@ def proc_visaid( mmif_path:str,
                  visaid_path:str=None, 
                  stdout:bool=False,
                  scene_adj:bool=True,
-                 cust_params:dict={} ):
+                 cust_params=None,
+                 loader:str="mmif",
+                 cache_dir:str=None,
+                 index_dir:str=None,
+                 index_next_to_media:bool=False ):
     """
     This performs all the steps to process a MMIF file and create a visaid.
 
+    `cust_params` may also be a list of customization dictionaries (a parameter 
+    sweep).  Then one visaid is created for each customization set, all from a 
+    single pass through the video.  Each visaid file name gets a suffix with the
+    number of its customization set (e.g., "_cust2").
+
     Args:
         mmif_path (str): Path to the input MMIF file
         video_path (str): Path to the input video file
@@ -92,40 +100,74 @@ def proc_visaid( mmif_path:str,
         stdout (bool): If true, visaid is written to stdout.
         scene_adj (bool):  If true, visaid scenes (such as scene subamples) are 
             added and/or removed before visaid creation
-        cust_params (dict):  Dictionary of values for custom parameters
+        cust_params (dict or list):  Dictionary of values for custom parameters,
+            or a list of such dictionaries
+        loader (str):  MMIF loader to use (one of `proc_swt.MMIF_LOADERS`)
+        cache_dir (str):  Directory for caching data read from MMIF files and
+            stills extracted from the video (no caching if None)
+        index_dir (str):  Directory for saving the index of the video (see 
+            `media_index`), if not `cache_dir`
+        index_next_to_media (bool):  If true, and there is no directory for the
+            index, the index is saved next to the video file
 
     Returns:
         (no return value)
 
     Raises:
         FileNotFoundError: If the media file is missing.
+        ValueError: If several customization sets are to be written to stdout,
+            or if they differ in how the video is to be decoded (any of the 
+            `DECODE_OPTIONS`).
     """
 
     #
     # Collect and sort all the declared and default parameters        
+    # (for each customization set)
     #
     if not cust_params:
         cust_params = {}
 
-    proc_swt_params = {}
-    for key in proc_swt.PROC_SWT_DEFAULTS:
-        if key in cust_params:
-            proc_swt_params[key] = cust_params[key]
-        else:
-            proc_swt_params[key] = proc_swt.PROC_SWT_DEFAULTS[key]
-    visaid_params = {}
-    for key in create_visaid.VISAID_DEFAULTS:
-        if key in cust_params:
-            visaid_params[key] = cust_params[key]
-        else:
-            visaid_params[key] = create_visaid.VISAID_DEFAULTS[key]
+    if isinstance(cust_params, dict):
+        cust_sets = [ cust_params ]
+    else:
+        cust_sets = [ (c or {}) for c in cust_params ]
+        if not cust_sets:
+            cust_sets = [ {} ]
+    sweep = len(cust_sets) > 1
+
+    if sweep and stdout:
+        raise ValueError("Cannot write visaids for several customization sets to stdout.")
+
+    param_sets = []
+    for cust in cust_sets:
+        proc_swt_params = {}
+        for key in proc_swt.PROC_SWT_DEFAULTS:
+            if key in cust:
+                proc_swt_params[key] = cust[key]
+            else:
+                proc_swt_params[key] = proc_swt.PROC_SWT_DEFAULTS[key]
+        visaid_params = {}
+        for key in create_visaid.VISAID_DEFAULTS:
+            if key in cust:
+                visaid_params[key] = cust[key]
+            else:
+                visaid_params[key] = create_visaid.VISAID_DEFAULTS[key]
+        param_sets.append( (proc_swt_params, visaid_params) )
+
+    # (All the sets share one pass through the video.)
+    differing = [ key for key in DECODE_OPTIONS
+                  if any( vp[key] != param_sets[0][1][key] for _, vp in param_sets ) ]
+    if differing:
+        raise ValueError("Customization sets must have the same values for decoding options, but they differ in: " + ", ".join(differing))
 
-    
-    # Load up the MMIF serialization from a MMIF file
-    with open(mmif_path, "r") as usefile:
-        mmif_str = usefile.read()
 
-    usemmif = Mmif(mmif_str)
+    #
+    # Process MMIF into a scene list
+    # 
+    if not stdout:
+        logging.info("Attempting to process MMIF into a scene list...")
+
+    swt = swt_cache.cached_load_swt(mmif_path, cache_dir, loader=loader)
 
     #
     # Figure out the path to the media file, if it has not been provided
@@ -144,7 +186,7 @@ def proc_visaid( mmif_path:str,
     if not visaid_video_path:
 
         # get the document path from the MMIF file
-        doc_path = usemmif.get_document_location(DocumentTypes.VideoDocument, path_only=True)
+        doc_path = swt["video_path"]
 
         if visaid_video_dir:
             # We were given a directory path as input.
@@ -160,40 +202,31 @@ def proc_visaid( mmif_path:str,
 
 
     #
-    # Process MMIF and create visaid
+    # Adjust scene list and create visaid
     # 
-    if not stdout:
-        logging.info("Attempting to process MMIF into a scene list...")
+    tfsd = swt["tfsd"]
+    first_time, final_time = swt["first_time"], swt["final_time"]
 
-    # Get the right views
-    tp_view_id, tf_view_id = proc_swt.get_swt_view_ids(usemmif)
-    td_view_id = proc_swt.get_td_view_id(usemmif)
-
-    # create TimeFrame table from the serialized MMIF
-    # create TimeFrame table from the serialized MMIF
-    tfsd = proc_swt.tfsd_from_mmif( usemmif, 
-                                    tp_view_id,
-                                    tf_view_id,
-                                    td_view_id )
-    # find the outer temporal boundaries of the TimePoint analysis
-    first_time, final_time = proc_swt.first_final_time_in_mmif( usemmif, tp_view_id=tp_view_id )
+    if not stdout:
+        for kind in proc_swt.JOIN_PROBLEMS:
+            count = len([ p for p in swt["problems"] if p["problem"] == kind ])
+            if count:
+                logging.warning(f"Warning: {count} x {kind}: {proc_swt.JOIN_PROBLEMS[kind]}")
 
     # Create an adjusted TimeFrame table (with scenes added and/or removed)
-    if scene_adj:
-        tfsd_adj = proc_swt.adjust_tfsd( tfsd, 
-                                         first_time, 
-                                         final_time, 
-                                         proc_swt_params ) 
-    else:
-        tfsd_adj = tfsd[:]
-
-    # create legacy table structure
-    tfs = proc_swt.tfsd_to_tfs(tfsd)
-    tfs_adj = proc_swt.tfsd_to_tfs(tfsd_adj)
+    # for each customization set
+    tfsd_adjs = []
+    for proc_swt_params, _ in param_sets:
+        if scene_adj:
+            tfsd_adj = proc_swt.adjust_tfsd( tfsd, 
+                                             first_time, 
+                                             final_time, 
+                                             proc_swt_params ) 
+        else:
+            tfsd_adj = tfsd[:]
+        tfsd_adjs.append(tfsd_adj)
 
-    mmif_metadata_str = proc_swt.get_mmif_metadata_str( usemmif,
-                                                        tp_view_id,
-                                                        tf_view_id )
+    mmif_metadata_str = swt["mmif_metadata_str"]
 
     # Assign values for other required parameters
 
@@ -209,26 +242,85 @@ def proc_visaid( mmif_path:str,
         output_dirname = "."
 
 
+    # Extract the stills needed for all the customization sets in one pass 
+    # through the video:  one request for each distinct style of still (image
+    # height, format, quality, etc.), for the union of the rep times of all the
+    # adjusted tables of the sets with that style.
     if not stdout:
-        logging.info("Creating a visual index...")
+        logging.info("Extracting stills from video...")
+    style_times = {}
+    set_styles = []
+    for (_, visaid_params), tfsd_adj in zip(param_sets, tfsd_adjs):
+        img_format, img_quality = create_visaid.img_settings( visaid_params["img_format"], 
+                                                              visaid_params["img_profile"], 
+                                                              stdout )
+        style = ( visaid_params["max_img_height"],
+                  img_format,
+                  img_quality,
+                  visaid_params["interpolation"],
+                  visaid_params["img_encoder"],
+                  visaid_params["preview_tolerance"] if visaid_params["preview"] else None )
+        style_times.setdefault( style, set() ).update( tf["tp_time"] for tf in tfsd_adj )
+        set_styles.append(style)
+    style_names = { style: f"style{snum}" for snum, style in enumerate(style_times, start=1) }
+
+    plan = frame_plan.FramePlan( visaid_video_path, 
+                                 stdout=stdout, 
+                                 cache_dir=cache_dir,
+                                 index_dir=index_dir,
+                                 index_next_to_media=index_next_to_media )
+    for style, times in style_times.items():
+        max_img_height, img_format, img_quality, interpolation, encoder, preview_tolerance = style
+        plan.request( style_names[style],
+                      times,
+                      stretch_threshold=create_visaid.STRETCH_THRESHOLD,
+                      max_img_height=max_img_height,
+                      img_format=img_format,
+                      img_quality=img_quality,
+                      preview_tolerance=preview_tolerance,
+                      interpolation=interpolation,
+                      encoder=encoder )
+    # (The decoding options are the same for all the sets.)
+    decode_params = param_sets[0][1]
+    plan.run( strategy=decode_params["extract_strategy"],
+              skip_frames=decode_params["skip_frames"],
+              skip_window=decode_params["skip_window"],
+              thread_type=decode_params["decode_thread_type"],
+              thread_count=decode_params["decode_threads"],
+              workers=decode_params["decode_workers"],
+              encode_threads=decode_params["encode_threads"],
+              lowres=decode_params["lowres_decode"] )
 
-    # Create visaid
-    visaid_path, visaid_problems, visaid_infos, visaid_extras = create_visaid.create_visaid( 
-        video_path=visaid_video_path, 
-        tfs=tfs_adj, 
-        stdout=stdout, 
-        output_dirname=output_dirname,
-        hfilename=hfilename,
-        item_id=video_filename_base,
-        item_name=video_filename,
-        proc_swt_params=proc_swt_params,
-        visaid_params=visaid_params,
-        mmif_metadata_str=mmif_metadata_str
-        )
 
     if not stdout:
-        logging.info("Visual index created at")
-        logging.info(visaid_path)
+        logging.info("Creating a visual index...")
+
+    # Create visaids
+    for set_num, ((proc_swt_params, visaid_params), tfsd_adj) in enumerate(zip(param_sets, tfsd_adjs), start=1):
+
+        if sweep:
+            hfilename_base, hfilename_ext = os.path.splitext(hfilename)
+            set_hfilename = f"{hfilename_base}_cust{set_num}{hfilename_ext}"
+        else:
+            set_hfilename = hfilename
+
+        set_visaid_path, visaid_problems, visaid_infos, visaid_extras = create_visaid.create_visaid( 
+            video_path=visaid_video_path, 
+            tfsd=tfsd_adj, 
+            stdout=stdout, 
+            output_dirname=output_dirname,
+            hfilename=set_hfilename,
+            item_id=video_filename_base,
+            item_name=video_filename,
+            proc_swt_params=proc_swt_params,
+            visaid_params=visaid_params,
+            mmif_metadata_str=mmif_metadata_str,
+            stills=plan.stills(style_names[set_styles[set_num-1]])
+            )
+
+        if not stdout:
+            logging.info("Visual index created at")
+            logging.info(set_visaid_path)
 
 
 
@@ -257,8 +349,18 @@ Creates useful data artifacts from the output of the SWT detection CLAMS app.
         help="File path for visaid HTML file.  Implies 'visaid'.")
     parser.add_argument("-m", "--mmif_only", action="store_true",
         help="Include only MMIF TimeFrames (do not adjust scenes according to customizations) before creating a visaid")
-    parser.add_argument("-c", "--customization", type=str, default=None,
-        help="Path to a JSON file supplying the values of customization options")
+    parser.add_argument("-c", "--customization", type=str, default=None, nargs="+",
+        help="Path to a JSON file supplying the values of customization options.  Several paths may be given (or a file may contain a list of sets of options), to create one visaid for each set of options from a single pass through the video.")
+    parser.add_argument("-l", "--loader", type=str, default="mmif", choices=proc_swt.MMIF_LOADERS,
+        help="How to read the MMIF file.  The 'stream' loader reads only the annotations needed, without building a full MMIF object.  (Default: 'mmif')")
+    parser.add_argument("-p", "--preview", action="store_true",
+        help="Make a quick preview visaid, using the nearest keyframe (within the 'preview_tolerance' option) for each still.")
+    parser.add_argument("--cache_dir", type=str, default=None,
+        help="Directory in which to cache data read from MMIF files and stills (and indexes) extracted from video, so that re-running with the same files skips reading the MMIF file and decoding frames already extracted.")
+    parser.add_argument("--index_dir", type=str, default=None,
+        help="Directory in which to save the index of the video (its duration and keyframe times), so that re-running with the same video skips reading the whole file to build it.  (Default: the cache directory, if any)")
+    parser.add_argument("--index_next_to_media", action="store_true",
+        help="Save the index of the video next to the video file (as '<video file>.mindex.json'), if there is no directory for it.")
     
     args = parser.parse_args() 
 
@@ -296,9 +398,9 @@ Creates useful data artifacts from the output of the SWT detection CLAMS app.
             sys.exit(1)
 
 
-    # Validate customization file
-    cust_path = args.customization
-    if cust_path:
+    # Validate customization files
+    cust_paths = args.customization or []
+    for cust_path in cust_paths:
         if not os.path.exists(cust_path):
             print("Error:  No file exists at the supplied customization file path.")
             print("Run with '-h' for help.")
@@ -317,27 +419,50 @@ Creates useful data artifacts from the output of the SWT detection CLAMS app.
     warnings.filterwarnings("ignore")
 
     if display:
-        proc_display(mmif_path)
+        proc_display(mmif_path, loader=args.loader, cache_dir=args.cache_dir)
 
     if visaid:
-        if cust_path:
+        # Each customization file may hold one set of options or a list of sets
+        cust_sets = []
+        for cust_path in cust_paths:
             with open(cust_path, "r") as file:
-                cust_params = json.load(file)
-            if not stdout:
-                # Warn about spurious parameters
-                for key in cust_params:
+                cust_json = json.load(file)
+            if isinstance(cust_json, list):
+                cust_sets += cust_json
+            else:
+                cust_sets.append(cust_json)
+
+        if args.preview:
+            cust_sets = [ { **c, "preview": True } for c in (cust_sets or [ {} ]) ]
+
+        if stdout and len(cust_sets) > 1:
+            print("Error:  Cannot write visaids for several customization sets to stdout.")
+            print("Run with '-h' for help.")
+            sys.exit(1)
+
+        if not stdout:
+            # Warn about spurious parameters
+            for cust in cust_sets:
+                for key in cust:
                     if key not in { **proc_swt.PROC_SWT_DEFAULTS, 
                                     **create_visaid.VISAID_DEFAULTS } :
                         logging.warning("Warning: `" + key + "` is not a valid config option for this postprocess. Ignoring.")
+
+        if len(cust_sets) == 1:
+            cust_params = cust_sets[0]
         else:
-            cust_params = {}
+            cust_params = cust_sets
 
         proc_visaid( mmif_path, 
                      video_path, 
                      visaid_path=visaid_path,
                      stdout=stdout, 
                      scene_adj=scene_adj,
-                     cust_params=cust_params )
+                     cust_params=cust_params,
+                     loader=args.loader,
+                     cache_dir=args.cache_dir,
+                     index_dir=args.index_dir,
+                     index_next_to_media=args.index_next_to_media )
 
 
 #
@@ -108,6 +108,28 @@ function toggleEngagement() {
     }
 }
 
+function imgDataUri(imgEl) {
+    // Images may be embedded (as data URIs) or in sidecar files.  For sidecar
+    // files, make a data URI from the loaded image, if the browser allows it.
+    // (Browsers do not allow it for pages opened from `file://` URLs, so the
+    // cataid must be served over HTTP to export sidecar images.)  Returns null
+    // if the image cannot be made into a data URI.
+    const src = imgEl.getAttribute('src');
+    if (src.startsWith("data:")) {
+        return src;
+    }
+    try {
+        const canvas = document.createElement("canvas");
+        canvas.width = imgEl.naturalWidth;
+        canvas.height = imgEl.naturalHeight;
+        canvas.getContext("2d").drawImage(imgEl, 0, 0);
+        return canvas.toDataURL("image/jpeg");
+    }
+    catch (e) {
+        return null;
+    }
+}
+
 function collectEdits () {
     const cataloger = document.getElementById("cataloger-blank").textContent.trim();
     if (!cataloger) {
@@ -124,6 +146,7 @@ function collectEdits () {
     dataExport["cataloger"] = cataloger
     dataExport["export_date"] = new Date().toISOString().slice(0,-5) + "Z";
     dataExport["editor_items"] = [];
+    let unembedded = 0;
     for (const itemEl of document.querySelectorAll(`.item-editor.engaged`)) {
         const editorItem = {};
 
@@ -142,7 +165,15 @@ function collectEdits () {
         editorItem["img_fname"] = fnameEl.textContent.trim();
 
         const imgEl = document.querySelector(`img[data-rid='${rid}']`);
-        editorItem["img_data_uri"] = imgEl.getAttribute('src');
+        const dataUri = imgDataUri(imgEl);
+        if (dataUri === null) {
+            // fall back to the URL of the image file
+            editorItem["img_data_uri"] = imgEl.src;
+            unembedded += 1;
+        }
+        else {
+            editorItem["img_data_uri"] = dataUri;
+        }
 
         dataExport["editor_items"].push(editorItem);
     }
@@ -157,6 +188,13 @@ function collectEdits () {
     anchor.download = filename;
     anchor.click();
     window.URL.revokeObjectURL(url);
+    if (unembedded > 0) {
+        window.alert(`${unembedded} image(s) could not be included in the export, because this cataid ` +
+                     "was opened from a file, and its images are in separate files.  The export refers " +
+                     "to the image files instead, so it will not show the images once moved.  To " +
+                     "include the images, open the cataid from a web server (e.g., run " +
+                     "`python -m http.server` in its directory and open it at http://localhost:8000/).");
+    }
 }
 
 function initializePage() {